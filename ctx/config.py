@@ -39,12 +39,62 @@ def create_redis_config(config_info: 'Dict'):
     return RedisConfig(config_info)
 
 
+def create_upstream_config(config_info: 'Dict'):
+    return UpstreamConfig(config_info)
+
+
+def create_circuit_breaker_config(config_info: 'Dict'):
+    return CircuitBreakerConfig(config_info)
+
+
+def create_health_check_config(config_info: 'Dict'):
+    return HealthCheckConfig(config_info)
+
+
+def create_retry_config(config_info: 'Dict'):
+    return RetryConfig(config_info)
+
+
+def create_throttle_config(config_info: 'Dict'):
+    return ThrottleConfig(config_info)
+
+
+def create_response_cache_config(config_info: 'Dict'):
+    return ResponseCacheConfig(config_info)
+
+
+def create_coalescing_config(config_info: 'Dict'):
+    return CoalescingConfig(config_info)
+
+
+def create_compression_config(config_info: 'Dict'):
+    return CompressionConfig(config_info)
+
+
+def create_rpc_server_config(config_info: 'Dict'):
+    return RpcServerConfig(config_info)
+
+
+def create_prefork_config(config_info: 'Dict'):
+    return PreforkConfig(config_info)
+
+
 class AbsConfigOption:
 
     def __init__(self):
         self.discovery_config = None  # type: [DiscoveryConfig]
         self.app_config = None  # type: [AppConfig]
         self.redis_config = None  # type: [RedisConfig]
+        self.upstream_config = None  # type: [UpstreamConfig]
+        self.circuit_breaker_config = None  # type: [CircuitBreakerConfig]
+        self.health_check_config = None  # type: [HealthCheckConfig]
+        self.retry_config = None  # type: [RetryConfig]
+        self.throttle_config = None  # type: [ThrottleConfig]
+        self.response_cache_config = None  # type: [ResponseCacheConfig]
+        self.coalescing_config = None  # type: [CoalescingConfig]
+        self.compression_config = None  # type: [CompressionConfig]
+        self.rpc_server_config = None  # type: [RpcServerConfig]
+        self.prefork_config = None  # type: [PreforkConfig]
 
     def get_discovery_config(self) -> 'DiscoveryConfig':
         return self.discovery_config
@@ -52,6 +102,36 @@ class AbsConfigOption:
     def get_redis_config(self) -> 'RedisConfig':
         return self.redis_config
 
+    def get_upstream_config(self) -> 'UpstreamConfig':
+        return self.upstream_config
+
+    def get_circuit_breaker_config(self) -> 'CircuitBreakerConfig':
+        return self.circuit_breaker_config
+
+    def get_health_check_config(self) -> 'HealthCheckConfig':
+        return self.health_check_config
+
+    def get_retry_config(self) -> 'RetryConfig':
+        return self.retry_config
+
+    def get_throttle_config(self) -> 'ThrottleConfig':
+        return self.throttle_config
+
+    def get_response_cache_config(self) -> 'ResponseCacheConfig':
+        return self.response_cache_config
+
+    def get_coalescing_config(self) -> 'CoalescingConfig':
+        return self.coalescing_config
+
+    def get_compression_config(self) -> 'CompressionConfig':
+        return self.compression_config
+
+    def get_rpc_server_config(self) -> 'RpcServerConfig':
+        return self.rpc_server_config
+
+    def get_prefork_config(self) -> 'PreforkConfig':
+        return self.prefork_config
+
     def get_name(self) -> str:
         if self.app_config:
             return self.app_config.name
@@ -129,3 +209,249 @@ class RedisConfig(Config):
                     raise CommonException(error_code=CommonErrorCode.Redis_Conf_Not_Setting_Error)
         else:
             raise CommonException(error_code=CommonErrorCode.Redis_Conf_Not_Setting_Error)
+
+
+class UpstreamConfig(Config):
+    """upstream http and redis rpc connection pool config, every option is optional"""
+
+    def __init__(self, config_info: dict):
+        self.max_connections_per_host = 64
+        self.redis_max_connections = 512
+        self.idle_timeout = 60.0
+        self.connect_timeout = 20.0
+        self.request_timeout = 20.0
+        self.streaming = False
+        self.max_body_size = None
+        self.max_buffer_size = 1024 * 1024
+        self.load_balancer = 'random'
+        self.total_timeout = 30.0
+        self.config_parse(config_info)
+
+    def config_parse(self, config_info: dict):
+        if config_info:
+            upstream_config = config_info.get('upstream')
+            if upstream_config:
+                self.max_connections_per_host = upstream_config.get('max_connections_per_host',
+                                                                    self.max_connections_per_host)
+                self.redis_max_connections = upstream_config.get('redis_max_connections',
+                                                                 self.redis_max_connections)
+                self.idle_timeout = upstream_config.get('idle_timeout', self.idle_timeout)
+                self.connect_timeout = upstream_config.get('connect_timeout', self.connect_timeout)
+                self.request_timeout = upstream_config.get('request_timeout', self.request_timeout)
+                self.streaming = upstream_config.get('streaming', self.streaming)
+                self.max_body_size = upstream_config.get('max_body_size', self.max_body_size)
+                self.max_buffer_size = upstream_config.get('max_buffer_size', self.max_buffer_size)
+                self.load_balancer = upstream_config.get('load_balancer', self.load_balancer)
+                self.total_timeout = upstream_config.get('total_timeout', self.total_timeout)
+
+
+class CircuitBreakerConfig(Config):
+    """outlier detection per instance and circuit breaker per service, every option is optional"""
+
+    def __init__(self, config_info: dict):
+        self.enabled = True
+        self.consecutive_errors = 5
+        self.base_ejection_time = 30.0
+        self.max_ejection_time = 300.0
+        self.max_ejection_percent = 50
+        self.failure_rate_threshold = 0.5
+        self.minimum_requests = 20
+        self.window = 10.0
+        self.open_timeout = 10.0
+        self.half_open_requests = 1
+        self.config_parse(config_info)
+
+    def config_parse(self, config_info: dict):
+        if config_info:
+            breaker_config = config_info.get('circuit_breaker')
+            if breaker_config:
+                for option in ('enabled', 'consecutive_errors', 'base_ejection_time', 'max_ejection_time',
+                               'max_ejection_percent', 'failure_rate_threshold', 'minimum_requests', 'window',
+                               'open_timeout', 'half_open_requests'):
+                    setattr(self, option, breaker_config.get(option, getattr(self, option)))
+
+
+class HealthCheckConfig(Config):
+    """active health checking of the discovered instances, every option is optional"""
+
+    def __init__(self, config_info: dict):
+        self.enabled = True
+        self.path = '/health'
+        self.interval = 10.0
+        self.jitter = 0.2
+        self.timeout = 2.0
+        self.unhealthy_threshold = 2
+        self.healthy_threshold = 1
+        self.config_parse(config_info)
+
+    def config_parse(self, config_info: dict):
+        if config_info:
+            health_check_config = config_info.get('health_check')
+            if health_check_config:
+                for option in ('enabled', 'path', 'interval', 'jitter', 'timeout', 'unhealthy_threshold',
+                               'healthy_threshold'):
+                    setattr(self, option, health_check_config.get(option, getattr(self, option)))
+
+
+class RetryConfig(Config):
+    """retries and hedged requests of idempotent upstream calls, every option is optional"""
+
+    def __init__(self, config_info: dict):
+        self.enabled = True
+        self.retries = 1
+        self.hedge = True
+        self.budget_ratio = 0.1
+        self.min_retries_per_second = 10.0
+        self.hedge_percentile = 0.95
+        self.hedge_min_delay = 0.01
+        self.config_parse(config_info)
+
+    def config_parse(self, config_info: dict):
+        if config_info:
+            retry_config = config_info.get('retry')
+            if retry_config:
+                for option in ('enabled', 'retries', 'hedge', 'budget_ratio', 'min_retries_per_second',
+                               'hedge_percentile', 'hedge_min_delay'):
+                    setattr(self, option, retry_config.get(option, getattr(self, option)))
+
+
+class ThrottleConfig(Config):
+    """
+    request throttling of the routes with throttling enabled by the ``throttling`` or ``throttle``
+    metadata of their instances, every option is optional.
+    mode ``redis`` asks redis on every request, ``hybrid`` leases token batches from redis
+    and ``local`` only throttles per gateway. ``algorithm`` is the default of the routes without
+    ``throttle`` metadata, one of token_bucket, sliding_window and gcra
+    """
+
+    def __init__(self, config_info: dict):
+        self.mode = 'hybrid'
+        self.algorithm = 'token_bucket'
+        self.rate = 30
+        self.capacity = 200
+        self.lease_size = 10
+        self.lease_ttl = 1.0
+        self.fail_open = True
+        self.config_parse(config_info)
+
+    def config_parse(self, config_info: dict):
+        if config_info:
+            throttle_config = config_info.get('throttle')
+            if throttle_config:
+                for option in ('mode', 'algorithm', 'rate', 'capacity', 'lease_size', 'lease_ttl', 'fail_open'):
+                    setattr(self, option, throttle_config.get(option, getattr(self, option)))
+
+
+class ResponseCacheConfig(Config):
+    """
+    in-memory cache of GET responses, every option is optional. Only routes with a ttl are cached,
+    ``ttl`` 0 leaves it to the ``cache_ttl`` metadata of the routes
+    """
+
+    def __init__(self, config_info: dict):
+        self.enabled = True
+        self.ttl = 0
+        self.stale_while_revalidate = 0
+        self.max_size = 64 * 1024 * 1024
+        self.max_entry_size = 1024 * 1024
+        self.key_headers = list()
+        self.config_parse(config_info)
+
+    def config_parse(self, config_info: dict):
+        if config_info:
+            cache_config = config_info.get('response_cache')
+            if cache_config:
+                for option in ('enabled', 'ttl', 'stale_while_revalidate', 'max_size', 'max_entry_size',
+                               'key_headers'):
+                    setattr(self, option, cache_config.get(option, getattr(self, option)))
+
+
+class CoalescingConfig(Config):
+    """single flight of identical requests to the routes with the ``idempotent`` metadata, every option is optional"""
+
+    def __init__(self, config_info: dict):
+        self.enabled = True
+        self.max_wait = 10.0
+        self.max_body_size = 4 * 1024 * 1024
+        self.key_headers = list()
+        self.config_parse(config_info)
+
+    def config_parse(self, config_info: dict):
+        if config_info:
+            coalescing_config = config_info.get('coalescing')
+            if coalescing_config:
+                for option in ('enabled', 'max_wait', 'max_body_size', 'key_headers'):
+                    setattr(self, option, coalescing_config.get(option, getattr(self, option)))
+
+
+class CompressionConfig(Config):
+    """
+    compression of the responses, every option is optional. ``encodings`` in order of preference,
+    br and zstd are skipped when brotli or zstandard are not installed
+    """
+
+    def __init__(self, config_info: dict):
+        self.enabled = True
+        self.min_size = 1024
+        self.level = 6
+        self.encodings = ['br', 'zstd', 'gzip']
+        self.max_cpu_usage = 0.8
+        self.config_parse(config_info)
+
+    def config_parse(self, config_info: dict):
+        if config_info:
+            compression_config = config_info.get('compression')
+            if compression_config:
+                for option in ('enabled', 'min_size', 'level', 'encodings', 'max_cpu_usage'):
+                    setattr(self, option, compression_config.get(option, getattr(self, option)))
+
+
+class RpcServerConfig(Config):
+    """
+    redis rpc server, every option is optional. Requests are read in batches of ``batch_size``,
+    at most ``concurrency`` are handled at once, sync handlers on ``workers`` threads.
+    ``transport`` stream reads them from a redis stream and acks them once replied,
+    requests pending longer than ``claim_idle`` seconds with a dead server are handled again.
+    ``processes`` above 1 forks that many worker processes, for handlers bound by the GIL
+    """
+
+    def __init__(self, config_info: dict):
+        self.transport = 'list'
+        self.processes = 1
+        self.shutdown_timeout = 30.0
+        self.concurrency = 100
+        self.workers = 50
+        self.batch_size = 100
+        self.block = 5.0
+        self.claim_idle = 30.0
+        self.max_deliveries = 5
+        self.stream_max_len = 100000
+        self.config_parse(config_info)
+
+    def config_parse(self, config_info: dict):
+        if config_info:
+            rpc_server_config = config_info.get('rpc_server')
+            if rpc_server_config:
+                for option in ('transport', 'processes', 'shutdown_timeout', 'concurrency', 'workers', 'batch_size',
+                               'block', 'claim_idle', 'max_deliveries', 'stream_max_len'):
+                    setattr(self, option, rpc_server_config.get(option, getattr(self, option)))
+
+
+class PreforkConfig(Config):
+    """
+    worker processes of the gateway, every option is optional. ``processes`` above 1 forks that many
+    workers serving the port together, 0 forks one per cpu. Workers still serving after ``shutdown_timeout``
+    seconds of a stop are killed
+    """
+
+    def __init__(self, config_info: dict):
+        self.processes = 1
+        self.shutdown_timeout = 30.0
+        self.config_parse(config_info)
+
+    def config_parse(self, config_info: dict):
+        if config_info:
+            prefork_config = config_info.get('prefork')
+            if prefork_config:
+                for option in ('processes', 'shutdown_timeout'):
+                    setattr(self, option, prefork_config.get(option, getattr(self, option)))
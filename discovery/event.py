@@ -1,6 +1,7 @@
 """
 Discovery Event Definition
 """
+from typing import List
 
 
 class WatchedEvent:
@@ -14,8 +15,42 @@ class ServiceWatchedEvent(WatchedEvent):
     """
     A change on Discovery that a Watcher is able to respond to.
     The :class:`ServiceWatchedEvent` declare service has changed for add , del, modified.
-    An instance of :class:`ServiceWatchedEvent` will be passed to registered watch functions.
+    ``func`` is called with a :class:`ServiceChangedEvent` describing the change of one service.
     """
 
     def __init__(self, func=None):
-        super(ServiceWatchedEvent, self).__init__(name='ServiceWatchedEvent', func=func)
\ No newline at end of file
+        super(ServiceWatchedEvent, self).__init__(name='ServiceWatchedEvent', func=func)
+
+
+class ServiceChangedEvent:
+    """
+    Delta of a single service passed to the registered watch functions,
+    watchers patch the state of ``service_id`` only instead of reloading every service
+    """
+
+    def __init__(self, service_id: str):
+        self.service_id = service_id
+
+
+class ServiceAddedEvent(ServiceChangedEvent):
+    """a service node has been created, its instances follow with an :class:`InstancesChangedEvent`"""
+
+
+class ServiceRemovedEvent(ServiceChangedEvent):
+    """a service node has been removed together with all of its instances"""
+
+
+class InstancesChangedEvent(ServiceChangedEvent):
+    """
+    Instances of one service have been added, removed or changed.
+    ``instances`` is the complete current instance list of the service
+    """
+
+    def __init__(self, service_id: str, instances: 'List[ServiceInstance]',
+                 added: 'List[ServiceInstance]' = None, removed: 'List[ServiceInstance]' = None,
+                 changed: 'List[ServiceInstance]' = None):
+        super(InstancesChangedEvent, self).__init__(service_id)
+        self.instances = instances
+        self.added = added or list()
+        self.removed = removed or list()
+        self.changed = changed or list()
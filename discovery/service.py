@@ -45,5 +45,8 @@ class ServiceProvider:
     def register_service(self, service: 'ServiceInstance') -> None:
         pass
 
+    def unregister_service(self, service: 'ServiceInstance') -> None:
+        pass
+
     def stop(self) -> None:
         pass
@@ -71,11 +71,13 @@ class GWErrorCode(ErrorCode):
     Version_Num_Too_Low_Error = (201007, 'GateWay', '接口版本号太低')
     Throttle_Error = (201008, 'GateWay', '访问高峰期...')
     Discovery_Not_Setting_Error = (201009, 'GateWay', '服务发现没有配置')
+    Circuit_Open_Error = (201010, 'GateWay', '服务熔断中, 请稍后再试')
 
 
 class RPCErrorCode(ErrorCode):
     General_Error = (202001, 'RPC', '通用错误')
     Service_Not_Found_Error = (202002, 'RPC', '服务没有发现')
+    Server_Error = (202003, 'RPC', '服务端处理失败')
 
 
 class MseErrorCode(ErrorCode):
@@ -1,17 +1,37 @@
 # coding=utf-8
+import asyncio
+import functools
+import os
+import signal
+import socket
 import sys
+from typing import List, Optional
+
 import tornado
-from tornado.ioloop import IOLoop
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.netutil import bind_sockets
 from tornado.routing import AnyMatches, Rule
 from tornado.web import RequestHandler
 from exception.definition import CommonException
 from exception.error_code import CommonErrorCode
+from gateway import breaker
 from gateway.context import create_app_context
 from gateway.filters import LoadBalancerClientFilter, AuthGatewayFilter, RequestRateLimiterGatewayFilter, \
-    ForwardRoutingFilter
-from gateway.handler import FilteringWebHandler, RequestForwardingHandler
-from gateway.route.locator import RouteDefinitionRouteLocator, DiscoveryClientRouteDefinitionLocator
+    ForwardRoutingFilter, CircuitBreakerGatewayFilter, ResponseCacheGatewayFilter, RequestCoalescingGatewayFilter, \
+    ResponseCompressionGatewayFilter
+from gateway.health import HealthChecker
+from gateway.prefork import RouteTableServer, RouteTableSubscriber, route_socket_path
+from gateway.handler import FilteringWebHandler, RequestForwardingHandler, StreamingRequestForwardingHandler, \
+    InFlightRequests
+from gateway.retry import RetryPolicy
+from gateway.route.locator import RouteLocator, RouteDefinitionRouteLocator, DiscoveryClientRouteDefinitionLocator
 from logger.log import gen_log
+from mse.supervisor import WorkerSupervisor
+from rpc import pool, redispool
+
+# worker id of the prefork process which serves the route table
+ROUTE_PROCESS_ID = 0
 
 
 class Gateway:
@@ -45,13 +65,161 @@ class AppGateway(Gateway):
 
     def __init__(self):
         super(AppGateway, self).__init__()
+        self.upstream_config = self.app_context.get_upstream_config()
+        breaker_config = self.app_context.get_circuit_breaker_config()
+        breaker.configure(consecutive_errors=breaker_config.consecutive_errors,
+                          base_ejection_time=breaker_config.base_ejection_time,
+                          max_ejection_time=breaker_config.max_ejection_time,
+                          max_ejection_percent=breaker_config.max_ejection_percent)
+        # created by the process which serves the routes, a prefork supervisor starts no thread before forking
+        self.route_definition_locator = None  # type: Optional[DiscoveryClientRouteDefinitionLocator]
+        self.route_locator = None  # type: Optional[RouteDefinitionRouteLocator]
+        self.health_checker = None  # type: Optional[HealthChecker]
+        self.stopping = False
+
+    def configure_pools(self):
+        """new connection pools, a forked process must not share the connections of another one"""
+        upstream_config = self.upstream_config
+        pool.configure(max_connections_per_host=upstream_config.max_connections_per_host,
+                       idle_timeout=upstream_config.idle_timeout,
+                       connect_timeout=upstream_config.connect_timeout,
+                       request_timeout=upstream_config.request_timeout)
+        redispool.configure(max_connections_per_host=upstream_config.redis_max_connections,
+                            idle_timeout=upstream_config.idle_timeout,
+                            connect_timeout=upstream_config.connect_timeout)
+
+    def create_route_locator(self):
+        """starts watching discovery, the health checker is started on the IOLoop later"""
         self.route_definition_locator = DiscoveryClientRouteDefinitionLocator(self.app_context)
         self.route_locator = RouteDefinitionRouteLocator(route_def_locator=self.route_definition_locator)
-        filters = [AuthGatewayFilter(), LoadBalancerClientFilter(),
-                   RequestRateLimiterGatewayFilter(self.app_context), ForwardRoutingFilter()]
-        self.web_handler = FilteringWebHandler(filters=filters)
-        self.handlers = [Rule(AnyMatches(), RequestForwardingHandler,
-                              {'web_handler': self.web_handler, 'route_locator': self.route_locator})]
+        health_check_config = self.app_context.get_health_check_config()
+        if health_check_config.enabled:
+            self.health_checker = HealthChecker(self.route_locator, path=health_check_config.path,
+                                                interval=health_check_config.interval,
+                                                jitter=health_check_config.jitter,
+                                                timeout=health_check_config.timeout,
+                                                unhealthy_threshold=health_check_config.unhealthy_threshold,
+                                                healthy_threshold=health_check_config.healthy_threshold)
+
+    def create_web_handler(self) -> 'FilteringWebHandler':
+        """the filters take their pools when created, :meth:`configure_pools` must be called before"""
+        upstream_config = self.upstream_config
+        # cached responses skip load balancing, throttling and the upstream, cache misses are coalesced,
+        # cached and upstream responses are compressed on the way out
+        filters = [AuthGatewayFilter(), ResponseCompressionGatewayFilter(self.app_context),
+                   ResponseCacheGatewayFilter(self.app_context),
+                   RequestCoalescingGatewayFilter(self.app_context),
+                   LoadBalancerClientFilter(upstream_config.load_balancer),
+                   RequestRateLimiterGatewayFilter(self.app_context), CircuitBreakerGatewayFilter(self.app_context),
+                   ForwardRoutingFilter(self.create_retry_policy(), upstream_config.total_timeout)]
+        return FilteringWebHandler(filters=filters)
+
+    def create_handlers(self, route_locator: 'RouteLocator',
+                        in_flight: 'InFlightRequests' = None) -> List['Rule']:
+        upstream_config = self.upstream_config
+        web_handler = self.create_web_handler()
+        if upstream_config.streaming:
+            return [Rule(AnyMatches(), StreamingRequestForwardingHandler,
+                         {'web_handler': web_handler, 'route_locator': route_locator,
+                          'max_body_size': upstream_config.max_body_size,
+                          'max_buffer_size': upstream_config.max_buffer_size, 'in_flight': in_flight})]
+        return [Rule(AnyMatches(), RequestForwardingHandler,
+                     {'web_handler': web_handler, 'route_locator': route_locator, 'in_flight': in_flight})]
+
+    def create_retry_policy(self) -> 'RetryPolicy':
+        retry_config = self.app_context.get_retry_config()
+        return RetryPolicy(enabled=retry_config.enabled, retries=retry_config.retries, hedge=retry_config.hedge,
+                           budget_ratio=retry_config.budget_ratio,
+                           min_retries_per_second=retry_config.min_retries_per_second,
+                           hedge_percentile=retry_config.hedge_percentile,
+                           hedge_min_delay=retry_config.hedge_min_delay)
+
+    def start(self, argv):
+        prefork_config = self.app_context.get_prefork_config()
+        processes = prefork_config.processes or os.cpu_count()
+        if processes > 1:
+            self.start_prefork(argv, processes, prefork_config.shutdown_timeout)
+            return
+        self.configure_pools()
+        self.create_route_locator()
+        self.handlers = self.create_handlers(self.route_locator)
+        if self.health_checker is not None:
+            IOLoop.current().add_callback(self.health_checker.start)
+        super(AppGateway, self).start(argv)
+
+    def start_prefork(self, argv, processes: int, shutdown_timeout: float):
+        """
+        this process only supervises, it forks one process which watches discovery, probes the instances
+        and pushes the route table, and ``processes`` workers serving the port
+        """
+        self.set_argv(argv)
+        # bound here, a restarted route process serves the socket the workers know
+        route_server = RouteTableServer(route_socket_path(self.port))
+        # without SO_REUSEPORT the workers accept on the sockets bound here
+        sockets = None if hasattr(socket, 'SO_REUSEPORT') else bind_sockets(self.port)
+        drain_timeout = max(min(self.upstream_config.total_timeout, shutdown_timeout - 1), 0)
+        supervisor = WorkerSupervisor(functools.partial(self._run_process, route_server, sockets, drain_timeout),
+                                      processes + 1, shutdown_timeout=shutdown_timeout)
+        try:
+            supervisor.run()
+        finally:
+            route_server.close()
+
+    def _run_process(self, route_server: 'RouteTableServer', sockets: 'Optional[List[socket.socket]]',
+                     drain_timeout: float, worker_id: int):
+        # the loop of the supervisor is not shared with the forked processes
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.configure_pools()
+        if worker_id == ROUTE_PROCESS_ID:
+            self._run_routes(route_server)
+            return
+        route_server.socket.close()
+        self._run_worker(route_server.path, sockets, drain_timeout, worker_id)
+
+    def _run_routes(self, route_server: 'RouteTableServer'):
+        self.create_route_locator()
+        io_loop = IOLoop.current()
+        route_server.serve(self.route_locator)
+        if self.health_checker is not None:
+            io_loop.add_callback(self.health_checker.start)
+        supervisor_pid = os.getppid()
+        # a killed supervisor can not stop this process
+        PeriodicCallback(lambda: os.getppid() != supervisor_pid and io_loop.stop(), 1000).start()
+        signal.signal(signal.SIGTERM, lambda signum, frame: io_loop.add_callback_from_signal(io_loop.stop))
+        gen_log.info(f'gateway routes served on {route_server.path}')
+        io_loop.start()
+
+    def _run_worker(self, path: str, sockets: 'Optional[List[socket.socket]]', drain_timeout: float,
+                    worker_id: int):
+        io_loop = IOLoop.current()
+        route_locator = RouteTableSubscriber(path)
+        in_flight = InFlightRequests()
+        server = HTTPServer(tornado.web.Application(self.create_handlers(route_locator, in_flight)))
+        stop = functools.partial(self._stop_worker, server, route_locator, in_flight, drain_timeout)
+        route_locator.on_close = stop
+        io_loop.run_sync(route_locator.connect)
+        server.add_sockets(sockets or bind_sockets(self.port, reuse_port=True))
+        signal.signal(signal.SIGTERM, lambda signum, frame: io_loop.add_callback_from_signal(stop))
+        gen_log.info(f'gateway worker {worker_id} serving port {self.port}')
+        io_loop.start()
+
+    def _stop_worker(self, server: 'HTTPServer', route_locator: 'RouteTableSubscriber',
+                     in_flight: 'InFlightRequests', drain_timeout: float):
+        """stops accepting, the requests in flight have ``drain_timeout`` seconds to finish"""
+        if self.stopping:
+            return
+        self.stopping = True
+        server.stop()
+        route_locator.close()
+        IOLoop.current().add_callback(self._drain_worker, in_flight, drain_timeout)
+
+    @staticmethod
+    async def _drain_worker(in_flight: 'InFlightRequests', drain_timeout: float):
+        try:
+            await asyncio.wait_for(in_flight.wait_idle(), drain_timeout)
+        except asyncio.TimeoutError:
+            gen_log.warning(f'{in_flight.count} requests still in flight after {drain_timeout}s')
+        IOLoop.current().stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,203 @@
+# coding=utf-8
+"""
+Passive outlier detection per upstream instance and circuit breaker per service,
+both are fed with the outcome of the forwarded requests
+"""
+import collections
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from gateway.loadbalancer import instance_key
+
+
+class OutlierDetector:
+    """
+    Ejects an instance for a back-off period after ``consecutive_errors`` failed requests in a row,
+    the period grows with every ejection of the same instance up to ``max_ejection_time``.
+    No more than ``max_ejection_percent`` of the instances of a service are ejected at the same time
+    """
+
+    class _InstanceState:
+        def __init__(self):
+            self.consecutive_errors = 0
+            self.ejections = 0
+            self.ejected_until = 0.0
+
+    def __init__(self, consecutive_errors: int = 5, base_ejection_time: float = 30.0,
+                 max_ejection_time: float = 300.0, max_ejection_percent: int = 50):
+        self.consecutive_errors = consecutive_errors
+        self.base_ejection_time = base_ejection_time
+        self.max_ejection_time = max_ejection_time
+        self.max_ejection_percent = max_ejection_percent
+        self.instances = dict()  # type: Dict[str, OutlierDetector._InstanceState]
+        self._lock = threading.Lock()
+
+    def _get_state(self, route: 'Any') -> '_InstanceState':
+        key = instance_key(route)
+        state = self.instances.get(key)
+        if state is None:
+            state = self.instances.setdefault(key, self._InstanceState())
+        return state
+
+    def record(self, route: 'Any', success: bool):
+        with self._lock:
+            state = self._get_state(route)
+            if success:
+                state.consecutive_errors = 0
+                return
+            state.consecutive_errors += 1
+            now = time.monotonic()
+            if state.consecutive_errors >= self.consecutive_errors and state.ejected_until <= now:
+                state.ejections += 1
+                state.consecutive_errors = 0
+                ejection_time = min(self.base_ejection_time * state.ejections, self.max_ejection_time)
+                state.ejected_until = now + ejection_time
+
+    def is_ejected(self, route: 'Any', now: float = None) -> bool:
+        state = self.instances.get(instance_key(route))
+        return state is not None and state.ejected_until > (now or time.monotonic())
+
+    def filter_routes(self, routes: List['Any']) -> List['Any']:
+        """routes without the ejected instances, at most ``max_ejection_percent`` of them are dropped"""
+        if not self.instances or not routes:
+            return routes
+        now = time.monotonic()
+        healthy = [route for route in routes if not self.is_ejected(route, now)]
+        if len(healthy) == len(routes):
+            return routes
+        max_ejected = len(routes) * self.max_ejection_percent // 100
+        if len(routes) - len(healthy) > max_ejected:
+            # too many outliers, the upstream is more likely the problem than the instances
+            ejected = sorted((route for route in routes if self.is_ejected(route, now)),
+                             key=lambda route: self.instances[instance_key(route)].ejected_until)
+            healthy.extend(ejected[:len(ejected) - max_ejected])
+        return healthy
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        return {key: {'consecutive_errors': state.consecutive_errors, 'ejections': state.ejections,
+                      'ejected': state.ejected_until > now} for key, state in self.instances.items()}
+
+
+class CircuitBreaker:
+    """
+    Breaker of one service. Closed, it counts the outcomes of the last ``window`` seconds and opens
+    once at least ``minimum_requests`` were seen and the failure rate reaches ``failure_rate_threshold``.
+    Open, every request fails fast for ``open_timeout`` seconds. Half open, ``half_open_requests``
+    probes are let through, a failing probe opens the breaker again, succeeding probes close it
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_rate_threshold: float = 0.5, minimum_requests: int = 20, window: float = 10.0,
+                 open_timeout: float = 10.0, half_open_requests: int = 1):
+        self.failure_rate_threshold = failure_rate_threshold
+        self.minimum_requests = minimum_requests
+        self.window = window
+        self.open_timeout = open_timeout
+        self.half_open_requests = half_open_requests
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.half_open_in_flight = 0
+        self.half_open_successes = 0
+        # one bucket of [requests, failures] per second of the window
+        self.buckets = collections.deque()  # type: collections.deque
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.open_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self.half_open_in_flight = 0
+                self.half_open_successes = 0
+            if self.half_open_in_flight < self.half_open_requests:
+                self.half_open_in_flight += 1
+                return True
+            return False
+
+    def record(self, success: bool):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                self.half_open_in_flight = max(0, self.half_open_in_flight - 1)
+                if not success:
+                    self._open(now)
+                    return
+                self.half_open_successes += 1
+                if self.half_open_successes >= self.half_open_requests:
+                    self.state = self.CLOSED
+                    self.buckets.clear()
+                return
+            if self.state == self.OPEN:
+                # requests let through before the breaker opened
+                return
+            second = int(now)
+            while self.buckets and self.buckets[0][0] <= second - self.window:
+                self.buckets.popleft()
+            if not self.buckets or self.buckets[-1][0] != second:
+                self.buckets.append([second, 0, 0])
+            bucket = self.buckets[-1]
+            bucket[1] += 1
+            if not success:
+                bucket[2] += 1
+                requests = sum(bucket[1] for bucket in self.buckets)
+                failures = sum(bucket[2] for bucket in self.buckets)
+                if requests >= self.minimum_requests and failures >= requests * self.failure_rate_threshold:
+                    self._open(now)
+
+    def _open(self, now: float):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.buckets.clear()
+
+    def get_state(self) -> str:
+        return self.state
+
+
+class CircuitBreakerRegistry:
+    """one :class:`CircuitBreaker` per service, all created with the same options"""
+
+    def __init__(self, **breaker_options):
+        self.breaker_options = breaker_options
+        self.breakers = dict()  # type: Dict[str, CircuitBreaker]
+        self._lock = threading.Lock()
+
+    def get_breaker(self, service_name: str) -> 'CircuitBreaker':
+        breaker = self.breakers.get(service_name)
+        if breaker is None:
+            with self._lock:
+                breaker = self.breakers.get(service_name)
+                if breaker is None:
+                    breaker = CircuitBreaker(**self.breaker_options)
+                    self.breakers[service_name] = breaker
+        return breaker
+
+    def get_stats(self) -> Dict[str, str]:
+        return {service_name: breaker.get_state() for service_name, breaker in self.breakers.items()}
+
+
+_outlier_detector = None  # type: Optional[OutlierDetector]
+_detector_options = dict()  # type: Dict[str, Any]
+
+
+def configure(consecutive_errors: int = 5, base_ejection_time: float = 30.0,
+              max_ejection_time: float = 300.0, max_ejection_percent: int = 50) -> None:
+    """configure the shared outlier detector, must be called before the filters are created"""
+    global _outlier_detector
+    _detector_options.update(consecutive_errors=consecutive_errors, base_ejection_time=base_ejection_time,
+                             max_ejection_time=max_ejection_time, max_ejection_percent=max_ejection_percent)
+    _outlier_detector = None
+
+
+def get_outlier_detector() -> 'OutlierDetector':
+    """:return: the process wide detector shared by the load balancer and the circuit breaker filter"""
+    global _outlier_detector
+    if _outlier_detector is None:
+        _outlier_detector = OutlierDetector(**_detector_options)
+    return _outlier_detector
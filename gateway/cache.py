@@ -0,0 +1,178 @@
+# coding=utf-8
+"""
+In-memory cache of upstream responses, bounded by the bytes of the cached bodies
+"""
+import collections
+import hashlib
+import threading
+import time
+import urllib.parse
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from tornado.httputil import HTTPHeaders
+
+from gateway.web import ServerWebExchange, MICRO_SERVICE_NAME, MICRO_SERVICE_VERSION, REQUEST_METHOD_NAME
+
+# route metadata keys, set when the instance is registered
+CACHE_TTL_METADATA = 'cache_ttl'
+CACHE_STALE_METADATA = 'cache_stale'
+# comma separated request headers the response depends on, part of the cache and coalescing keys
+CACHE_HEADERS_METADATA = 'cache_headers'
+
+CACHE_STATUS_HEADER = 'X-Cache'
+
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    """``Cache-Control`` directives, lower case names mapped to their value or None"""
+    directives = dict()
+    for directive in (value or '').split(','):
+        name, _, argument = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def normalize_query(query: str) -> str:
+    """query string with sorted arguments, so the order of the arguments does not split the cache"""
+    return urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(query or '', keep_blank_values=True)))
+
+
+def get_key_headers(route: 'Any', key_headers: List[str]) -> List[str]:
+    """lower case ``key_headers`` and the ``cache_headers`` of the route"""
+    metadata = getattr(route, 'metadata', None) or dict()
+    return key_headers + [name.strip().lower() for name in metadata.get(CACHE_HEADERS_METADATA, '').split(',')
+                          if name.strip()]
+
+
+def get_request_key(exchange: 'ServerWebExchange', key_headers: List[str], body: bytes = None) -> str:
+    """service, version, method, sorted query, the ``key_headers`` and a digest of ``body`` of the request"""
+    request = exchange.get_request()
+    key = f'{exchange.get_attributes(MICRO_SERVICE_NAME)}:{exchange.get_attributes(MICRO_SERVICE_VERSION)}:' \
+          f'{exchange.get_attributes(REQUEST_METHOD_NAME)}?{normalize_query(request.get_query())}'
+    if key_headers:
+        headers = request.get_origin_header()
+        key += '|' + '|'.join(headers.get(name, '') for name in key_headers)
+    if body:
+        key += '|' + hashlib.md5(body).hexdigest()
+    return key
+
+
+def body_size(body: Union[str, bytes, Any]) -> int:
+    if isinstance(body, (str, bytes)):
+        return len(body)
+    return len(str(body))
+
+
+class CacheEntry:
+
+    def __init__(self, status_code: int, reason: Optional[str], headers: List[Tuple[str, str]],
+                 body: Union[str, bytes, Any], ttl: float, stale: float):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.size = body_size(body) + sum(len(name) + len(value) for name, value in headers)
+        self.created = time.monotonic()
+        self.expires = self.created + ttl
+        # a stale entry is still served while it is refreshed in the background
+        self.stale_until = self.expires + stale
+
+    def is_fresh(self, now: float = None) -> bool:
+        return (now or time.monotonic()) < self.expires
+
+    def is_usable(self, now: float = None) -> bool:
+        return (now or time.monotonic()) < self.stale_until
+
+    def get_age(self) -> int:
+        return int(time.monotonic() - self.created)
+
+
+class ResponseCache:
+    """
+    LRU of :class:`CacheEntry` holding at most ``max_size`` bytes, entries larger than ``max_entry_size``
+    are not cached. Expired entries are dropped when they are looked up or evicted
+    """
+
+    def __init__(self, max_size: int = 64 * 1024 * 1024, max_entry_size: int = 1024 * 1024):
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.entries = collections.OrderedDict()  # type: collections.OrderedDict[str, CacheEntry]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional['CacheEntry']:
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if not entry.is_usable():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: 'CacheEntry') -> bool:
+        if entry.size > self.max_entry_size:
+            return False
+        with self._lock:
+            self._remove(key)
+            self.entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_size and self.entries:
+                self._remove(next(iter(self.entries)))
+        return True
+
+    def remove(self, key: str):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def get_stats(self) -> Dict[str, int]:
+        return {'entries': len(self.entries), 'size': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+def get_response_ttl(headers: 'HTTPHeaders', ttl: float, stale: float,
+                     key_headers: List[str]) -> Optional[Tuple[float, float]]:
+    """
+    :return: ttl and stale-while-revalidate seconds of an upstream response, ``max-age``/``s-maxage`` and
+             ``stale-while-revalidate`` of its ``Cache-Control`` win over the route settings,
+             None when the response must not be cached
+    """
+    if 'Set-Cookie' in headers:
+        return None
+    if headers.get('Content-Encoding', 'identity').strip().lower() != 'identity':
+        # asked for with Accept-Encoding: identity, an encoded body could reach a client which can not decode it
+        return None
+    vary = [name.strip().lower() for name in headers.get('Vary', '').split(',') if name.strip()]
+    # every cached body is unencoded, Accept-Encoding does not split the cache
+    if any(name not in key_headers and name != 'accept-encoding' for name in vary):
+        # the response depends on headers which are not part of the key
+        return None
+    directives = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-store' in directives or 'no-cache' in directives or 'private' in directives:
+        return None
+    max_age = directives.get('s-maxage') or directives.get('max-age')
+    if max_age is not None:
+        try:
+            ttl = float(max_age)
+        except ValueError:
+            return None
+    if directives.get('stale-while-revalidate') is not None:
+        try:
+            stale = float(directives['stale-while-revalidate'])
+        except ValueError:
+            pass
+    if 'must-revalidate' in directives or 'proxy-revalidate' in directives:
+        stale = 0
+    if ttl <= 0:
+        return None
+    return ttl, stale
@@ -0,0 +1,241 @@
+# coding=utf-8
+"""
+Compression of the responses sent to the client, negotiated from ``Accept-Encoding``.
+brotli and zstd are used when their packages are installed, gzip is always available
+"""
+import time
+import zlib
+from typing import Awaitable, Dict, List, Optional, Union
+
+from tornado.escape import json_encode, utf8
+from tornado.httputil import HTTPHeaders
+
+from gateway.web import ServerHttpResponse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# content types worth compressing besides text/*
+COMPRESSIBLE_TYPES = frozenset(['application/json', 'application/javascript', 'application/xml',
+                                'application/x-www-form-urlencoded', 'image/svg+xml'])
+
+
+class Encoder:
+    """incremental compressor of one response body"""
+
+    def compress(self, chunk: bytes) -> bytes:
+        """:return: compressed ``chunk``, flushed so the client can decode everything sent so far"""
+        raise NotImplementedError()
+
+    def finish(self) -> bytes:
+        raise NotImplementedError()
+
+
+class GzipEncoder(Encoder):
+
+    def __init__(self, level: int = 6):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, chunk: bytes) -> bytes:
+        return self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliEncoder(Encoder):
+
+    def __init__(self, level: int = 6):
+        # brotli quality runs from 0 to 11, gzip levels from 1 to 9
+        self.compressor = brotli.Compressor(quality=min(11, level))
+
+    def compress(self, chunk: bytes) -> bytes:
+        return self.compressor.process(chunk) + self.compressor.flush()
+
+    def finish(self) -> bytes:
+        return self.compressor.finish()
+
+
+class ZstdEncoder(Encoder):
+
+    def __init__(self, level: int = 6):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, chunk: bytes) -> bytes:
+        return self.compressor.compress(chunk) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush()
+
+
+ENCODERS = {'gzip': GzipEncoder}
+if brotli is not None:
+    ENCODERS['br'] = BrotliEncoder
+if zstandard is not None:
+    ENCODERS['zstd'] = ZstdEncoder
+
+
+def negotiate_encoding(accept_encoding: Optional[str], encodings: List[str]) -> Optional[str]:
+    """
+    :return: the first of ``encodings`` the client accepts with the highest quality,
+             None when identity should be sent
+    """
+    qualities = dict()  # type: Dict[str, float]
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name] = quality
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        if encoding not in ENCODERS:
+            continue
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def is_compressible(content_type: Optional[str]) -> bool:
+    if not content_type:
+        # rpc responses are sent as tornado's default text/html
+        return True
+    content_type = content_type.split(';')[0].strip().lower()
+    return content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES \
+        or content_type.endswith('+json') or content_type.endswith('+xml')
+
+
+class CpuBudget:
+    """
+    CPU used by the process over the last ``interval`` seconds, as a share of one core.
+    The IOLoop runs on one core, above ``max_usage`` compression is skipped
+    """
+
+    def __init__(self, max_usage: float = 0.8, interval: float = 1.0):
+        self.max_usage = max_usage
+        self.interval = interval
+        self.usage = 0.0
+        self.last_wall = time.monotonic()
+        self.last_cpu = time.process_time()
+
+    def saturated(self) -> bool:
+        now = time.monotonic()
+        if now - self.last_wall >= self.interval:
+            cpu = time.process_time()
+            self.usage = (cpu - self.last_cpu) / (now - self.last_wall)
+            self.last_wall, self.last_cpu = now, cpu
+        return self.usage > self.max_usage
+
+
+class CompressingServerHttpResponse(ServerHttpResponse):
+    """
+    Passes every call on to ``response``, compressing the body with ``encoding``. Written chunks
+    are compressed as they stream, a body set with ``set_response_body`` is compressed by ``finish``.
+    Bodies with a ``Content-Encoding``, of a type not worth it or known to be smaller than ``min_size``
+    are sent unchanged
+    """
+
+    def __init__(self, response: 'ServerHttpResponse', encoding: str, min_size: int = 1024, level: int = 6):
+        self.response = response
+        self.encoding = encoding
+        self.min_size = min_size
+        self.level = level
+        self.encoder = None  # type: Optional[Encoder]
+        self.decided = False
+        self.response_body = None
+
+    def _should_compress(self, size: Optional[int]) -> bool:
+        headers = self.response.get_headers()
+        if 'Content-Encoding' in headers or not is_compressible(headers.get('Content-Type')):
+            return False
+        if self.response.get_status_code() in (204, 304):
+            return False
+        if size is None and 'Content-Length' in headers:
+            try:
+                size = int(headers['Content-Length'])
+            except ValueError:
+                pass
+        return size is None or size >= self.min_size
+
+    def _start(self, size: Optional[int]) -> bool:
+        """decides about the encoding once, before the first byte of the body is sent"""
+        if not self.decided:
+            self.decided = True
+            if self._should_compress(size):
+                self.encoder = ENCODERS[self.encoding](self.level)
+                self.response.clear_header('Content-Length')
+                self.response.set_header('Content-Encoding', self.encoding)
+                self.response.add_header('Vary', 'Accept-Encoding')
+        return self.encoder is not None
+
+    def get_status_code(self) -> int:
+        return self.response.get_status_code()
+
+    def set_status_code(self, status_code: int, reason: str = None):
+        self.response.set_status_code(status_code, reason)
+
+    def get_cookies(self):
+        return self.response.get_cookies()
+
+    def add_cookies(self, key, cookie):
+        self.response.add_cookies(key, cookie)
+
+    def get_response_body(self):
+        return self.response.get_response_body()
+
+    def set_response_body(self, body: Union[str, bytes, dict]):
+        self.response_body = body
+        self.response.set_response_body(body)
+
+    def set_header(self, name: str, value: str):
+        self.response.set_header(name, value)
+
+    def add_header(self, name: str, value: str):
+        self.response.add_header(name, value)
+
+    def clear_header(self, name: str):
+        self.response.clear_header(name)
+
+    def get_headers(self) -> 'HTTPHeaders':
+        return self.response.get_headers()
+
+    def write(self, chunk: bytes) -> Awaitable[None]:
+        if self._start(None):
+            chunk = self.encoder.compress(chunk)
+        return self.response.write(chunk)
+
+    def is_streaming(self) -> bool:
+        return self.response.is_streaming()
+
+    async def finish(self):
+        """compresses the buffered body, or sends the end of the compressed stream"""
+        if self.response.is_streaming():
+            if self.encoder is not None:
+                await self.response.write(self.encoder.finish())
+            return
+        body = self.response_body
+        if body is None:
+            return
+        if isinstance(body, dict):
+            # what tornado would send for a dict
+            body = json_encode(body)
+            if 'Content-Type' not in self.response.get_headers():
+                self.response.set_header('Content-Type', 'application/json; charset=UTF-8')
+        body = utf8(body)
+        if self._start(len(body)):
+            self.response.set_response_body(self.encoder.compress(body) + self.encoder.finish())
@@ -8,7 +8,10 @@ import os
 import yaml
 
 from ctx.config import ENV_YAML_DIC, CURRENT_ENV, AbsConfigOption, \
-    create_app_config, create_discovery_config, create_redis_config
+    create_app_config, create_discovery_config, create_redis_config, create_upstream_config, \
+    create_circuit_breaker_config, create_health_check_config, \
+    create_retry_config, create_throttle_config, create_response_cache_config, \
+    create_coalescing_config, create_compression_config, create_prefork_config
 
 
 class ConfigOption(AbsConfigOption):
@@ -27,4 +30,13 @@ class ConfigOption(AbsConfigOption):
         self.app_config = create_app_config(app_config_info)
         self.discovery_config = create_discovery_config(app_config_info)
         self.redis_config = create_redis_config(app_config_info)
+        self.upstream_config = create_upstream_config(app_config_info)
+        self.circuit_breaker_config = create_circuit_breaker_config(app_config_info)
+        self.health_check_config = create_health_check_config(app_config_info)
+        self.retry_config = create_retry_config(app_config_info)
+        self.throttle_config = create_throttle_config(app_config_info)
+        self.response_cache_config = create_response_cache_config(app_config_info)
+        self.coalescing_config = create_coalescing_config(app_config_info)
+        self.compression_config = create_compression_config(app_config_info)
+        self.prefork_config = create_prefork_config(app_config_info)
 
@@ -28,6 +28,33 @@ class ApplicationContext(ConfApplicationContext):
     def get_redis_config(self) -> 'RedisConfig':
         return self.config_option.get_redis_config()
 
+    def get_upstream_config(self) -> 'UpstreamConfig':
+        return self.config_option.get_upstream_config()
+
+    def get_circuit_breaker_config(self) -> 'CircuitBreakerConfig':
+        return self.config_option.get_circuit_breaker_config()
+
+    def get_health_check_config(self) -> 'HealthCheckConfig':
+        return self.config_option.get_health_check_config()
+
+    def get_retry_config(self) -> 'RetryConfig':
+        return self.config_option.get_retry_config()
+
+    def get_throttle_config(self) -> 'ThrottleConfig':
+        return self.config_option.get_throttle_config()
+
+    def get_response_cache_config(self) -> 'ResponseCacheConfig':
+        return self.config_option.get_response_cache_config()
+
+    def get_coalescing_config(self) -> 'CoalescingConfig':
+        return self.config_option.get_coalescing_config()
+
+    def get_compression_config(self) -> 'CompressionConfig':
+        return self.config_option.get_compression_config()
+
+    def get_prefork_config(self) -> 'PreforkConfig':
+        return self.config_option.get_prefork_config()
+
 
 def create_app_context() -> 'ApplicationContext':
     return ApplicationContext()
@@ -0,0 +1,50 @@
+# coding=utf-8
+"""
+Per route timeouts and the deadline of a forwarded request
+"""
+import time
+from typing import Any, Optional
+
+# route metadata keys in seconds, set when the instance is registered
+CONNECT_TIMEOUT_METADATA = 'connect_timeout'
+REQUEST_TIMEOUT_METADATA = 'request_timeout'
+TIMEOUT_METADATA = 'timeout'
+
+# remaining milliseconds of the deadline, sent to http upstreams
+DEADLINE_HEADER = 'X-Request-Timeout-Ms'
+
+
+def get_route_timeout(route: 'Any', name: str, default: Optional[float] = None) -> Optional[float]:
+    """timeout ``name`` of the route metadata in seconds, ``default`` when absent or not a number"""
+    value = (getattr(route, 'metadata', None) or dict()).get(name)
+    if value is None:
+        return default
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return default
+    return value if value > 0 else default
+
+
+class Deadline:
+    """total time a request may spend upstream, started when it is created"""
+
+    def __init__(self, timeout: Optional[float]):
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout if timeout else None
+
+    def remaining(self) -> Optional[float]:
+        """:return: seconds left, never negative, None without deadline"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def cap(self, timeout: Optional[float]) -> Optional[float]:
+        """``timeout`` shortened to what is left of the deadline, a timeout of 0 would mean none"""
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return max(0.001, min(timeout, remaining) if timeout else remaining)
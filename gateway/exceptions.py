@@ -38,6 +38,13 @@ class ThrottleError(GWException):
         super(GWException, self).__init__(error_code)
 
 
+class CircuitOpenError(GWException):
+    def __init__(self, service_name=None):
+        super(CircuitOpenError, self).__init__(GWErrorCode.Circuit_Open_Error)
+        if service_name:
+            self.msg = '{} 服务熔断中, 请稍后再试'.format(service_name)
+
+
 class VersionNumTooTowError(GWException):
     def __init__(self, api_name=None):
         super(GWException, self).__init__(error_code=GWErrorCode.Version_Num_Too_Low_Error)
@@ -1,11 +1,51 @@
+import inspect
+
 from gateway.web import ServerWebExchange
 
 
 class GatewayFilter:
-    def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
+    async def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
         raise NotImplementedError()
 
 
 class GatewayFilterChain:
-    def filter(self, exchange: 'ServerWebExchange'):
+    async def filter(self, exchange: 'ServerWebExchange'):
         raise NotImplementedError()
+
+
+class _DeferredGatewayFilterChain(GatewayFilterChain):
+    """
+    Chain handed to a synchronous filter, the sync filter still calls ``chain.filter(exchange)``
+    as before, the call is only recorded here and the real chain is awaited once the filter returns
+    """
+
+    def __init__(self, chain: 'GatewayFilterChain'):
+        self.chain = chain
+        self.exchange = None
+        self.called = False
+
+    def filter(self, exchange: 'ServerWebExchange'):
+        self.called = True
+        self.exchange = exchange
+
+
+class SyncGatewayFilterAdapter(GatewayFilter):
+    """
+    Adapter for filters written against the old synchronous api,
+    ``def filter(self, exchange, chain)`` runs on the IOLoop and must not block
+    """
+
+    def __init__(self, gateway_filter):
+        self.gateway_filter = gateway_filter
+
+    async def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
+        deferred_chain = _DeferredGatewayFilterChain(chain)
+        self.gateway_filter.filter(exchange, deferred_chain)
+        if deferred_chain.called:
+            await chain.filter(deferred_chain.exchange)
+
+
+def adapt_filter(gateway_filter) -> 'GatewayFilter':
+    if inspect.iscoroutinefunction(gateway_filter.filter):
+        return gateway_filter
+    return SyncGatewayFilterAdapter(gateway_filter)
@@ -1,89 +1,312 @@
 import asyncio
-import base64
+import functools
 import gzip
+import inspect
 import json
+import math
+import time
 import urllib
 import uuid
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Optional, Callable, Awaitable, List, Any, Dict, Tuple
 
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPClientError
-from tornado.httputil import HTTPHeaders
+from tornado.concurrent import run_on_executor
+from tornado.httpclient import HTTPRequest, HTTPClientError, HTTPResponse
+from tornado.httputil import HTTPHeaders, ResponseStartLine, parse_response_start_line
+from tornado.simple_httpclient import HTTPTimeoutError
 from tornado.web import HTTPError
 
-from gateway.exceptions import RpcTypeError, ThrottleError, ApiNotFoundException
-from gateway.loadbalancer import RandomRule
+from gateway import breaker
+from gateway.breaker import CircuitBreakerRegistry
+from gateway.cache import ResponseCache, CacheEntry, parse_cache_control, get_response_ttl, get_key_headers, \
+    get_request_key, CACHE_TTL_METADATA, CACHE_STALE_METADATA, CACHE_STATUS_HEADER
+from gateway.compression import CpuBudget, CompressingServerHttpResponse, negotiate_encoding
+from gateway.deadline import Deadline, get_route_timeout, TIMEOUT_METADATA, CONNECT_TIMEOUT_METADATA, \
+    REQUEST_TIMEOUT_METADATA, DEADLINE_HEADER
+from gateway.exceptions import RpcTypeError, ThrottleError, ApiNotFoundException, CircuitOpenError, GWException, \
+    ApiTimeoutError
+from gateway.loadbalancer import LoadBalancerRuleSelector, get_load_balancer_stats, HASH_KEY_METADATA, instance_key
+from gateway.retry import RetryPolicy, RetryBudget, IDEMPOTENT_METHODS, RETRYABLE_STATUS, IDEMPOTENT_METADATA
 from gateway.filter.definition import GatewayFilter, GatewayFilterChain
-from gateway.route.definition import RpcType
-from gateway.throttle.throttling import TokenBucketThrottle
+from gateway.route.definition import RpcType, Route
+from gateway.throttle.throttling import TokenBucketThrottle, HybridTokenBucketThrottle, BaseThrottle, \
+    SlidingWindowThrottle, GCRAThrottle, THROTTLES, THROTTLE_METADATA, THROTTLE_RATE_METADATA, THROTTLE_BURST_METADATA
 from gateway.web import GATEWAY_REQUEST_ROUTE_ATTR, REQUEST_METHOD_NAME, GATEWAY_ROUTE_ATTR, MICRO_SERVICE_NAME, \
-    ServerWebExchange
-from rpc.redis import RedisClient
+    ServerWebExchange, ServerHttpResponse, RequestBodyStream, HOP_BY_HOP_HEADERS, REQUEST_DEADLINE_ATTR, \
+    RecordingServerHttpResponse, UPSTREAM_IDENTITY_ATTR
+from logger.log import gen_log
+from rpc import pool, redispool, reply, stream
+from rpc.message import encode_message
 
 
 class ForwardRoutingFilter(GatewayFilter):
 
-    def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
+    def __init__(self, retry_policy: 'RetryPolicy' = None, total_timeout: float = None):
+        self.http_routing_filter = HttpRoutingFilter(retry_policy)
+        self.rpc_routing_filter = RpcRoutingFilter()
+        self.load_balancer_stats = get_load_balancer_stats()
+        # default of the ``timeout`` route metadata, whole time including retries and hedged requests
+        self.total_timeout = total_timeout
+
+    async def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
         route = exchange.get_attributes(GATEWAY_REQUEST_ROUTE_ATTR)
-        if route.rpc_type == RpcType.HTTP:
-            http_routing_filter = HttpRoutingFilter()
-            http_routing_filter.filter(exchange=exchange, chain=chain)
-            chain.filter(exchange)
-        elif route.rpc_type == RpcType.REDIS_RPC:
-            rpc_route_filter = RpcRoutingFilter()
-            rpc_route_filter.filter(exchange=exchange, chain=chain)
-            chain.filter(exchange)
+        if route.route_type == RpcType.HTTP:
+            routing_filter = self.http_routing_filter
+        elif route.route_type == RpcType.REDIS_RPC:
+            routing_filter = self.rpc_routing_filter
         else:
             raise RpcTypeError()
 
+        deadline = Deadline(get_route_timeout(route, TIMEOUT_METADATA, self.total_timeout))
+        exchange.set_attributes(REQUEST_DEADLINE_ATTR, deadline)
+        # in-flight count and latency of the instance feed the load balancer rules
+        self.load_balancer_stats.on_start(route)
+        start = time.monotonic()
+        success = False
+        try:
+            if routing_filter is self.http_routing_filter and exchange.get_request().is_streaming():
+                # a download or a long poll may outlive the deadline, the connection pool applies it
+                # until the response headers and a read timeout between the chunks after them
+                await routing_filter.filter(exchange=exchange, chain=chain)
+            else:
+                try:
+                    await asyncio.wait_for(routing_filter.filter(exchange=exchange, chain=chain),
+                                           deadline.remaining())
+                except asyncio.TimeoutError:
+                    raise ApiTimeoutError(f'{exchange.get_attributes(MICRO_SERVICE_NAME)} 接口请求超时')
+            success = (exchange.get_response().get_status_code() or 200) < 500
+        finally:
+            self.load_balancer_stats.on_complete(route, time.monotonic() - start, success)
+
 
 class HttpRoutingFilter(GatewayFilter):
 
-    def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
-        asyncio.run(self.http_request(exchange, chain))
+    def __init__(self, retry_policy: 'RetryPolicy' = None):
+        self.connection_pool = pool.get_connection_pool()
+        self.retry_policy = retry_policy or RetryPolicy(enabled=False)
+        # picks the instance of a retry or a hedged request
+        self.load_balancer_rule = LoadBalancerRuleSelector()
+        self.load_balancer_stats = get_load_balancer_stats()
+        self.outlier_detector = breaker.get_outlier_detector()
+
+    async def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
+        await self.http_request(exchange, chain)
 
     async def http_request(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
 
         try:
             route = exchange.get_attributes(GATEWAY_REQUEST_ROUTE_ATTR)
             method_name = exchange.get_attributes(REQUEST_METHOD_NAME)
-            host = route.uri
             request = exchange.get_request()
             query = request.get_query()
             origin_header = request.get_origin_header().get_all()
             header = HTTPHeaders()
             for key, value in origin_header:
-                if key != 'Host' and key != 'If Modified Since ':
+                if key != 'Host' and key != 'If Modified Since ' and key not in HOP_BY_HOP_HEADERS:
                     header.add(key, value)
-            real_request_url = f'http://{host}/{method_name}?{query}'
-            http_client = AsyncHTTPClient()
-            method = exchange.get_request().get_method_name()
-            http_request = HTTPRequest(url=real_request_url, method=method.upper())
-            response = await http_client.fetch(request=http_request, headers=header)
-            exchange.get_response().set_response_body(str(response.body))
-            chain.filter(exchange)
+            if exchange.get_attributes(UPSTREAM_IDENTITY_ATTR):
+                header['Accept-Encoding'] = 'identity'
+            method = exchange.get_request().get_method_name().upper()
+            deadline = exchange.get_attributes(REQUEST_DEADLINE_ATTR) or Deadline(None)
+            body, body_producer = None, None
+            if method in ('POST', 'PUT', 'PATCH'):
+                if request.is_streaming():
+                    body_producer = functools.partial(self.produce_body, request.get_body_stream())
+                else:
+                    body = request.get_body()
+
+            def create_request(target: 'Route', **kwargs) -> 'HTTPRequest':
+                if deadline.expired():
+                    raise HTTPTimeoutError('Deadline exceeded')
+                request_timeout = deadline.cap(get_route_timeout(target, REQUEST_TIMEOUT_METADATA,
+                                                                 self.connection_pool.request_timeout))
+                if request_timeout is not None:
+                    header[DEADLINE_HEADER] = str(int(request_timeout * 1000))
+                return HTTPRequest(url=f'http://{target.uri}/{method_name}?{query}', method=method,
+                                   headers=HTTPHeaders(header), body=body,
+                                   connect_timeout=get_route_timeout(target, CONNECT_TIMEOUT_METADATA),
+                                   request_timeout=request_timeout, **kwargs)
+
+            if request.is_streaming():
+                writer = UpstreamResponseWriter(exchange.get_response())
+                http_request = create_request(route, body_producer=body_producer,
+                                              header_callback=writer.header_callback,
+                                              streaming_callback=writer.streaming_callback)
+                read_timeout = get_route_timeout(route, REQUEST_TIMEOUT_METADATA, self.connection_pool.request_timeout)
+                await self.connection_pool.fetch(http_request, raise_error=False, read_timeout=read_timeout)
+            else:
+
+                response = await self.fetch_with_retries(exchange, route, method, create_request)
+                set_upstream_headers(exchange.get_response(), response.code, response.reason, response.headers)
+                if has_response_body(method, response.code):
+                    exchange.get_response().set_response_body(response.body)
+            await chain.filter(exchange)
         except Exception as ex:
-            if isinstance(ex, HTTPClientError):
+            if isinstance(ex, (GWException, HTTPError)):
+                raise ex
+            elif isinstance(ex, HTTPTimeoutError):
+                raise ApiTimeoutError(f'{exchange.get_attributes(MICRO_SERVICE_NAME)} 接口请求超时')
+            elif isinstance(ex, HTTPClientError):
                 raise HTTPError(code=ex.code, reason=ex.__str__())
             else:
                 raise HTTPError(code=500, reason=ex.__str__())
 
+    async def fetch_with_retries(self, exchange: 'ServerWebExchange', route: 'Route', method: str,
+                                 create_request: 'Callable[[Route], HTTPRequest]') -> 'HTTPResponse':
+        """
+        sends the request to ``route``, idempotent requests are hedged and retried on other
+        instances as long as the route policy and the retry budget of the service allow it
+        """
+        service_name = exchange.get_attributes(MICRO_SERVICE_NAME)
+        policy = self.retry_policy
+        if not policy.enabled or method not in IDEMPOTENT_METHODS:
+            return await self.attempt(service_name, route, create_request, primary=route)
+
+        budget = policy.get_budget(service_name)
+        budget.deposit()
+        retries = policy.get_retries(route)
+        hedge_delay = policy.get_hedge_delay(service_name) if policy.is_hedged(route) else None
+        tried = [route]
+        target = route
+        while True:
+            try:
+                if hedge_delay is None:
+                    response = await self.attempt(service_name, target, create_request, primary=route)
+                else:
+                    response = await self.hedged_attempt(exchange, service_name, target, create_request,
+                                                          hedge_delay, tried, budget, primary=route)
+                if response.code not in RETRYABLE_STATUS or retries <= 0 or not budget.withdraw():
+                    return response
+            except (HTTPClientError, IOError):
+                if retries <= 0 or not budget.withdraw():
+                    raise
+            retries -= 1
+            target = self.choose_other(exchange, tried) or target
+            tried.append(target)
+
+    async def hedged_attempt(self, exchange: 'ServerWebExchange', service_name: str, target: 'Route',
+                             create_request: 'Callable[[Route], HTTPRequest]', hedge_delay: float,
+                             tried: List['Route'], budget: 'RetryBudget', primary: 'Route') -> 'HTTPResponse':
+        """waits ``hedge_delay`` for ``target``, then races a second instance and cancels the loser"""
+        first = asyncio.ensure_future(self.attempt(service_name, target, create_request, primary))
+        pending = {first}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=hedge_delay)
+            if done:
+                return first.result()
+            other = self.choose_other(exchange, tried)
+            if other is None or not budget.withdraw():
+                return await first
+            tried.append(other)
+            pending.add(asyncio.ensure_future(self.attempt(service_name, other, create_request, primary)))
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and task.result().code not in RETRYABLE_STATUS:
+                        return task.result()
+                if not pending:
+                    # both have failed, report the first attempt
+                    return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def attempt(self, service_name: str, target: 'Route', create_request: 'Callable[[Route], HTTPRequest]',
+                      primary: 'Route') -> 'HTTPResponse':
+        # the first instance is accounted by ForwardRoutingFilter, retries and hedges here
+        if target is not primary:
+            self.load_balancer_stats.on_start(target)
+        start = time.monotonic()
+        success = False
+        try:
+            response = await self.connection_pool.fetch(create_request(target), raise_error=False)
+            success = response.code < 500
+            return response
+        finally:
+            latency = time.monotonic() - start
+            if success:
+                self.retry_policy.get_latency_tracker(service_name).record(latency)
+            if target is not primary:
+                self.load_balancer_stats.on_complete(target, latency, success)
+
+    def choose_other(self, exchange: 'ServerWebExchange', tried: List['Route']) -> Optional['Route']:
+        tried_keys = set(map(instance_key, tried))
+        routes = [route for route in exchange.get_attributes(GATEWAY_ROUTE_ATTR) or ()
+                  if instance_key(route) not in tried_keys]
+        return self.load_balancer_rule.choose(self.outlier_detector.filter_routes(routes))
+
+    @staticmethod
+    async def produce_body(body_stream: 'RequestBodyStream', write: 'Callable[[bytes], Awaitable[None]]'):
+        async for chunk in body_stream:
+            await write(chunk)
+
+
+def set_upstream_headers(response: 'ServerHttpResponse', code: int, reason: str, headers: 'HTTPHeaders'):
+    """pass upstream status and end-to-end headers through unchanged"""
+    response.set_status_code(code, reason)
+    header_names = set()
+    for key, value in headers.get_all():
+        if key in HOP_BY_HOP_HEADERS:
+            continue
+        if key in header_names:
+            response.add_header(key, value)
+        else:
+            response.set_header(key, value)
+            header_names.add(key)
+
+
+def has_response_body(method: str, code: int) -> bool:
+    """responses to HEAD and 1xx, 204 and 304 responses end with their headers, tornado refuses a body"""
+    return method != 'HEAD' and code not in (204, 304) and not 100 <= code < 200
+
+
+class UpstreamResponseWriter:
+    """
+    Relay upstream response to the client while it arrives,
+    used as header_callback and streaming_callback of the upstream HTTPRequest
+    """
+
+    def __init__(self, response: 'ServerHttpResponse'):
+        self.response = response
+        self.start_line = None  # type: Optional[ResponseStartLine]
+        self.headers = HTTPHeaders()
+
+    def header_callback(self, line: str):
+        if line.startswith('HTTP/'):
+            self.start_line = parse_response_start_line(line.strip())
+            self.headers = HTTPHeaders()
+        elif line.strip():
+            self.headers.parse_line(line)
+        elif self.start_line is not None and self.start_line.code >= 200:
+            # skip interim 1xx responses
+            set_upstream_headers(self.response, self.start_line.code, self.start_line.reason, self.headers)
+
+    def streaming_callback(self, chunk: bytes) -> 'Awaitable[None]':
+        # flush future is awaited before the next chunk is read from the upstream
+        return self.response.write(chunk)
+
 
 class RpcRoutingFilter(GatewayFilter):
 
-    def __init__(self):
-        self.redis_cache = None
+    def __init__(self, request_timeout: float = 15):
+        # default of the ``request_timeout`` route metadata
+        self.request_timeout = request_timeout
 
-    def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
+    async def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
+        # rpc params are built from the whole body, a streamed body is read up here
+        await exchange.get_request().read_body()
+        deadline = exchange.get_attributes(REQUEST_DEADLINE_ATTR) or Deadline(None)
         route = exchange.get_attributes(GATEWAY_REQUEST_ROUTE_ATTR)
-        host = route.uri
+        timeout = deadline.cap(get_route_timeout(route, REQUEST_TIMEOUT_METADATA, self.request_timeout))
+        response = await self.rpc_request(exchange, timeout)
+        exchange.get_response().set_response_body(response)
+        await chain.filter(exchange)
 
-        if self.redis_cache:
-            redis = RedisClient(host=host, password=route.password, username=route.user)
-            self.redis_cache[host] = redis
-        else:
-            redis = self.redis_cache.get(host)
-            if redis is None:
-                redis = RedisClient(host=host, password=route.password, username=route.user)
-                self.redis_cache[host] = redis
+    async def rpc_request(self, exchange: 'ServerWebExchange', timeout: float):
+        route = exchange.get_attributes(GATEWAY_REQUEST_ROUTE_ATTR)
+        # connections of the redis host are pooled and shared with rpc.redis
+        redis = redispool.get_async_redis(route.uri, password=route.password, username=route.user)
+        replies = reply.get_async_reply_channel(route.uri, password=route.password, username=route.user)
 
         service_name = exchange.get_attributes(MICRO_SERVICE_NAME)
         method_name = exchange.get_attributes(REQUEST_METHOD_NAME)
@@ -108,9 +331,8 @@ class RpcRoutingFilter(GatewayFilter):
             for key in xml_dict:
                 arg_dic[key.lower()] = xml_dict[key]
 
+        # file bodies travel as raw parts of the rpc envelope
         for key in request.get_files():
-            for file in request.get_files()[key]:
-                file['body'] = base64.b64encode(file['body']).decode('utf-8')
             arg_dic[key.lower()] = request.get_files()[key]
 
         query = request.get_query()
@@ -124,57 +346,391 @@ class RpcRoutingFilter(GatewayFilter):
         header_param = request.get_header()
 
         if header_param:
-            for key, value in header_param:
+            for key, value in header_param.items():
                 arg_dic[key.lower()] = urllib.parse.unquote(value)
 
-        request = {'id': str(uuid.uuid4()),
+        request_id = str(uuid.uuid4())
+        request = {'id': request_id,
                    'queue_name': queue_name,
                    'method': method_name,
-                   'params': arg_dic}
-
-        redis.lpush(queue_name, json.dumps(request))
-        redis.expire(queue_name, 15)
-        channel, response = redis.brpop(id, 15)  # 如果超时会抛异常
-        return response.decode('utf-8')
+                   'params': arg_dic,
+                   # epoch seconds after which the caller has given up, the server may drop the request
+                   'deadline': time.time() + timeout,
+                   # reply list shared by every request of this process
+                   'reply_to': replies.key}
+
+        message = encode_message(request)
+        if route.metadata.get(stream.TRANSPORT_METADATA) == stream.TRANSPORT_STREAM:
+            # the server reads requests from a stream in batches, trimmed to about stream_max_len entries
+            commands = [stream.xadd_command(stream.stream_key(service_name, version), message,
+                                            stream.get_max_len(route))]
+        else:
+            commands = [('LPUSH', queue_name, message), ('EXPIRE', queue_name, 15)]
+        try:
+            response = reply.get_reply_result(await replies.request(
+                request_id, lambda: redis.pipeline(commands), timeout))
+        except asyncio.TimeoutError:
+            raise ApiTimeoutError(f'{service_name} 接口请求超时')
+        return response.decode('utf-8') if isinstance(response, bytes) else response
 
 
 class LoadBalancerClientFilter(GatewayFilter):
 
-    def __init__(self):
-        self.load_balancer_rule = RandomRule()
-
-    def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
-        route = self.load_balancer_rule.choose(exchange.get_attributes(GATEWAY_ROUTE_ATTR))
+    def __init__(self, default_rule: str = 'random'):
+        # rule is picked per route from its ``load_balancer`` metadata
+        self.load_balancer_rule = LoadBalancerRuleSelector(default_rule)
+        self.outlier_detector = breaker.get_outlier_detector()
+
+    @staticmethod
+    def get_hash_key(exchange: 'ServerWebExchange', routes: List['Route']) -> Optional[str]:
+        """hash key of the request for consistent hashing, from the ``hash_key`` metadata of the route"""
+        if not routes:
+            return None
+        hash_key = routes[0].metadata.get(HASH_KEY_METADATA)
+        if not hash_key:
+            return None
+        request = exchange.get_request()
+        source, _, name = hash_key.partition(':')
+        if source == 'header':
+            return request.get_origin_header().get(name)
+        elif source == 'query':
+            values = urllib.parse.parse_qs(request.get_query()).get(name)
+            return values[0] if values else None
+        elif source == 'remote_ip':
+            return request.get_remote_ip()
+        return None
+
+    async def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
+        routes = exchange.get_attributes(GATEWAY_ROUTE_ATTR)
+        # instances ejected by the circuit breaker filter get no traffic until their back-off is over
+        routes = self.outlier_detector.filter_routes(routes)
+        route = self.load_balancer_rule.choose(routes, self.get_hash_key(exchange, routes))
 
         if route is None:
             raise ApiNotFoundException(exchange.get_attributes(MICRO_SERVICE_NAME))
 
         exchange.set_attributes(GATEWAY_REQUEST_ROUTE_ATTR, route)
-        chain.filter(exchange)
+        await chain.filter(exchange)
+
+
+class ResponseCompressionGatewayFilter(GatewayFilter):
+    """
+    Compresses the response with the best of ``encodings`` the client accepts, streamed responses chunk
+    by chunk. Compression is skipped while the process uses more than ``max_cpu_usage`` of a core
+    """
+
+    def __init__(self, context: 'ApplicationContext'):
+        config = context.get_compression_config()
+        self.enabled = config.enabled
+        self.min_size = config.min_size
+        self.level = config.level
+        self.encodings = [encoding.lower() for encoding in config.encodings]
+        self.cpu_budget = CpuBudget(config.max_cpu_usage)
+
+    async def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
+        encoding = None
+        if self.enabled:
+            encoding = negotiate_encoding(exchange.get_request().get_origin_header().get('Accept-Encoding'),
+                                          self.encodings)
+        if encoding is None or self.cpu_budget.saturated():
+            await chain.filter(exchange)
+            return
+        response = CompressingServerHttpResponse(exchange.get_response(), encoding, self.min_size, self.level)
+        await chain.filter(exchange.mutate(response))
+        await response.finish()
+
+
+class ResponseCacheGatewayFilter(GatewayFilter):
+    """
+    Answers GET requests of routes with a ``cache_ttl`` from memory. The key is made of service, version,
+    method, the sorted query and the request headers named by ``key_headers`` and the ``cache_headers``
+    metadata. A stale entry within its ``cache_stale`` seconds is served while one background request
+    refreshes it. Upstream ``Cache-Control`` overrides the route ttl and can forbid caching,
+    a client sending ``Cache-Control: no-cache`` skips the lookup
+    """
+
+    def __init__(self, context: 'ApplicationContext'):
+        config = context.get_response_cache_config()
+        self.enabled = config.enabled
+        self.ttl = config.ttl
+        self.stale_while_revalidate = config.stale_while_revalidate
+        self.key_headers = [name.lower() for name in config.key_headers or ()]
+        self.cache = ResponseCache(max_size=config.max_size, max_entry_size=config.max_entry_size)
+        # keys being refreshed in the background
+        self.refreshing = set()
+
+    async def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
+        routes = exchange.get_attributes(GATEWAY_ROUTE_ATTR)
+        if not self.enabled or not routes or exchange.get_request().get_method_name().upper() != 'GET':
+            await chain.filter(exchange)
+            return
+        ttl = get_route_timeout(routes[0], CACHE_TTL_METADATA, self.ttl)
+        if not ttl:
+            await chain.filter(exchange)
+            return
+        stale = get_route_timeout(routes[0], CACHE_STALE_METADATA, self.stale_while_revalidate) or 0
+        key_headers = get_key_headers(routes[0], self.key_headers)
+        key = get_request_key(exchange, key_headers)
+        directives = parse_cache_control(exchange.get_request().get_origin_header().get('Cache-Control'))
+        if 'no-store' in directives:
+            await chain.filter(exchange)
+            return
+
+        # the key leaves out Accept-Encoding, the cached body must suit every client
+        exchange.set_attributes(UPSTREAM_IDENTITY_ATTR, True)
+
+        if 'no-cache' not in directives:
+            entry = self.cache.get(key)
+            if entry is not None:
+                fresh = entry.is_fresh()
+                if not fresh:
+                    self.revalidate(key, exchange, chain, ttl, stale, key_headers)
+                self.write_entry(exchange.get_response(), entry, 'HIT' if fresh else 'STALE')
+                return
+
+        recording = RecordingServerHttpResponse(exchange.get_response(), self.cache.max_entry_size)
+        recording.set_header(CACHE_STATUS_HEADER, 'MISS')
+        await chain.filter(exchange.mutate(recording))
+        self.store(key, recording, ttl, stale, key_headers)
+
+    def revalidate(self, key: str, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain', ttl: float,
+                   stale: float, key_headers: List[str]):
+        if key in self.refreshing:
+            return
+        self.refreshing.add(key)
+        asyncio.ensure_future(self.refresh(key, exchange.mutate(RecordingServerHttpResponse()), chain, ttl, stale,
+                                           key_headers))
+
+    async def refresh(self, key: str, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain', ttl: float,
+                      stale: float, key_headers: List[str]):
+        try:
+            await chain.filter(exchange)
+            self.store(key, exchange.get_response(), ttl, stale, key_headers)
+        except Exception as ex:
+            # the stale entry is served until it expires
+            gen_log.warning(f'refresh of cached {key} failed: {ex}')
+        finally:
+            self.refreshing.discard(key)
+
+    def store(self, key: str, response: 'RecordingServerHttpResponse', ttl: float, stale: float,
+              key_headers: List[str]):
+        body = response.get_recorded_body()
+        if body is None or (response.get_status_code() or 200) != 200:
+            return
+        response_ttl = get_response_ttl(response.headers, ttl, stale, key_headers)
+        if response_ttl is None:
+            self.cache.remove(key)
+            return
+        headers = [(name, value) for name, value in response.headers.get_all() if name != CACHE_STATUS_HEADER]
+        self.cache.put(key, CacheEntry(200, response.reason, headers, body, *response_ttl))
+
+    @staticmethod
+    def write_entry(response: 'ServerHttpResponse', entry: 'CacheEntry', cache_status: str):
+        response.set_status_code(entry.status_code, entry.reason)
+        header_names = set()
+        for name, value in entry.headers:
+            if name in header_names:
+                response.add_header(name, value)
+            else:
+                response.set_header(name, value)
+                header_names.add(name)
+        response.set_header('Age', str(entry.get_age()))
+        response.set_header(CACHE_STATUS_HEADER, cache_status)
+        response.set_response_body(entry.body)
+
+
+class RequestCoalescingGatewayFilter(GatewayFilter):
+    """
+    Single flight for routes with the ``idempotent`` metadata, concurrent requests with the same
+    :func:`get_request_key` (including the body) share one upstream call. Waiters get the response or
+    the error of that call, and give up with a timeout after ``max_wait`` seconds. A response larger than
+    ``max_body_size`` can not be shared, its waiters send their own requests. The upstream is asked for
+    an unencoded body, the compression filter encodes it for each client
+    """
+
+    def __init__(self, context: 'ApplicationContext'):
+        config = context.get_coalescing_config()
+        self.enabled = config.enabled
+        self.max_wait = config.max_wait
+        self.max_body_size = config.max_body_size
+        self.key_headers = [name.lower() for name in config.key_headers or ()]
+        self.in_flight = dict()  # type: Dict[str, asyncio.Future]
+
+    @staticmethod
+    def is_idempotent(route: 'Any') -> bool:
+        idempotent = (getattr(route, 'metadata', None) or dict()).get(IDEMPOTENT_METADATA, False)
+        if isinstance(idempotent, str):
+            return idempotent.lower() in ('true', '1', 'yes')
+        return bool(idempotent)
+
+    async def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
+        routes = exchange.get_attributes(GATEWAY_ROUTE_ATTR)
+        request = exchange.get_request()
+        if not self.enabled or not routes or not self.is_idempotent(routes[0]) \
+                or (request.is_streaming() and request.get_method_name().upper() != 'GET'):
+            # a streamed body can not be part of the key without reading it first
+            await chain.filter(exchange)
+            return
+        key = get_request_key(exchange, get_key_headers(routes[0], self.key_headers), request.get_body())
+        # the key leaves out Accept-Encoding, the shared body must suit every waiter
+        exchange.set_attributes(UPSTREAM_IDENTITY_ATTR, True)
+        future = self.in_flight.get(key)
+        if future is None:
+            await self.lead(key, exchange, chain)
+            return
+        try:
+            recording = await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            raise ApiTimeoutError(f'{exchange.get_attributes(MICRO_SERVICE_NAME)} 接口请求超时')
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+            # the client of the shared call has gone away
+            recording = None
+        if recording is None or recording.get_recorded_body() is None \
+                or recording.headers.get('Content-Encoding', 'identity').strip().lower() != 'identity':
+            # an upstream which encodes anyway could send a body this client can not decode
+            await chain.filter(exchange)
+            return
+        response = exchange.get_response()
+        set_upstream_headers(response, recording.get_status_code(), recording.reason, recording.headers)
+        response.set_response_body(recording.get_recorded_body())
+
+    async def lead(self, key: str, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
+        future = asyncio.get_event_loop().create_future()
+        self.in_flight[key] = future
+        recording = RecordingServerHttpResponse(exchange.get_response(), self.max_body_size)
+        try:
+            await chain.filter(exchange.mutate(recording))
+            future.set_result(recording)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as ex:
+            future.set_exception(ex)
+            # retrieved here in case nobody was waiting
+            future.exception()
+            raise
+        finally:
+            self.in_flight.pop(key, None)
+
+
+class CircuitBreakerGatewayFilter(GatewayFilter):
+    """
+    Sits between the load balancer and the routing filters, fails fast while the breaker of the
+    service is open and reports errors, timeouts and 5xx to the outlier detection of the instance
+    """
+
+    def __init__(self, context: 'ApplicationContext'):
+        config = context.get_circuit_breaker_config()
+        self.enabled = config.enabled
+        self.outlier_detector = breaker.get_outlier_detector()
+        self.breakers = CircuitBreakerRegistry(failure_rate_threshold=config.failure_rate_threshold,
+                                               minimum_requests=config.minimum_requests, window=config.window,
+                                               open_timeout=config.open_timeout,
+                                               half_open_requests=config.half_open_requests)
+
+    async def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
+        if not self.enabled:
+            await chain.filter(exchange)
+            return
+        service_name = exchange.get_attributes(MICRO_SERVICE_NAME)
+        route = exchange.get_attributes(GATEWAY_REQUEST_ROUTE_ATTR)
+        service_breaker = self.breakers.get_breaker(service_name)
+        if not service_breaker.allow_request():
+            raise CircuitOpenError(service_name)
+
+        success = False
+        try:
+            await chain.filter(exchange)
+            success = (exchange.get_response().get_status_code() or 200) < 500
+        finally:
+            service_breaker.record(success)
+            self.outlier_detector.record(route, success)
 
 
 class RequestRateLimiterGatewayFilter(GatewayFilter):
+    # a synchronous throttle talks to redis on every request, keep it off the IOLoop
+    executor = ThreadPoolExecutor(20)
 
     def __init__(self, context: 'ApplicationContext'):
         host = context.get_redis_config().host
         password = context.get_redis_config().password
-        redis = RedisClient(host=host, password=password)
-        self.throttling = TokenBucketThrottle(redis=redis)
+        self.redis = redispool.get_redis_client(host, password=password)
+        self.throttle_config = context.get_throttle_config()
+        # one throttle per algorithm and rates, routes with the same settings share it
+        self.throttles = dict()  # type: Dict[tuple, BaseThrottle]
 
-    def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
+    async def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
         route = exchange.get_attributes(GATEWAY_REQUEST_ROUTE_ATTR)
         if route and route.throttling:
             remote_ip = exchange.get_request().get_remote_ip()
             service_name = exchange.get_attributes(MICRO_SERVICE_NAME)
             method_name = exchange.get_attributes(REQUEST_METHOD_NAME)
+            algorithm, throttling = self.get_throttle(route)
             key = f'{remote_ip}:{service_name}:{method_name}'
-            if not self.throttling.allow_request(key):
+            if algorithm != 'token_bucket':
+                # every algorithm keeps another redis data type under its keys
+                key = f'{algorithm}:{key}'
+            if not await self.allow_request(throttling, key):
+                wait = throttling.wait(key)
+                if wait is not None:
+                    exchange.get_response().set_header('Retry-After', str(max(1, math.ceil(wait))))
                 raise ThrottleError()
 
-        chain.filter(exchange)
+        await chain.filter(exchange)
+
+    @staticmethod
+    def get_number(metadata: Dict[str, str], name: str, default: float) -> float:
+        try:
+            value = float(metadata.get(name, default))
+        except (TypeError, ValueError):
+            return default
+        return value if value > 0 else default
+
+    def get_throttle(self, route: 'Any') -> Tuple[str, 'BaseThrottle']:
+        """:return: algorithm and throttle of the route, from its metadata or the throttle config"""
+        metadata = getattr(route, 'metadata', None) or dict()
+        algorithm = metadata.get(THROTTLE_METADATA)
+        if algorithm not in THROTTLES:
+            algorithm = self.throttle_config.algorithm
+        rate = self.get_number(metadata, THROTTLE_RATE_METADATA, self.throttle_config.rate)
+        burst = self.get_number(metadata, THROTTLE_BURST_METADATA, self.throttle_config.capacity)
+        throttle_key = (algorithm, rate, burst)
+        throttling = self.throttles.get(throttle_key)
+        if throttling is None:
+            throttling = self.throttles[throttle_key] = self.create_throttle(algorithm, rate, burst)
+        return algorithm, throttling
+
+    def create_throttle(self, algorithm: str, rate: float, burst: float) -> 'BaseThrottle':
+        mode = self.throttle_config.mode
+        redis = self.redis if mode != 'local' else None
+        if algorithm == 'sliding_window':
+            # a window holding a whole burst, refilled at ``rate``
+            return SlidingWindowThrottle(redis=redis, limit=int(burst), window=burst / rate)
+        if algorithm == 'gcra':
+            return GCRAThrottle(redis=redis, rate=rate, burst=int(burst))
+        if mode == 'redis':
+            return TokenBucketThrottle(redis=redis, rate=rate, capacity=burst)
+        return HybridTokenBucketThrottle(redis=redis, rate=rate, capacity=burst,
+                                         lease_size=self.throttle_config.lease_size,
+                                         lease_ttl=self.throttle_config.lease_ttl,
+                                         fail_open=self.throttle_config.fail_open)
+
+    async def allow_request(self, throttling: 'BaseThrottle', key: str) -> bool:
+        if inspect.iscoroutinefunction(throttling.allow_request):
+            return await throttling.allow_request(key)
+        if getattr(throttling, 'redis', None) is None:
+            # counted in process, no round trip to keep off the IOLoop
+            return throttling.allow_request(key)
+        return await self.allow_request_on_executor(throttling, key)
+
+    @run_on_executor
+    def allow_request_on_executor(self, throttling: 'BaseThrottle', key: str) -> bool:
+        return throttling.allow_request(key)
 
 
 class AuthGatewayFilter(GatewayFilter):
 
-    def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
-        chain.filter(exchange)
+    async def filter(self, exchange: 'ServerWebExchange', chain: 'GatewayFilterChain'):
+        await chain.filter(exchange)
@@ -1,16 +1,15 @@
-import functools
+import asyncio
 import json
-from concurrent.futures.thread import ThreadPoolExecutor
-from typing import List
+from typing import List, Optional
 
 
-from tornado.concurrent import run_on_executor
-from tornado.web import RequestHandler, HTTPError
+from tornado.web import RequestHandler, HTTPError, stream_request_body
 
-from gateway.exceptions import VersionFormatError, ApiFormatErrorException, GWException
-from gateway.filter.definition import GatewayFilterChain, GatewayFilter
+from gateway.exceptions import VersionFormatError, ApiFormatErrorException, GWException, VersionNumTooTowError
+from gateway.filter.definition import GatewayFilterChain, GatewayFilter, adapt_filter
 from gateway.web import TornadoServerHttpRequest, DefaultServerWebExchange, TornadoServerHttpResponse, \
-    MICRO_SERVICE_NAME, REQUEST_METHOD_NAME, MICRO_SERVICE_VERSION, GATEWAY_ROUTE_ATTR, ServerWebExchange
+    MICRO_SERVICE_NAME, REQUEST_METHOD_NAME, MICRO_SERVICE_VERSION, GATEWAY_ROUTE_ATTR, ServerWebExchange, \
+    RequestBodyStream
 from logger.log import gen_log, app_log
 
 
@@ -18,22 +17,40 @@ class RequestForwardingHandler(RequestHandler):
     """Gateway Network request forwarding Handler
     Forward http request to target Micro Server
     This implementation extends ~.RequestHandler
+    Filter chain runs directly on the IOLoop, filters must not block
     """
 
-    # default thread pool
-    executor = ThreadPoolExecutor(500)
-
-    def initialize(self, web_handler: 'WebHandler', route_locator: 'RouteLocator') -> None:
+    def initialize(self, web_handler: 'WebHandler', route_locator: 'RouteLocator',
+                   in_flight: 'InFlightRequests' = None) -> None:
         self.web_handler = web_handler
         self.route_locator = route_locator
-
-    @run_on_executor()
-    def handle_request(self):
+        self.in_flight = in_flight
+        if in_flight is not None:
+            in_flight.start()
+
+    def finish(self, chunk=None) -> 'asyncio.Future':
+        future = super(RequestForwardingHandler, self).finish(chunk)
+        # the request counts until the response is flushed
+        future.add_done_callback(lambda f: self.request_done())
+        return future
+
+    def on_connection_close(self):
+        self.request_done()
+
+    def request_done(self):
+        if self.in_flight is not None:
+            self.in_flight.done()
+            self.in_flight = None
+
+    def create_exchange(self) -> 'ServerWebExchange':
+        server_http_request = TornadoServerHttpRequest(self.request)
+        server_http_response = TornadoServerHttpResponse(self)
+        return DefaultServerWebExchange(server_http_request, server_http_response)
+
+    async def handle_request(self):
+        server_web_exchange = self.create_exchange()
+        server_http_response = server_web_exchange.get_response()
         try:
-
-            server_http_request = TornadoServerHttpRequest(self.request)
-            server_http_response = TornadoServerHttpResponse(self)
-            server_web_exchange = DefaultServerWebExchange(server_http_request, server_http_response)
             path = self.request.path[1:]
             method_names = path.split('/')
             if len(method_names) > 2:
@@ -50,15 +67,19 @@ class RequestForwardingHandler(RequestHandler):
             server_web_exchange.set_attributes(MICRO_SERVICE_NAME, service_name)
             server_web_exchange.set_attributes(REQUEST_METHOD_NAME, method_name)
             server_web_exchange.set_attributes(MICRO_SERVICE_VERSION, version)
-            lookup_route = functools.partial(self.lookup_route, server_web_exchange)
-            routes = list(filter(lookup_route, self.route_locator.get_routes()))
+            route_table = self.route_locator.get_route_table()
+            routes = route_table.get_compatible_routes(service_name, version)
+            if not routes and route_table.get_service_routes(service_name):
+                # service is registered, but every instance is newer than the requested version
+                raise VersionNumTooTowError(service_name)
             server_web_exchange.set_attributes(GATEWAY_ROUTE_ATTR, routes)
-            self.web_handler.handle(server_web_exchange)
+            await self.web_handler.handle(server_web_exchange)
             return server_http_response.get_response_body()
         except Exception as ex:
-            if isinstance(ex, GWException):
+            if isinstance(ex, GWException) and not server_http_response.is_streaming():
                 state_val = ex.state
-            elif isinstance(ex, HTTPError):
+            elif isinstance(ex, HTTPError) or server_http_response.is_streaming():
+                # part of the body has been sent, tornado can only log it and finish the response
                 raise ex
             else:
                 state_val = 0
@@ -103,23 +124,91 @@ class RequestForwardingHandler(RequestHandler):
         self.set_header("Access-Control-Max-Age", "3600")  # 用来指定本次预检请求的有效期，单位为秒，在此期间不用发出另一条预检请求。
         # 定义一个响应OPTIONS 请求，不用作任务处理
 
-    def lookup_route(self, server_web_exchange: 'ServerWebExchange', route: 'Route'):
-        return server_web_exchange.get_attributes(MICRO_SERVICE_NAME) == route.route_id
+
+@stream_request_body
+class StreamingRequestForwardingHandler(RequestForwardingHandler):
+    """Gateway request forwarding Handler for streaming mode
+    Filter chain starts as soon as the headers arrive, request body flows to the upstream
+    through a bounded ~.RequestBodyStream and the upstream response is written in chunks
+    """
+
+    def initialize(self, web_handler: 'WebHandler', route_locator: 'RouteLocator',
+                   max_body_size: int = None, max_buffer_size: int = 1024 * 1024,
+                   in_flight: 'InFlightRequests' = None) -> None:
+        super(StreamingRequestForwardingHandler, self).initialize(web_handler, route_locator, in_flight)
+        self.max_body_size = max_body_size
+        self.body_stream = RequestBodyStream(max_buffer_size)
+        self.request_future = None
+
+    def prepare(self):
+        if self.max_body_size:
+            self.request.connection.set_max_body_size(self.max_body_size)
+        if self.request.method in ('GET', 'POST'):
+            self.request_future = asyncio.ensure_future(self.handle_request())
+            self.request_future.add_done_callback(lambda f: self.body_stream.discard())
+
+    def create_exchange(self) -> 'ServerWebExchange':
+        server_http_request = TornadoServerHttpRequest(self.request, body_stream=self.body_stream)
+        server_http_response = TornadoServerHttpResponse(self)
+        return DefaultServerWebExchange(server_http_request, server_http_response)
+
+    async def data_received(self, chunk: bytes):
+        await self.body_stream.put(chunk)
+
+    async def get(self):
+        self.body_stream.finish()
+        res = await self.request_future
+        await self.finish(res)
+
+    async def post(self):
+        self.body_stream.finish()
+        res = await self.request_future
+        await self.finish(res)
+
+    def on_connection_close(self):
+        super(StreamingRequestForwardingHandler, self).on_connection_close()
+        self.body_stream.discard()
+        if self.request_future is not None:
+            self.request_future.cancel()
+
+
+class InFlightRequests:
+    """counts the requests of a server, a stopping server waits until they are finished"""
+
+    def __init__(self):
+        self.count = 0
+        self.idle = None  # type: Optional[asyncio.Future]
+
+    def start(self):
+        self.count += 1
+
+    def done(self):
+        self.count -= 1
+        if self.count == 0 and self.idle is not None and not self.idle.done():
+            self.idle.set_result(None)
+
+    async def wait_idle(self):
+        """returns once no request is in flight"""
+        if self.count == 0:
+            return
+        self.idle = asyncio.get_event_loop().create_future()
+        await self.idle
 
 
 class WebHandler:
-    def handle(self, server_web_exchange: 'ServerWebExchange'):
+    async def handle(self, server_web_exchange: 'ServerWebExchange'):
         raise NotImplementedError()
 
 
 class FilteringWebHandler(WebHandler):
 
     def __init__(self, filters: List['GatewayFilter']):
-        self.filters = filters
+        # sync filters are wrapped once here, not per request
+        self.filters = list(map(adapt_filter, filters))
 
-    def handle(self, server_web_exchange: 'ServerWebExchange'):
+    async def handle(self, server_web_exchange: 'ServerWebExchange'):
         chain = DefaultGatewayFilterChain(self.filters)
-        chain.filter(server_web_exchange)
+        await chain.filter(server_web_exchange)
 
 
 class DefaultGatewayFilterChain(GatewayFilterChain):
@@ -131,8 +220,8 @@ class DefaultGatewayFilterChain(GatewayFilterChain):
     def get_filters(self) -> List['GatewayFilter']:
         return self.filters
 
-    def filter(self, exchange: 'ServerWebExchange'):
+    async def filter(self, exchange: 'ServerWebExchange'):
         if self.index < len(self.filters):
             filter_handler = self.filters[self.index]
             chain = DefaultGatewayFilterChain(self.get_filters(), self.index + 1)
-            return filter_handler.filter(exchange, chain)
+            return await filter_handler.filter(exchange, chain)
@@ -0,0 +1,166 @@
+# coding=utf-8
+"""
+Active health checking of the instances in the route table, probes run concurrently on the IOLoop
+and unhealthy instances are left out of the route snapshot served to the filters
+"""
+import asyncio
+import random
+import time
+from typing import Any, Dict, Optional
+
+from tornado.httpclient import HTTPRequest
+
+from gateway.loadbalancer import instance_key
+from gateway.route.definition import RpcType
+from logger.log import gen_log
+from rpc import pool, redispool
+from rpc.redis import heartbeat_key
+
+# route metadata keys, set when the instance is registered
+HEALTH_CHECK_PATH_METADATA = 'health_check_path'
+HEARTBEAT_INTERVAL_METADATA = 'heartbeat_interval'
+
+
+class _InstanceHealth:
+
+    def __init__(self, route: 'Any'):
+        self.route = route
+        self.healthy = True
+        self.successes = 0
+        self.failures = 0
+        self.last_check = None  # type: Optional[float]
+        self.task = None  # type: Optional[asyncio.Task]
+
+
+class HealthChecker:
+    """
+    Probes every instance of the discovered route table: an HTTP GET of ``path`` for http instances
+    (any response below 500 is healthy), the heartbeat key for redis rpc instances that announce a
+    ``heartbeat_interval``. Every instance is probed by its own task every ``interval`` seconds
+    +/- ``jitter``, so probes of many instances do not line up.
+    An instance turns unhealthy after ``unhealthy_threshold`` failed probes in a row and healthy again
+    after ``healthy_threshold`` good ones, the route locator is told about every change
+    """
+    def __init__(self, route_locator: 'RouteDefinitionRouteLocator', path: str = '/health', interval: float = 10.0,
+                 jitter: float = 0.2, timeout: float = 2.0, unhealthy_threshold: int = 2,
+                 healthy_threshold: int = 1):
+        self.route_locator = route_locator
+        self.path = path
+        self.interval = interval
+        self.jitter = jitter
+        self.timeout = timeout
+        self.unhealthy_threshold = unhealthy_threshold
+        self.healthy_threshold = healthy_threshold
+        self.instances = dict()  # type: Dict[str, _InstanceHealth]
+        self.route_table = None
+        self.sync_task = None  # type: Optional[asyncio.Task]
+
+    def start(self):
+        """must be called on the IOLoop"""
+        if self.sync_task is None:
+            self.sync_task = asyncio.ensure_future(self._sync_loop())
+
+    def stop(self):
+        if self.sync_task is not None:
+            self.sync_task.cancel()
+            self.sync_task = None
+        for health in self.instances.values():
+            health.task.cancel()
+        self.instances = dict()
+
+    async def _sync_loop(self):
+        while True:
+            try:
+                self.sync()
+            except Exception as ex:
+                gen_log.exception(ex)
+            await asyncio.sleep(1)
+
+    def sync(self):
+        """start probing new instances and stop probing the ones gone from discovery"""
+        route_table = self.route_locator.get_discovered_route_table()
+        if route_table is self.route_table:
+            return
+        self.route_table = route_table
+        routes = {instance_key(route): route for route in route_table.get_routes()}
+        for key in list(self.instances):
+            if key not in routes:
+                health = self.instances.pop(key)
+                health.task.cancel()
+                if not health.healthy:
+                    self._publish(health.route.route_id)
+        for key, route in routes.items():
+            health = self.instances.get(key)
+            if health is None:
+                health = _InstanceHealth(route)
+                health.task = asyncio.ensure_future(self._probe_loop(health))
+                self.instances[key] = health
+            else:
+                health.route = route
+
+    def _next_interval(self) -> float:
+        return self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    async def _probe_loop(self, health: '_InstanceHealth'):
+        # spread the first probes over a whole interval
+        await asyncio.sleep(random.uniform(0, self.interval))
+        while True:
+            try:
+                healthy = await self.probe(health.route)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                gen_log.warning(f'health check of {instance_key(health.route)} failed: {ex}')
+                healthy = False
+            if healthy is not None:
+                self._record(health, healthy)
+            await asyncio.sleep(self._next_interval())
+
+    def _record(self, health: '_InstanceHealth', healthy: bool):
+        health.last_check = time.monotonic()
+        if healthy:
+            health.successes += 1
+            health.failures = 0
+            changed = not health.healthy and health.successes >= self.healthy_threshold
+        else:
+            health.failures += 1
+            health.successes = 0
+            changed = health.healthy and health.failures >= self.unhealthy_threshold
+        if changed:
+            health.healthy = healthy
+            gen_log.warning(f'instance {instance_key(health.route)} of {health.route.route_id} is '
+                            f'{"healthy" if healthy else "unhealthy"}')
+            self._publish(health.route.route_id)
+
+    def _publish(self, service_name: str):
+        unhealthy = frozenset(key for key, health in self.instances.items()
+                              if not health.healthy and health.route.route_id == service_name)
+        self.route_locator.set_unhealthy_instances(service_name, unhealthy)
+
+    async def probe(self, route: 'Any') -> Optional[bool]:
+        """:return: health of the instance, None when the instance can not be checked"""
+        if route.route_type == RpcType.HTTP:
+            return await self.probe_http(route)
+        elif route.route_type == RpcType.REDIS_RPC:
+            return await self.probe_heartbeat(route)
+        return None
+
+    async def probe_http(self, route: 'Any') -> bool:
+        path = route.metadata.get(HEALTH_CHECK_PATH_METADATA) or self.path
+        request = HTTPRequest(url=f'http://{route.uri}{path}', method='GET',
+                              connect_timeout=self.timeout, request_timeout=self.timeout)
+        response = await pool.get_connection_pool().fetch(request, raise_error=False)
+        return response.code < 500
+
+    async def probe_heartbeat(self, route: 'Any') -> Optional[bool]:
+        if not route.metadata.get(HEARTBEAT_INTERVAL_METADATA) or not route.instance_id:
+            # server does not send heartbeats, nothing to check
+            return None
+        key = heartbeat_key(route.route_id, route.instance_id)
+        redis = redispool.get_async_redis(route.uri, password=route.password, username=route.user)
+        exists = await asyncio.wait_for(redis.exists(key), self.timeout)
+        return bool(exists)
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {key: {'service': health.route.route_id, 'healthy': health.healthy, 'last_check': health.last_check}
+                for key, health in self.instances.items()}
@@ -1,16 +1,348 @@
+import bisect
+import hashlib
+import math
 import random
-from typing import List, Any
+import threading
+import time
+from typing import List, Any, Dict, Optional, Tuple
+
+# route metadata keys, set when the instance is registered
+LOAD_BALANCER_METADATA = 'load_balancer'
+WEIGHT_METADATA = 'weight'
+# where the consistent hash key comes from: ``header:<name>``, ``query:<name>`` or ``remote_ip``
+HASH_KEY_METADATA = 'hash_key'
+
+# latency observations older than this (seconds) weigh 1/e in the EWMA
+DEFAULT_EWMA_DECAY = 10.0
+# statistics of instances idle for longer than this (seconds) are dropped
+STATS_IDLE_TIMEOUT = 3600.0
+
+
+def instance_key(route: 'Any') -> str:
+    instance_id = getattr(route, 'instance_id', None)
+    return instance_id if instance_id else route.uri
+
+
+class InstanceStats:
+    """
+    Live statistics of one upstream instance, in-flight request count and
+    the time decayed moving average of the observed latency (seconds)
+    """
+
+    def __init__(self, decay: float = DEFAULT_EWMA_DECAY):
+        self.decay = decay
+        self.outstanding = 0
+        self.ewma = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.last_update = None  # type: Optional[float]
+        self.created = time.monotonic()
+        self._lock = threading.Lock()
+
+    def on_start(self):
+        with self._lock:
+            self.outstanding += 1
+
+    def on_complete(self, latency: float, success: bool = True):
+        with self._lock:
+            self.outstanding = max(0, self.outstanding - 1)
+            self.requests += 1
+            if not success:
+                self.failures += 1
+            now = time.monotonic()
+            if self.last_update is None:
+                self.ewma = latency
+            else:
+                weight = math.exp(-(now - self.last_update) / self.decay)
+                self.ewma = self.ewma * weight + latency * (1 - weight)
+            self.last_update = now
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {'outstanding': self.outstanding, 'ewma': self.ewma,
+                'requests': self.requests, 'failures': self.failures}
+
+
+class LoadBalancerStats:
+    """per instance statistics shared by the load balancer rules and the filters feeding them"""
+
+    def __init__(self, decay: float = DEFAULT_EWMA_DECAY):
+        self.decay = decay
+        self.instances = dict()  # type: Dict[str, InstanceStats]
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def get_instance_stats(self, route: 'Any') -> 'InstanceStats':
+        key = instance_key(route)
+        stats = self.instances.get(key)
+        if stats is None:
+            with self._lock:
+                stats = self.instances.get(key)
+                if stats is None:
+                    self._sweep()
+                    stats = InstanceStats(self.decay)
+                    # copy on write, readers iterate the dict without locking
+                    instances = dict(self.instances)
+                    instances[key] = stats
+                    self.instances = instances
+        return stats
+
+    def _sweep(self):
+        """instances come and go with deployments, forget the ones idle for a long time"""
+        now = time.monotonic()
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        self.instances = {key: stats for key, stats in self.instances.items()
+                          if stats.outstanding > 0 or now - (stats.last_update or stats.created) < STATS_IDLE_TIMEOUT}
+
+    def on_start(self, route: 'Any'):
+        self.get_instance_stats(route).on_start()
+
+    def on_complete(self, route: 'Any', latency: float, success: bool = True):
+        self.get_instance_stats(route).on_complete(latency, success)
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {key: stats.get_stats() for key, stats in self.instances.items()}
+
+
+_load_balancer_stats = LoadBalancerStats()
+
+
+def get_load_balancer_stats() -> 'LoadBalancerStats':
+    """:return: the process wide statistics"""
+    return _load_balancer_stats
 
 
 class LoadBalancerRule:
 
-    def choose(self, services: List['Any']) -> Any:
+    def __init__(self, stats: 'LoadBalancerStats' = None):
+        self.stats = stats or get_load_balancer_stats()
+
+    def choose(self, services: List['Any'], key: str = None) -> Any:
         pass
 
 
 class RandomRule(LoadBalancerRule):
 
-    def choose(self, services: List['Any']) -> Any:
+    def choose(self, services: List['Any'], key: str = None) -> Any:
         if len(services) > 0:
             index = random.randint(0, len(services) - 1)
             return services[index]
+
+
+class WeightedRoundRobinRule(LoadBalancerRule):
+    """
+    Smooth weighted round robin, the weight of an instance is the ``weight`` metadata (default 1),
+    an instance with weight 0 gets no traffic as long as another one has a weight
+    """
+
+    def __init__(self, stats: 'LoadBalancerStats' = None):
+        super(WeightedRoundRobinRule, self).__init__(stats)
+        self.current_weights = dict()  # type: Dict[Tuple[str, Any], Dict[str, int]]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_weight(route: 'Any') -> int:
+        metadata = getattr(route, 'metadata', None) or dict()
+        try:
+            return max(0, int(metadata.get(WEIGHT_METADATA, 1)))
+        except (TypeError, ValueError):
+            return 1
+
+    def choose(self, services: List['Any'], key: str = None) -> Any:
+        if len(services) == 0:
+            return None
+        if len(services) == 1:
+            return services[0]
+        weights = [(instance_key(route), self.get_weight(route)) for route in services]
+        total = sum(weight for _, weight in weights)
+        if total == 0:
+            return random.choice(services)
+        # versions of a service are balanced separately, like the rings of ConsistentHashRule
+        round_key = (services[0].route_id, services[0].version)
+        with self._lock:
+            current_weights = self.current_weights.get(round_key)
+            if current_weights is None or len(current_weights) != len(weights) \
+                    or any(instance not in current_weights for instance, _ in weights):
+                # instances have changed, restart the round
+                current_weights = {instance: 0 for instance, _ in weights}
+                self.current_weights[round_key] = current_weights
+            best = None
+            for index, (instance, weight) in enumerate(weights):
+                current_weights[instance] += weight
+                if best is None or current_weights[instance] > current_weights[weights[best][0]]:
+                    best = index
+            current_weights[weights[best][0]] -= total
+        return services[best]
+
+
+class LeastOutstandingRule(LoadBalancerRule):
+    """instance with the fewest in-flight requests, ties are broken randomly"""
+
+    def choose(self, services: List['Any'], key: str = None) -> Any:
+        if len(services) == 0:
+            return None
+        best, least = list(), None
+        for route in services:
+            outstanding = self.stats.get_instance_stats(route).outstanding
+            if least is None or outstanding < least:
+                best, least = [route], outstanding
+            elif outstanding == least:
+                best.append(route)
+        return best[0] if len(best) == 1 else random.choice(best)
+
+
+class PowerOfTwoChoicesRule(LoadBalancerRule):
+    """
+    Power of two choices over the latency EWMA, two random instances are compared by
+    ``ewma * (outstanding + 1)`` and the cheaper one wins. Instances without observations
+    are priced at the latency floor so new instances get probed right away
+    """
+    latency_floor = 0.001
+
+    def cost(self, route: 'Any') -> float:
+        stats = self.stats.get_instance_stats(route)
+        return max(stats.ewma, self.latency_floor) * (stats.outstanding + 1)
+
+    def choose(self, services: List['Any'], key: str = None) -> Any:
+        if len(services) == 0:
+            return None
+        if len(services) == 1:
+            return services[0]
+        first, second = random.sample(services, 2)
+        return first if self.cost(first) <= self.cost(second) else second
+
+
+def hash_value(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class ConsistentHashRing:
+    """
+    Ring of virtual nodes, adding or removing an instance only inserts or removes its own
+    virtual nodes, so about 1/N of the keys move to another instance
+    """
+
+    def __init__(self, replicas: int = 160):
+        self.replicas = replicas
+        self.hashes = list()  # type: List[int]
+        self.nodes = list()  # type: List[str]
+        self.routes = dict()  # type: Dict[str, Any]
+        # the routes tuple of the snapshot the ring was last synced with
+        self.source = None
+
+    def update(self, services: List['Any']):
+        routes = {instance_key(route): route for route in services}
+        removed = set(self.routes).difference(routes)
+        if removed:
+            points = [(point, node) for point, node in zip(self.hashes, self.nodes) if node not in removed]
+            self.hashes = [point for point, _ in points]
+            self.nodes = [node for _, node in points]
+        for node in routes:
+            if node in self.routes:
+                continue
+            for replica in range(self.replicas):
+                point = hash_value(f'{node}#{replica}')
+                index = bisect.bisect_right(self.hashes, point)
+                self.hashes.insert(index, point)
+                self.nodes.insert(index, node)
+        self.routes = routes
+        self.source = services
+
+    def lookup(self, key: str, accept=None) -> Any:
+        """
+        first instance clockwise from the hash of ``key`` which is accepted by ``accept``,
+        the first instance clockwise when none is accepted
+        """
+        if not self.hashes:
+            return None
+        start = bisect.bisect_right(self.hashes, hash_value(key)) % len(self.hashes)
+        if accept is None:
+            return self.routes[self.nodes[start]]
+        tried = set()
+        size = len(self.hashes)
+        for offset in range(size):
+            node = self.nodes[(start + offset) % size]
+            if node in tried:
+                continue
+            route = self.routes[node]
+            if accept(route):
+                return route
+            tried.add(node)
+            if len(tried) == len(self.routes):
+                break
+        return self.routes[self.nodes[start]]
+
+
+class ConsistentHashRule(LoadBalancerRule):
+    """
+    Consistent hashing with bounded load, the key from :func:`hash_key` is hashed onto a ring of
+    virtual nodes, an instance already holding more than ``load_factor`` times the average
+    in-flight requests is skipped for the next one on the ring. Requests without a key are spread randomly
+    """
+
+    def __init__(self, stats: 'LoadBalancerStats' = None, replicas: int = 160, load_factor: float = 1.25):
+        super(ConsistentHashRule, self).__init__(stats)
+        self.replicas = replicas
+        self.load_factor = load_factor
+        self.rings = dict()  # type: Dict[Tuple[str, Any], ConsistentHashRing]
+        self._lock = threading.Lock()
+
+    def get_ring(self, services: List['Any']) -> 'ConsistentHashRing':
+        ring_key = (services[0].route_id, services[0].version)
+        ring = self.rings.get(ring_key)
+        if ring is not None and ring.source is services:
+            return ring
+        with self._lock:
+            ring = self.rings.get(ring_key)
+            if ring is None:
+                ring = ConsistentHashRing(self.replicas)
+                self.rings[ring_key] = ring
+            if ring.source is not services:
+                # the route snapshot has changed, move the ring to the new instances
+                ring.update(services)
+        return ring
+
+    def choose(self, services: List['Any'], key: str = None) -> Any:
+        if len(services) == 0:
+            return None
+        if len(services) == 1:
+            return services[0]
+        if key is None:
+            return random.choice(services)
+        ring = self.get_ring(services)
+        total = sum(self.stats.get_instance_stats(route).outstanding for route in services)
+        capacity = math.ceil((total + 1) * self.load_factor / len(services))
+        return ring.lookup(key, lambda route: self.stats.get_instance_stats(route).outstanding < capacity)
+
+
+LOAD_BALANCER_RULES = {
+    'random': RandomRule,
+    'round_robin': WeightedRoundRobinRule,
+    'least_outstanding': LeastOutstandingRule,
+    'p2c_ewma': PowerOfTwoChoicesRule,
+    'consistent_hash': ConsistentHashRule,
+}
+
+
+class LoadBalancerRuleSelector:
+    """
+    Picks the rule of a service from the ``load_balancer`` metadata of its routes,
+    one rule instance per name so stateful rules keep their state across requests
+    """
+
+    def __init__(self, default_rule: str = 'random', stats: 'LoadBalancerStats' = None):
+        self.stats = stats or get_load_balancer_stats()
+        self.rules = {name: rule(self.stats) for name, rule in LOAD_BALANCER_RULES.items()}
+        self.default_rule = self.rules.get(default_rule) or self.rules['random']
+
+    def get_rule(self, services: List['Any']) -> 'LoadBalancerRule':
+        if len(services) > 0:
+            metadata = getattr(services[0], 'metadata', None) or dict()
+            rule = self.rules.get(metadata.get(LOAD_BALANCER_METADATA))
+            if rule is not None:
+                return rule
+        return self.default_rule
+
+    def choose(self, services: List['Any'], key: str = None) -> Any:
+        return self.get_rule(services).choose(services, key)
@@ -0,0 +1,176 @@
+# coding=utf-8
+"""
+Route tables of a prefork gateway.
+
+The supervisor only forks and restarts processes, it starts no thread, so every fork is safe. One of
+its processes watches discovery and probes the instances, it serves its route table on a unix socket
+bound by the supervisor and pushes every new table to the workers, which serve the requests on the
+shared port::
+
+    length of the table (4 bytes, big endian) | pickled RouteTable
+
+A worker gets the current table as soon as it connects, so a restarted worker serves the same routes
+as the others. While the route process is restarted the workers keep serving their last table, a
+worker stops once the supervisor has gone
+"""
+import asyncio
+import os
+import pickle
+import socket
+import struct
+import tempfile
+from typing import Any, Callable, List, Optional, Set
+
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_unix_socket
+from tornado.tcpserver import TCPServer
+
+from gateway.route.locator import RouteLocator, RouteDefinitionRouteLocator
+from gateway.route.table import RouteTable
+from logger.log import gen_log
+
+_LENGTH = struct.Struct('>I')
+
+
+def route_socket_path(port: int) -> str:
+    """unix socket of the supervisor serving ``port``"""
+    return os.path.join(tempfile.gettempdir(), f'gateway-{port}-{os.getpid()}.sock')
+
+
+def encode_route_table(route_table: 'RouteTable') -> bytes:
+    data = pickle.dumps(route_table, protocol=pickle.HIGHEST_PROTOCOL)
+    return _LENGTH.pack(len(data)) + data
+
+
+class RouteTableServer(TCPServer):
+    """
+    pushes the served table of the route process to every connected worker, runs on one IOLoop. The
+    socket is bound on creation, workers may connect before the route process serves it
+    """
+
+    def __init__(self, path: str):
+        super(RouteTableServer, self).__init__()
+        self.path = path
+        self.route_locator = None  # type: Optional[RouteDefinitionRouteLocator]
+        self.streams = set()  # type: Set[IOStream]
+        self.io_loop = None  # type: Optional[IOLoop]
+        # only the owner may connect
+        self.socket = bind_unix_socket(path, mode=0o600)
+
+    def serve(self, route_locator: 'RouteDefinitionRouteLocator'):
+        """must be called on the IOLoop"""
+        self.route_locator = route_locator
+        self.io_loop = IOLoop.current()
+        self.add_socket(self.socket)
+        route_locator.add_listener(self._route_table_changed)
+
+    def _route_table_changed(self, route_table: 'RouteTable'):
+        # discovery events come on the zookeeper threads
+        self.io_loop.add_callback(self.publish, route_table)
+
+    async def handle_stream(self, stream: 'IOStream', address):
+        self.streams.add(stream)
+        stream.set_close_callback(lambda: self.streams.discard(stream))
+        self._send(stream, encode_route_table(self.route_locator.get_route_table()))
+
+    def publish(self, route_table: 'RouteTable'):
+        if route_table is not self.route_locator.get_route_table():
+            # a newer table is on its way
+            return
+        data = encode_route_table(route_table)
+        for stream in list(self.streams):
+            self._send(stream, data)
+
+    def _send(self, stream: 'IOStream', data: bytes):
+        try:
+            stream.write(data)
+        except StreamClosedError:
+            self.streams.discard(stream)
+
+    def close(self):
+        """must be called on the IOLoop of :meth:`serve` if it was served"""
+        self.stop()
+        self.socket.close()
+        for stream in list(self.streams):
+            stream.close()
+        self.streams.clear()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class RouteTableSubscriber(RouteLocator):
+    """
+    route locator of a worker, serves the last table the route process has pushed. ``on_close`` is
+    called once the supervisor has gone
+    """
+
+    def __init__(self, path: str, on_close: 'Callable[[], None]' = None, timeout: float = 10.0,
+                 retry_interval: float = 1.0):
+        self.path = path
+        self.on_close = on_close
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.supervisor_pid = os.getppid()
+        self.route_table = RouteTable()
+        self.stream = None  # type: Optional[IOStream]
+        self.reader = None  # type: Optional[asyncio.Task]
+        self.closed = False
+
+    async def connect(self):
+        """connects to the route process and waits for the first table, then keeps reading the new ones"""
+        self.route_table = await self._connect()
+        self.reader = asyncio.ensure_future(self._read_loop())
+
+    async def _connect(self) -> 'RouteTable':
+        self.stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        try:
+            await asyncio.wait_for(self.stream.connect(self.path), self.timeout)
+            return await asyncio.wait_for(self._read(), self.timeout)
+        except BaseException:
+            self.stream.close()
+            raise
+
+    async def _read(self) -> 'RouteTable':
+        length, = _LENGTH.unpack(await self.stream.read_bytes(_LENGTH.size))
+        return pickle.loads(await self.stream.read_bytes(length))
+
+    async def _read_loop(self):
+        while not self.closed:
+            try:
+                while True:
+                    self.route_table = await self._read()
+            except StreamClosedError:
+                if self.closed:
+                    return
+                gen_log.error(f'route process closed {self.path}, serving the last table')
+            await self._reconnect()
+
+    async def _reconnect(self):
+        while not self.closed:
+            if os.getppid() != self.supervisor_pid:
+                gen_log.error(f'supervisor of {self.path} has gone')
+                self.closed = True
+                if self.on_close is not None:
+                    self.on_close()
+                return
+            await asyncio.sleep(self.retry_interval)
+            try:
+                self.route_table = await self._connect()
+                return
+            except (OSError, StreamClosedError, asyncio.TimeoutError):
+                # the route process is starting again
+                continue
+
+    def close(self):
+        self.closed = True
+        if self.stream is not None:
+            self.stream.close()
+
+    def get_routes(self) -> List['Any']:
+        return list(self.route_table.get_routes())
+
+    def get_route_table(self) -> 'RouteTable':
+        return self.route_table
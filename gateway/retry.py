@@ -0,0 +1,136 @@
+# coding=utf-8
+"""
+Retry budget, per service latency percentiles and the retry / hedging policy of the upstream calls
+"""
+import collections
+import threading
+import time
+from typing import Any, Dict, Optional
+
+# route metadata keys, set when the instance is registered
+RETRY_ATTEMPTS_METADATA = 'retry_attempts'
+HEDGE_METADATA = 'hedge'
+# every method of the service is safe to send more than once, such as read only rpc methods
+IDEMPOTENT_METADATA = 'idempotent'
+
+# methods which are safe to send more than once
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+# upstream answers worth another attempt on another instance
+RETRYABLE_STATUS = frozenset([502, 503, 504, 599])
+
+
+class RetryBudget:
+    """
+    Retries and hedged requests of a service are limited to ``ratio`` of its requests,
+    plus ``min_per_second`` so services with little traffic can still retry
+    """
+
+    def __init__(self, ratio: float = 0.1, min_per_second: float = 10.0, window: float = 10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_balance = max(1.0, min_per_second * window)
+        self.balance = self.max_balance
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.balance = min(self.max_balance, self.balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self.balance = min(self.max_balance, self.balance + (now - self.last_refill) * self.min_per_second)
+            self.last_refill = now
+            if self.balance >= 1:
+                self.balance -= 1
+                return True
+            return False
+
+
+class LatencyTracker:
+    """latencies of the last ``size`` successful requests of a service, percentiles are cached for a while"""
+
+    def __init__(self, size: int = 1024, refresh: int = 64):
+        self.samples = collections.deque(maxlen=size)
+        self.refresh = refresh
+        self.pending = 0
+        self.sorted_samples = list()
+        self._lock = threading.Lock()
+
+    def record(self, latency: float):
+        with self._lock:
+            self.samples.append(latency)
+            self.pending += 1
+
+    def percentile(self, percent: float) -> Optional[float]:
+        with self._lock:
+            if self.pending >= self.refresh or len(self.sorted_samples) < min(len(self.samples), self.refresh):
+                self.sorted_samples = sorted(self.samples)
+                self.pending = 0
+            sorted_samples = self.sorted_samples
+        if not sorted_samples:
+            return None
+        index = min(len(sorted_samples) - 1, int(len(sorted_samples) * percent))
+        return sorted_samples[index]
+
+    def __len__(self):
+        return len(self.samples)
+
+
+class RetryPolicy:
+    """
+    ``retries`` extra attempts on other instances for idempotent requests failing with a connection error,
+    a timeout or 502/503/504, and a hedged request to another instance once the first one passes the p95
+    latency of the service. Both are overridden per route by the ``retry_attempts`` and ``hedge`` metadata
+    and both draw from the retry budget of the service
+    """
+
+    def __init__(self, enabled: bool = True, retries: int = 1, hedge: bool = True, budget_ratio: float = 0.1,
+                 min_retries_per_second: float = 10.0, hedge_percentile: float = 0.95,
+                 hedge_min_delay: float = 0.01, hedge_min_samples: int = 20):
+        self.enabled = enabled
+        self.retries = retries
+        self.hedge = hedge
+        self.budget_ratio = budget_ratio
+        self.min_retries_per_second = min_retries_per_second
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.budgets = dict()  # type: Dict[str, RetryBudget]
+        self.latencies = dict()  # type: Dict[str, LatencyTracker]
+        self._lock = threading.Lock()
+
+    def get_retries(self, route: 'Any') -> int:
+        try:
+            return max(0, int(route.metadata.get(RETRY_ATTEMPTS_METADATA, self.retries)))
+        except (TypeError, ValueError):
+            return self.retries
+
+    def is_hedged(self, route: 'Any') -> bool:
+        hedge = route.metadata.get(HEDGE_METADATA, self.hedge)
+        if isinstance(hedge, str):
+            return hedge.lower() in ('true', '1', 'yes')
+        return bool(hedge)
+
+    def get_budget(self, service_name: str) -> 'RetryBudget':
+        budget = self.budgets.get(service_name)
+        if budget is None:
+            with self._lock:
+                budget = self.budgets.setdefault(service_name,
+                                                 RetryBudget(self.budget_ratio, self.min_retries_per_second))
+        return budget
+
+    def get_latency_tracker(self, service_name: str) -> 'LatencyTracker':
+        tracker = self.latencies.get(service_name)
+        if tracker is None:
+            with self._lock:
+                tracker = self.latencies.setdefault(service_name, LatencyTracker())
+        return tracker
+
+    def get_hedge_delay(self, service_name: str) -> Optional[float]:
+        """:return: seconds to wait before hedging, None while too few latencies have been observed"""
+        tracker = self.get_latency_tracker(service_name)
+        if len(tracker) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, tracker.percentile(self.hedge_percentile))
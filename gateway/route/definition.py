@@ -1,8 +1,10 @@
 from enum import Enum
+from typing import Dict
 
 from discovery.instance import ServiceInstance
 from exception.definition import CommonException
 from exception.error_code import CommonErrorCode
+from gateway.throttle.throttling import is_throttled
 
 
 class RpcType(Enum):
@@ -12,28 +14,45 @@ class RpcType(Enum):
 
 class RouteDefinition:
     def __init__(self, route_id: str, uri: str, route_type: 'RpcType' = RpcType.HTTP,
-                 throttling=False, version='50000'):
+                 throttling=False, version='50000', instance_id: str = None, metadata: Dict[str, str] = None):
         self.route_id = route_id
         self.uri = uri
         self.version = version
         self.route_type = route_type
         self.throttling = throttling
+        self.instance_id = instance_id
+        self.metadata = metadata or dict()
 
 
 class Route:
     def __init__(self, route_id: str, uri: str, route_type: 'RpcType' = RpcType.HTTP,
-                 throttling=False, version='50000'):
+                 throttling=False, version='50000', instance_id: str = None, metadata: Dict[str, str] = None):
         self.route_id = route_id
         self.uri = uri
         self.version = version
         self.route_type = route_type
         self.throttling = throttling
+        self.instance_id = instance_id
+        self.metadata = metadata or dict()
 
 
 class RedisRpcRouteDefinition(RouteDefinition):
 
-    def __init__(self, route_id: str, uri: str, route_type: 'RpcType', password: 'str', user: 'str', version: 'str'):
-        super(RedisRpcRouteDefinition).__init__(route_id=route_id, uri=uri, route_type=route_type, version=version)
+    def __init__(self, route_id: str, uri: str, route_type: 'RpcType', password: 'str', user: 'str', version: 'str',
+                 throttling=False, instance_id: str = None, metadata: Dict[str, str] = None):
+        super(RedisRpcRouteDefinition, self).__init__(route_id=route_id, uri=uri, route_type=route_type,
+                                                      throttling=throttling, version=version,
+                                                      instance_id=instance_id, metadata=metadata)
+        self.password = password
+        self.user = user
+
+
+class RedisRpcRoute(Route):
+
+    def __init__(self, route_id: str, uri: str, route_type: 'RpcType', password: 'str', user: 'str', version: 'str',
+                 throttling=False, instance_id: str = None, metadata: Dict[str, str] = None):
+        super(RedisRpcRoute, self).__init__(route_id=route_id, uri=uri, route_type=route_type, throttling=throttling,
+                                            version=version, instance_id=instance_id, metadata=metadata)
         self.password = password
         self.user = user
 
@@ -44,16 +63,21 @@ class RouteFactory:
     def get_route(instance: 'ServiceInstance'):
         service_id = instance.get_service_id()
         version = instance.get_version()
+        instance_id = instance.get_instance_id()
+        metadata = instance.get_meta_data() or dict()
         uri = f'{instance.get_host()}:{instance.get_port()}'
         route_type = RpcType.HTTP
+        throttling = is_throttled(metadata)
         if instance.get_rpc_type() == RpcType.HTTP.value:
-            return RouteDefinition(route_id=service_id, uri=uri, route_type=route_type, version=version)
+            return RouteDefinition(route_id=service_id, uri=uri, route_type=route_type, throttling=throttling,
+                                   version=version, instance_id=instance_id, metadata=metadata)
         elif instance.get_rpc_type() == RpcType.REDIS_RPC.value:
             route_type = RpcType.REDIS_RPC
-            uri = instance.get_meta_data().get('redis_host')
-            pwd = instance.get_meta_data().get('password')
-            user = instance.get_meta_data().get('user')
+            uri = metadata.get('redis_host')
+            pwd = metadata.get('password')
+            user = metadata.get('user')
             return RedisRpcRouteDefinition(route_id=service_id, uri=uri, route_type=route_type,
-                                           password=pwd, user=user, version=version)
+                                           password=pwd, user=user, version=version, throttling=throttling,
+                                           instance_id=instance_id, metadata=metadata)
         else:
             raise CommonException(error_code=CommonErrorCode.Rpc_Type_Error)
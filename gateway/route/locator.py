@@ -1,13 +1,16 @@
 import threading
-from typing import List
+from typing import List, Callable, Dict, Tuple, FrozenSet
 
-from discovery.event import ServiceWatchedEvent
+from discovery.event import ServiceWatchedEvent, ServiceChangedEvent, ServiceRemovedEvent, InstancesChangedEvent
 from discovery.instance import ServiceInstance
 from exception.definition import CommonException
 from exception.error_code import CommonErrorCode
 from gateway.exceptions import DiscoveryNotSettingError
 from gateway.factory import DiscoveryFactory
-from gateway.route.definition import RouteDefinition, Route, RpcType, RouteFactory
+from gateway.loadbalancer import instance_key
+from gateway.route.definition import RouteDefinition, Route, RpcType, RouteFactory, RedisRpcRouteDefinition, \
+    RedisRpcRoute
+from gateway.route.table import RouteTable
 
 
 class RouteLocator:
@@ -15,6 +18,9 @@ class RouteLocator:
     def get_routes(self) -> List['Route']:
         raise NotImplementedError()
 
+    def get_route_table(self) -> 'RouteTable':
+        raise NotImplementedError()
+
     def convert_to_route(self, route_instance: 'RouteDefinition'):
         raise NotImplementedError()
 
@@ -24,17 +30,93 @@ class RouteDefinitionLocator:
     def get_route_definitions(self) -> List[RouteDefinition]:
         raise NotImplementedError()
 
+    def get_service_route_definitions(self, service_id: str) -> List[RouteDefinition]:
+        raise NotImplementedError()
+
+    def add_listener(self, listener: 'Callable[[ServiceChangedEvent], None]'):
+        """listener is called with the :class:`ServiceChangedEvent` after the route definitions have changed"""
+        raise NotImplementedError()
+
 
 class RouteDefinitionRouteLocator(RouteLocator):
 
     def __init__(self, route_def_locator: 'RouteDefinitionLocator'):
         self.route_definition_locator = route_def_locator
+        # everything discovered, and the table served to the filters without the unhealthy instances
+        self.discovered_route_table = RouteTable()
+        self.route_table = RouteTable()
+        self.unhealthy_instances = dict()  # type: Dict[str, FrozenSet[str]]
+        self.listeners = list()  # type: List[Callable[[RouteTable], None]]
+        self._run_lock = threading.Lock()
+        route_def_locator.add_listener(self.refresh)
+        self.refresh()
+
+    def add_listener(self, listener: 'Callable[[RouteTable], None]'):
+        """listener is called with every new served table, on the thread which changed it"""
+        self.listeners.append(listener)
+
+    def _notify(self):
+        for listener in self.listeners:
+            listener(self.route_table)
+
+    def refresh(self, event: 'ServiceChangedEvent' = None):
+        """rebuild the whole table, or only the slice of the service the event is about"""
+        with self._run_lock:
+            if event is None:
+                route_definitions = self.route_definition_locator.get_route_definitions()
+                self.discovered_route_table = RouteTable(map(self.convert_to_route, route_definitions))
+                route_table = self.discovered_route_table
+                for service_name in self.unhealthy_instances:
+                    route_table = route_table.with_service_routes(service_name, self._healthy_routes(service_name))
+                self.route_table = route_table
+                self._notify()
+                return
+            route_definitions = self.route_definition_locator.get_service_route_definitions(event.service_id)
+            routes = map(self.convert_to_route, route_definitions)
+            self.discovered_route_table = self.discovered_route_table.with_service_routes(event.service_id, routes)
+            self.route_table = self.route_table.with_service_routes(event.service_id,
+                                                                    self._healthy_routes(event.service_id))
+            self._notify()
+
+    def set_unhealthy_instances(self, service_name: str, instance_keys: 'FrozenSet[str]'):
+        """called by the health checker, ``instance_keys`` are left out of the served routes of the service"""
+        with self._run_lock:
+            if instance_keys:
+                self.unhealthy_instances[service_name] = frozenset(instance_keys)
+            else:
+                self.unhealthy_instances.pop(service_name, None)
+            self.route_table = self.route_table.with_service_routes(service_name,
+                                                                    self._healthy_routes(service_name))
+            self._notify()
+
+    def _healthy_routes(self, service_name: str) -> Tuple['Route', ...]:
+        routes = self.discovered_route_table.get_service_routes(service_name)
+        unhealthy = self.unhealthy_instances.get(service_name)
+        if not unhealthy:
+            return routes
+        healthy = tuple(route for route in routes if instance_key(route) not in unhealthy)
+        # every instance failing its probe is more likely a problem of the checks, keep serving them all
+        return healthy if healthy else routes
+
+    def get_discovered_route_table(self) -> 'RouteTable':
+        return self.discovered_route_table
 
     def get_routes(self) -> List['Route']:
-        return list(map(self.convert_to_route, self.route_definition_locator.get_route_definitions()))
+        return list(self.route_table.get_routes())
+
+    def get_route_table(self) -> 'RouteTable':
+        return self.route_table
 
     def convert_to_route(self, route_instance: 'RouteDefinition') -> Route:
-        return Route(route_id=route_instance.route_id, uri=route_instance.uri, route_type=route_instance.route_type)
+        if isinstance(route_instance, RedisRpcRouteDefinition):
+            return RedisRpcRoute(route_id=route_instance.route_id, uri=route_instance.uri,
+                                 route_type=route_instance.route_type, password=route_instance.password,
+                                 user=route_instance.user, version=route_instance.version,
+                                 throttling=route_instance.throttling, instance_id=route_instance.instance_id,
+                                 metadata=route_instance.metadata)
+        return Route(route_id=route_instance.route_id, uri=route_instance.uri, route_type=route_instance.route_type,
+                     throttling=route_instance.throttling, version=route_instance.version,
+                     instance_id=route_instance.instance_id, metadata=route_instance.metadata)
 
 
 class DiscoveryClientRouteDefinitionLocator(RouteDefinitionLocator):
@@ -51,34 +133,49 @@ class DiscoveryClientRouteDefinitionLocator(RouteDefinitionLocator):
         if self.discovery_client is None:
             raise DiscoveryNotSettingError()
 
-        self.services = self.discovery_client.get_services()
-        self.service_instances = list()  # type: List[ServiceInstance]
+        self.listeners = list()  # type: List[Callable[[ServiceChangedEvent], None]]
+        # only serializes writers, readers get the current dict without locking
         self._run_lock = threading.Lock()
-        for service in self.services:
+        service_route_definitions = dict()  # type: Dict[str, Tuple[RouteDefinition, ...]]
+        for service in self.discovery_client.get_services():
             instances = self.discovery_client.get_instances(service)  # type: List[ServiceInstance]
             if instances:
-                self.service_instances.extend(instances)
-        self.route_definitions = list(map(self._create_route_definition, self.service_instances))
+                service_route_definitions[service] = tuple(map(self._create_route_definition, instances))
+        self.service_route_definitions = service_route_definitions
 
         watcher = ServiceWatchedEvent(func=self.service_watch_event)
         self.discovery_client.add_watch(watcher)
 
-    def service_watch_event(self):
+    def service_watch_event(self, event: 'ServiceChangedEvent'):
         with self._run_lock:
-            services = self.discovery_client.get_services()
-            service_instances = list()  # type: List[ServiceInstance]
-            for service in services:
-                instances = self.discovery_client.get_instances(service)  # type: List[ServiceInstance]
-                if instances:
-                    service_instances.extend(instances)
-            route_definitions = list(map(self._create_route_definition, service_instances))
-            self.service_instances = service_instances
-            self.route_definitions = route_definitions
-            self.services = services
+            if isinstance(event, InstancesChangedEvent) and event.instances:
+                route_definitions = tuple(map(self._create_route_definition, event.instances))
+            elif isinstance(event, (InstancesChangedEvent, ServiceRemovedEvent)):
+                route_definitions = ()
+            else:
+                # a new service has no instances until its InstancesChangedEvent arrives
+                return
+            if not route_definitions and event.service_id not in self.service_route_definitions:
+                return
+            # copy on write, only the changed service is rebuilt
+            service_route_definitions = dict(self.service_route_definitions)
+            if route_definitions:
+                service_route_definitions[event.service_id] = route_definitions
+            else:
+                service_route_definitions.pop(event.service_id, None)
+            self.service_route_definitions = service_route_definitions
+            for listener in self.listeners:
+                listener(event)
 
     def get_route_definitions(self) -> List[RouteDefinition]:
-        with self._run_lock:
-            return self.route_definitions
+        return [route_definition for route_definitions in self.service_route_definitions.values()
+                for route_definition in route_definitions]
+
+    def get_service_route_definitions(self, service_id: str) -> List[RouteDefinition]:
+        return list(self.service_route_definitions.get(service_id, ()))
+
+    def add_listener(self, listener: 'Callable[[ServiceChangedEvent], None]'):
+        self.listeners.append(listener)
 
     def _create_route_definition(self, instance: 'ServiceInstance'):
         route_definition = RouteFactory.get_route(instance)
@@ -0,0 +1,124 @@
+import bisect
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+
+def normalize_version(version: Union[int, str, None]) -> Union[int, str, None]:
+    """versions are registered as int or digital str, index them as int"""
+    if isinstance(version, str) and version.isdigit():
+        return int(version)
+    return version
+
+
+def _index_versions(routes: Iterable['Any']) -> Dict[Any, Tuple['Any', ...]]:
+    by_version = dict()  # type: Dict[Any, List[Any]]
+    for route in routes:
+        by_version.setdefault(normalize_version(route.version), []).append(route)
+    return {key: tuple(value) for key, value in by_version.items()}
+
+
+def _sort_versions(by_version: Dict[Any, Tuple['Any', ...]]) -> Tuple[int, ...]:
+    return tuple(sorted(version for version in by_version if isinstance(version, int)))
+
+
+class RouteTable:
+    """
+    Immutable snapshot of the routes, indexed by service name and by (service name, version).
+    A new table is built when discovery changes and swapped in by a single attribute assignment,
+    so readers never take a lock and always see a consistent table.
+    The numeric versions of every service are kept sorted, so version resolution is a bisect
+    """
+
+    def __init__(self, routes: Iterable['Any'] = ()):
+        by_service = dict()  # type: Dict[str, List[Any]]
+        for route in routes:
+            by_service.setdefault(route.route_id, []).append(route)
+        self._by_service = {key: tuple(value) for key, value in by_service.items()}
+        self._by_version = {key: _index_versions(value) for key, value in self._by_service.items()}
+        self._versions = {key: _sort_versions(value) for key, value in self._by_version.items()}
+
+    @classmethod
+    def _from_index(cls, by_service: Dict[str, Tuple['Any', ...]],
+                    by_version: Dict[str, Dict[Any, Tuple['Any', ...]]],
+                    versions: Dict[str, Tuple[int, ...]]) -> 'RouteTable':
+        route_table = cls.__new__(cls)
+        route_table._by_service = by_service
+        route_table._by_version = by_version
+        route_table._versions = versions
+        return route_table
+
+    def with_service_routes(self, service_name: str, routes: Iterable['Any']) -> 'RouteTable':
+        """
+        copy on write, returns a new table where the routes of ``service_name`` are replaced,
+        the indexes of the other services are shared with this table
+        """
+        routes = tuple(routes)
+        if not routes:
+            return self.without_service(service_name)
+        by_service = dict(self._by_service)
+        by_version = dict(self._by_version)
+        versions = dict(self._versions)
+        by_service[service_name] = routes
+        by_version[service_name] = _index_versions(routes)
+        versions[service_name] = _sort_versions(by_version[service_name])
+        return self._from_index(by_service, by_version, versions)
+
+    def without_service(self, service_name: str) -> 'RouteTable':
+        if service_name not in self._by_service:
+            return self
+        by_service = dict(self._by_service)
+        by_version = dict(self._by_version)
+        versions = dict(self._versions)
+        by_service.pop(service_name)
+        by_version.pop(service_name, None)
+        versions.pop(service_name, None)
+        return self._from_index(by_service, by_version, versions)
+
+    def get_routes(self) -> Tuple['Any', ...]:
+        return tuple(route for routes in self._by_service.values() for route in routes)
+
+    def get_services(self) -> List[str]:
+        return list(self._by_service.keys())
+
+    def get_service_routes(self, service_name: str) -> Tuple['Any', ...]:
+        return self._by_service.get(service_name, ())
+
+    def get_version_routes(self, service_name: str, version: Union[int, str]) -> Tuple['Any', ...]:
+        return self._by_version.get(service_name, {}).get(normalize_version(version), ())
+
+    def get_versions(self, service_name: str) -> Tuple[int, ...]:
+        """numeric versions of the service in ascending order"""
+        return self._versions.get(service_name, ())
+
+    def resolve_version(self, service_name: str, version: Union[int, str]) -> Optional[int]:
+        """
+        :return: the requested version if it is registered, otherwise the highest version lower than it,
+                 None if every registered version is higher or the requested version is not numeric
+        """
+        version = normalize_version(version)
+        if not isinstance(version, int):
+            # only numeric versions are ordered
+            return None
+        versions = self._versions.get(service_name, ())
+        index = bisect.bisect_right(versions, version)
+        return versions[index - 1] if index else None
+
+    def get_compatible_routes(self, service_name: str, version: Union[int, str]) -> Tuple['Any', ...]:
+        """
+        routes of the exact version, or of the highest compatible version lower than the requested one.
+        Routes registered without a numeric version are not versioned, they are compatible with every
+        version no numeric one is, a service without numeric versions serves all of its routes
+        """
+        versions = self._versions.get(service_name)
+        if not versions:
+            return self._by_service.get(service_name, ())
+        resolved = self.resolve_version(service_name, version)
+        if resolved is not None:
+            return self._by_version[service_name][resolved]
+        by_version = self._by_version[service_name]
+        version = normalize_version(version)
+        if not isinstance(version, int) and version in by_version:
+            return by_version[version]
+        return tuple(route for key, routes in by_version.items() if not isinstance(key, int) for route in routes)
+
+    def __len__(self):
+        return sum(map(len, self._by_service.values()))
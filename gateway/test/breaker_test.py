@@ -0,0 +1,166 @@
+# coding=utf-8
+"""
+Behavior tests of the outlier detection per instance and the circuit breaker per service, on a fake clock::
+
+    python -m pytest gateway/test/breaker_test.py
+"""
+import asyncio
+from unittest import mock
+
+import pytest
+from tornado.httputil import HTTPServerRequest, HTTPHeaders
+
+from ctx.config import CircuitBreakerConfig
+from gateway import breaker
+from gateway.breaker import OutlierDetector, CircuitBreaker, CircuitBreakerRegistry
+from gateway.exceptions import CircuitOpenError
+from gateway.filters import CircuitBreakerGatewayFilter
+from gateway.handler import DefaultGatewayFilterChain
+from gateway.route.definition import Route
+from gateway.web import DefaultServerWebExchange, TornadoServerHttpRequest, RecordingServerHttpResponse, \
+    GATEWAY_REQUEST_ROUTE_ATTR, MICRO_SERVICE_NAME
+
+
+class Clock:
+    """stands in for the ``time`` module of :mod:`gateway.breaker`"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    clock = Clock()
+    with mock.patch('gateway.breaker.time', clock):
+        yield clock
+
+
+def route(name: str) -> 'Route':
+    return Route('svc', f'{name}:80', instance_id=name)
+
+
+def test_ejects_an_instance_after_consecutive_errors(clock):
+    detector = OutlierDetector(consecutive_errors=3, base_ejection_time=10, max_ejection_time=25)
+    a = route('a')
+    for success in (False, False, True, False, False):
+        detector.record(a, success)
+    assert not detector.is_ejected(a)
+    detector.record(a, False)
+    assert detector.is_ejected(a)
+    clock.now += 10
+    assert not detector.is_ejected(a)
+    # every ejection is longer, up to the maximum
+    ejection_times = []
+    for _ in range(3):
+        for _ in range(3):
+            detector.record(a, False)
+        ejected_at = clock.now
+        while detector.is_ejected(a):
+            clock.now += 1
+        ejection_times.append(clock.now - ejected_at)
+    assert ejection_times == [20, 25, 25]
+
+
+def test_ejects_at_most_max_ejection_percent(clock):
+    detector = OutlierDetector(consecutive_errors=1, base_ejection_time=10, max_ejection_percent=50)
+    routes = [route(name) for name in 'abcd']
+    assert detector.filter_routes(routes) is routes
+    for index, outlier in enumerate(routes[:3]):
+        clock.now += index
+        detector.record(outlier, False)
+    # the instance back soonest stays in the routes
+    assert [r.instance_id for r in detector.filter_routes(routes)] == ['d', 'a']
+    clock.now += 10
+    assert [r.instance_id for r in detector.filter_routes(routes)] == ['a', 'b', 'c', 'd']
+
+
+def test_breaker_opens_at_the_failure_rate(clock):
+    circuit = CircuitBreaker(failure_rate_threshold=0.5, minimum_requests=4, window=10, open_timeout=5)
+    for success in (False, False, False):
+        circuit.record(success)
+    # below the minimum of requests
+    assert circuit.get_state() == CircuitBreaker.CLOSED
+    circuit.record(True)
+    circuit.record(False)
+    assert circuit.get_state() == CircuitBreaker.OPEN
+    assert not circuit.allow_request()
+
+
+def test_breaker_forgets_the_outcomes_out_of_the_window(clock):
+    circuit = CircuitBreaker(failure_rate_threshold=0.5, minimum_requests=4, window=10)
+    for _ in range(3):
+        circuit.record(False)
+    clock.now += 10
+    for success in (True, True, False):
+        circuit.record(success)
+    assert circuit.get_state() == CircuitBreaker.CLOSED
+
+
+@pytest.mark.parametrize('probe_succeeds, state', [(True, CircuitBreaker.CLOSED), (False, CircuitBreaker.OPEN)])
+def test_half_open_breaker_probes(clock, probe_succeeds, state):
+    circuit = CircuitBreaker(minimum_requests=1, open_timeout=5, half_open_requests=1)
+    circuit.record(False)
+    clock.now += 5
+    assert circuit.allow_request()
+    assert circuit.get_state() == CircuitBreaker.HALF_OPEN
+    # one probe at a time
+    assert not circuit.allow_request()
+    circuit.record(probe_succeeds)
+    assert circuit.get_state() == state
+    assert circuit.allow_request() is probe_succeeds
+
+
+def test_registry_keeps_one_breaker_per_service():
+    registry = CircuitBreakerRegistry(minimum_requests=1)
+    assert registry.get_breaker('a') is registry.get_breaker('a')
+    registry.get_breaker('a').record(False)
+    assert registry.get_stats() == {'a': CircuitBreaker.OPEN}
+    assert registry.get_breaker('b').get_state() == CircuitBreaker.CLOSED
+
+
+class StatusFilter:
+    """the routing filter, answers with ``status``"""
+
+    def __init__(self, status: int):
+        self.status = status
+
+    async def filter(self, exchange, chain):
+        exchange.get_response().set_status_code(self.status)
+
+
+class Context:
+
+    def get_circuit_breaker_config(self):
+        return CircuitBreakerConfig({'circuit_breaker': {'minimum_requests': 3}})
+
+
+def test_filter_fails_fast_once_the_upstream_fails(clock):
+    breaker.configure(consecutive_errors=2)
+    breaker_filter = CircuitBreakerGatewayFilter(Context())
+    a = route('a')
+
+    async def forward(status):
+        exchange = DefaultServerWebExchange(TornadoServerHttpRequest(HTTPServerRequest(uri='/svc/50000/m',
+                                                                                       headers=HTTPHeaders())),
+                                            RecordingServerHttpResponse())
+        exchange.set_attributes(MICRO_SERVICE_NAME, 'svc')
+        exchange.set_attributes(GATEWAY_REQUEST_ROUTE_ATTR, a)
+        await breaker_filter.filter(exchange, DefaultGatewayFilterChain([StatusFilter(status)]))
+
+    async def test():
+        await forward(404)
+        await forward(503)
+        assert breaker.get_outlier_detector().get_stats()['a']['consecutive_errors'] == 1
+        # 2 failures of 3 requests open the breaker
+        await forward(502)
+        assert breaker.get_outlier_detector().is_ejected(a)
+        with pytest.raises(CircuitOpenError):
+            await forward(200)
+
+    try:
+        asyncio.run(test())
+    finally:
+        breaker.configure()
@@ -0,0 +1,181 @@
+# coding=utf-8
+"""
+Behavior tests of the response cache, a gateway and its upstream run in process::
+
+    python -m pytest gateway/test/cache_test.py
+"""
+import asyncio
+from unittest import mock
+
+import pytest
+import tornado.web
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.httputil import HTTPHeaders
+from tornado.routing import AnyMatches, Rule
+from tornado.testing import bind_unused_port
+
+from ctx.config import ResponseCacheConfig
+from gateway.cache import ResponseCache, CacheEntry, get_response_ttl, normalize_query
+from gateway.filters import LoadBalancerClientFilter, ForwardRoutingFilter, ResponseCacheGatewayFilter
+from gateway.handler import FilteringWebHandler, RequestForwardingHandler
+from gateway.retry import RetryPolicy
+from gateway.route.definition import Route
+from gateway.route.table import RouteTable
+from rpc import pool
+
+
+class Clock:
+    """stands in for the ``time`` module of :mod:`gateway.cache`"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+class CountingHandler(tornado.web.RequestHandler):
+    """answers with the number of requests it got, the ``cache_control`` argument is its Cache-Control"""
+
+    def initialize(self, hits):
+        self.hits = hits
+
+    def get(self, method):
+        self.hits.append(self.request.query)
+        if self.get_argument('cache_control', None):
+            self.set_header('Cache-Control', self.get_argument('cache_control'))
+        if self.get_argument('cookie', None):
+            self.set_cookie('session', 'x')
+        self.write(f'{method} {len(self.hits)}')
+
+
+class StaticRouteLocator:
+
+    def __init__(self, routes):
+        self.route_table = RouteTable(routes)
+
+    def get_route_table(self) -> 'RouteTable':
+        return self.route_table
+
+
+class Context:
+
+    def get_response_cache_config(self):
+        return ResponseCacheConfig({})
+
+
+def listen(app: 'tornado.web.Application') -> int:
+    sock, port = bind_unused_port()
+    HTTPServer(app).add_sockets([sock])
+    return port
+
+
+def run_with_gateway(test, metadata):
+    """runs ``test(get, hits)``, ``get(path, **headers)`` fetches ``/svc/50000/<path>`` from the gateway"""
+
+    async def main():
+        pool.configure()
+        hits = []
+        upstream = listen(tornado.web.Application([(r'/(.*)', CountingHandler, {'hits': hits})]))
+        web_handler = FilteringWebHandler([ResponseCacheGatewayFilter(Context()), LoadBalancerClientFilter(),
+                                           ForwardRoutingFilter(RetryPolicy(), 5)])
+        route_locator = StaticRouteLocator([Route('svc', f'127.0.0.1:{upstream}', metadata=metadata)])
+        port = listen(tornado.web.Application([Rule(AnyMatches(), RequestForwardingHandler,
+                                                    {'web_handler': web_handler, 'route_locator': route_locator})]))
+        client = AsyncHTTPClient(force_instance=True)
+
+        async def get(path, **headers):
+            response = await client.fetch(f'http://127.0.0.1:{port}/svc/50000/{path}', headers=headers)
+            return response.headers.get('X-Cache'), response.body.decode()
+
+        try:
+            return await test(get, hits)
+        finally:
+            client.close()
+            pool.get_connection_pool().close()
+
+    return asyncio.run(main())
+
+
+def test_serves_the_second_request_from_the_cache():
+    async def test(get, hits):
+        return [await get('m?a=1&b=2'), await get('m?b=2&a=1'), await get('m?a=2'), await get('other?a=1&b=2')]
+
+    replies = run_with_gateway(test, {'cache_ttl': '10'})
+    assert replies == [('MISS', 'm 1'), ('HIT', 'm 1'), ('MISS', 'm 2'), ('MISS', 'other 3')]
+
+
+def test_routes_without_ttl_are_not_cached():
+    async def test(get, hits):
+        return [await get('m'), await get('m')]
+
+    assert run_with_gateway(test, {}) == [(None, 'm 1'), (None, 'm 2')]
+
+
+@pytest.mark.parametrize('query', ['cache_control=no-store', 'cache_control=private', 'cache_control=max-age%3D0',
+                                   'cookie=1'])
+def test_upstream_can_forbid_caching(query):
+    async def test(get, hits):
+        return [await get(f'm?{query}'), await get(f'm?{query}')]
+
+    assert run_with_gateway(test, {'cache_ttl': '10'}) == [('MISS', 'm 1'), ('MISS', 'm 2')]
+
+
+def test_client_no_cache_skips_the_lookup():
+    async def test(get, hits):
+        return [await get('m'), await get('m', **{'Cache-Control': 'no-cache'}), await get('m')]
+
+    assert run_with_gateway(test, {'cache_ttl': '10'}) == [('MISS', 'm 1'), ('MISS', 'm 2'), ('HIT', 'm 2')]
+
+
+def test_stale_entry_is_served_while_it_is_refreshed():
+    clock = Clock()
+
+    async def test(get, hits):
+        replies = [await get('m')]
+        clock.now += 15
+        replies.append(await get('m'))
+        # refreshed in the background
+        while len(hits) < 2:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.01)
+        replies.append(await get('m'))
+        clock.now += 30
+        replies.append(await get('m'))
+        return replies, len(hits)
+
+    with mock.patch('gateway.cache.time', clock):
+        replies, hits = run_with_gateway(test, {'cache_ttl': '10', 'cache_stale': '10'})
+    assert replies == [('MISS', 'm 1'), ('STALE', 'm 1'), ('HIT', 'm 2'), ('MISS', 'm 3')]
+    assert hits == 3
+
+
+def test_evicts_the_least_recently_used_entries():
+    def entry(body):
+        return CacheEntry(200, None, [], body, ttl=10, stale=0)
+
+    cache = ResponseCache(max_size=10, max_entry_size=6)
+    assert not cache.put('big', entry(b'1234567'))
+    for key in 'abc':
+        assert cache.put(key, entry(b'1234'))
+    # a was evicted, b is used and c is evicted next
+    assert cache.get('a') is None and cache.get('b') is not None
+    cache.put('d', entry(b'1234'))
+    assert sorted(cache.entries) == ['b', 'd']
+    assert cache.get_stats() == {'entries': 2, 'size': 8, 'hits': 1, 'misses': 1}
+
+
+@pytest.mark.parametrize('headers, ttl', [({}, (10, 5)), ({'Cache-Control': 'max-age=60'}, (60, 5)),
+                                          ({'Cache-Control': 's-maxage=30, max-age=60'}, (30, 5)),
+                                          ({'Cache-Control': 'max-age=60, stale-while-revalidate=20'}, (60, 20)),
+                                          ({'Cache-Control': 'max-age=60, must-revalidate'}, (60, 0)),
+                                          ({'Cache-Control': 'no-cache'}, None), ({'Vary': 'Cookie'}, None),
+                                          ({'Vary': 'X-Tenant, Accept-Encoding'}, (10, 5)),
+                                          ({'Content-Encoding': 'gzip'}, None)])
+def test_response_ttl(headers, ttl):
+    assert get_response_ttl(HTTPHeaders(headers), 10, 5, ['x-tenant']) == ttl
+
+
+def test_normalize_query():
+    assert normalize_query('b=2&a=1&a=0&c=') == 'a=0&a=1&b=2&c='
@@ -0,0 +1,177 @@
+# coding=utf-8
+"""
+Behavior tests of the active health checks, from the probes of upstreams running in process to the
+routes served by the route locator::
+
+    python -m pytest gateway/test/health_test.py
+"""
+import asyncio
+from unittest import mock
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.tcpserver import TCPServer
+from tornado.testing import bind_unused_port
+
+from discovery.service import DiscoveryClient
+from gateway.health import HealthChecker
+from gateway.route.definition import RedisRpcRoute, RpcType
+from gateway.route.locator import DiscoveryClientRouteDefinitionLocator, RouteDefinitionRouteLocator
+from rpc import pool
+from rpc.redis import heartbeat_key
+from zookeeper.discovery import ZookeeperServiceInstance
+
+
+class StaticDiscoveryClient(DiscoveryClient):
+
+    def __init__(self, instances):
+        self.instances = instances
+
+    def get_services(self):
+        return list({instance.get_service_id() for instance in self.instances})
+
+    def get_instances(self, service_id):
+        return [instance for instance in self.instances if instance.get_service_id() == service_id]
+
+    def add_watch(self, watcher):
+        pass
+
+
+class Context:
+
+    def __init__(self, discovery_client):
+        self.discovery_client = discovery_client
+
+    def get_discovery_config(self):
+        return object()
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    """answers the health checks with the ``status`` of its upstream"""
+
+    def initialize(self, upstream):
+        self.upstream = upstream
+
+    def get(self, path):
+        self.upstream['paths'].append(path)
+        self.set_status(self.upstream['status'])
+
+
+class HeartbeatServer(TCPServer):
+    """a redis answering EXISTS for the ``keys`` it holds"""
+
+    def __init__(self, keys):
+        super(HeartbeatServer, self).__init__()
+        self.keys = keys
+
+    async def handle_stream(self, stream: 'IOStream', address):
+        try:
+            while True:
+                count = int((await stream.read_until(b'\r\n'))[1:-2])
+                args = []
+                for _ in range(count):
+                    length = int((await stream.read_until(b'\r\n'))[1:-2])
+                    args.append((await stream.read_bytes(length + 2))[:-2].decode())
+                exists = sum(1 for key in args[1:] if key in self.keys) if args[0].upper() == 'EXISTS' else 0
+                await stream.write(b':%d\r\n' % exists)
+        except StreamClosedError:
+            pass
+
+
+def listen(upstream: dict) -> int:
+    sock, port = bind_unused_port()
+    HTTPServer(tornado.web.Application([(r'/(.*)', HealthHandler, {'upstream': upstream})])).add_sockets([sock])
+    return port
+
+
+def instance(instance_id: str, port: int, metadata: dict = None) -> 'ZookeeperServiceInstance':
+    return ZookeeperServiceInstance(instance_id=instance_id, service_id='svc', host='127.0.0.1', port=port,
+                                    rpc_type=1, version=50000, metadata=metadata or {})
+
+
+def create_route_locator(instances) -> 'RouteDefinitionRouteLocator':
+    context = Context(StaticDiscoveryClient(instances))
+    with mock.patch('gateway.route.locator.DiscoveryFactory') as discovery_factory:
+        discovery_factory.return_value.apply.return_value = context.discovery_client
+        return RouteDefinitionRouteLocator(DiscoveryClientRouteDefinitionLocator(context))
+
+
+def served(route_locator: 'RouteDefinitionRouteLocator'):
+    return sorted(route.instance_id for route in route_locator.get_route_table().get_service_routes('svc'))
+
+
+async def wait_for(condition, timeout: float = 5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.01)
+
+
+def test_unhealthy_instances_leave_the_routes_until_they_recover():
+    async def test():
+        pool.configure()
+        good = {'status': 200, 'paths': []}
+        bad = {'status': 503, 'paths': []}
+        route_locator = create_route_locator([instance('good', listen(good)),
+                                              instance('bad', listen(bad), {'health_check_path': '/ready'})])
+        checker = HealthChecker(route_locator, interval=0.02, jitter=0, unhealthy_threshold=2, healthy_threshold=2)
+        checker.start()
+        try:
+            await wait_for(lambda: served(route_locator) == ['good'])
+            # two failed probes in a row
+            assert len(bad['paths']) >= 2
+            bad['status'] = 404
+            await wait_for(lambda: served(route_locator) == ['bad', 'good'])
+            stats = checker.get_stats()
+        finally:
+            checker.stop()
+            pool.get_connection_pool().close()
+        return good['paths'][0], bad['paths'][0], stats
+
+    good_path, bad_path, stats = asyncio.run(test())
+    assert (good_path, bad_path) == ('health', 'ready')
+    assert {key: stats['healthy'] for key, stats in stats.items()} == {'good': True, 'bad': True}
+
+
+def test_all_instances_unhealthy_keep_serving():
+    async def test():
+        pool.configure()
+        upstreams = [{'status': 500, 'paths': []} for _ in range(2)]
+        route_locator = create_route_locator([instance(f'i{index}', listen(upstream))
+                                              for index, upstream in enumerate(upstreams)])
+        checker = HealthChecker(route_locator, interval=0.02, jitter=0, unhealthy_threshold=1)
+        checker.start()
+        try:
+            await wait_for(lambda: [stats['healthy'] for stats in checker.get_stats().values()] == [False] * 2)
+            return served(route_locator)
+        finally:
+            checker.stop()
+            pool.get_connection_pool().close()
+
+    assert asyncio.run(test()) == ['i0', 'i1']
+
+
+def test_instances_without_heartbeat_are_not_probed():
+    checker = HealthChecker(route_locator=None)
+    redis_route = RedisRpcRoute('svc', '127.0.0.1:1', RpcType.REDIS_RPC, password=None, user=None,
+                                version='50000', instance_id='i', metadata={})
+    assert asyncio.run(checker.probe(redis_route)) is None
+
+
+def test_probes_the_heartbeat_of_redis_instances():
+    def redis_route(instance_id, port):
+        return RedisRpcRoute('svc', f'127.0.0.1:{port}', RpcType.REDIS_RPC, password=None, user=None,
+                             version='50000', instance_id=instance_id, metadata={'heartbeat_interval': 5})
+
+    async def test():
+        sock, port = bind_unused_port()
+        server = HeartbeatServer({heartbeat_key('svc', 'alive')})
+        server.add_sockets([sock])
+        checker = HealthChecker(route_locator=None)
+        try:
+            return await checker.probe(redis_route('alive', port)), await checker.probe(redis_route('gone', port))
+        finally:
+            server.stop()
+
+    assert asyncio.run(test()) == (True, False)
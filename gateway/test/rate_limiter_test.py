@@ -0,0 +1,148 @@
+# coding=utf-8
+"""
+Behavior tests of the request throttling of the routes, from the discovered instance metadata to the
+replies of a gateway running in process, with local throttles::
+
+    python -m pytest gateway/test/rate_limiter_test.py
+"""
+import asyncio
+import json
+from unittest import mock
+
+import pytest
+import tornado.web
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.routing import AnyMatches, Rule
+from tornado.testing import bind_unused_port
+
+from ctx.config import RedisConfig, ThrottleConfig
+from discovery.service import DiscoveryClient
+from gateway.exceptions import ThrottleError
+from gateway.filters import LoadBalancerClientFilter, ForwardRoutingFilter, RequestRateLimiterGatewayFilter
+from gateway.handler import FilteringWebHandler, RequestForwardingHandler
+from gateway.retry import RetryPolicy
+from gateway.route.definition import RouteFactory
+from gateway.route.locator import DiscoveryClientRouteDefinitionLocator, RouteDefinitionRouteLocator
+from gateway.throttle.throttling import is_throttled
+from rpc import pool
+from zookeeper.discovery import ZookeeperServiceInstance
+
+
+class StaticDiscoveryClient(DiscoveryClient):
+
+    def __init__(self, instances):
+        self.instances = instances
+
+    def get_services(self):
+        return list({instance.get_service_id() for instance in self.instances})
+
+    def get_instances(self, service_id):
+        return [instance for instance in self.instances if instance.get_service_id() == service_id]
+
+    def add_watch(self, watcher):
+        pass
+
+
+class Context:
+
+    def __init__(self, discovery_client):
+        self.discovery_client = discovery_client
+
+    def get_discovery_config(self):
+        return object()
+
+    def get_redis_config(self):
+        return RedisConfig({'redis': {'host': '127.0.0.1:1'}})
+
+    def get_throttle_config(self):
+        return ThrottleConfig({'throttle': {'mode': 'local', 'rate': 1, 'capacity': 3}})
+
+
+class OkHandler(tornado.web.RequestHandler):
+
+    def get(self, method):
+        self.write('ok')
+
+
+def instance(service_id: str, port: int, metadata: dict) -> 'ZookeeperServiceInstance':
+    return ZookeeperServiceInstance(instance_id=f'{service_id}-1', service_id=service_id, host='127.0.0.1',
+                                    port=port, rpc_type=1, version=50000, metadata=metadata)
+
+
+def listen(app: 'tornado.web.Application') -> int:
+    sock, port = bind_unused_port()
+    HTTPServer(app).add_sockets([sock])
+    return port
+
+
+def run_with_gateway(test, metadata_by_service):
+    """runs ``test(url)``, every service of ``metadata_by_service`` is an instance of the same upstream"""
+
+    async def main():
+        pool.configure()
+        upstream = listen(tornado.web.Application([(r'/(.*)', OkHandler)]))
+        context = Context(StaticDiscoveryClient([instance(service_id, upstream, metadata)
+                                                 for service_id, metadata in metadata_by_service.items()]))
+        with mock.patch('gateway.route.locator.DiscoveryFactory') as discovery_factory:
+            discovery_factory.return_value.apply.return_value = context.discovery_client
+            route_locator = RouteDefinitionRouteLocator(DiscoveryClientRouteDefinitionLocator(context))
+        web_handler = FilteringWebHandler([LoadBalancerClientFilter(), RequestRateLimiterGatewayFilter(context),
+                                           ForwardRoutingFilter(RetryPolicy(), 5)])
+        port = listen(tornado.web.Application([Rule(AnyMatches(), RequestForwardingHandler,
+                                                    {'web_handler': web_handler, 'route_locator': route_locator})]))
+        try:
+            return await test(f'http://127.0.0.1:{port}')
+        finally:
+            pool.get_connection_pool().close()
+
+    return asyncio.run(main())
+
+
+async def replies(url: str, count: int):
+    """:return: the body of ``count`` requests, or the State of the error the gateway replied"""
+    client = AsyncHTTPClient(force_instance=True)
+    bodies = []
+    for _ in range(count):
+        body = (await client.fetch(url)).body.decode()
+        bodies.append(body if body == 'ok' else json.loads(body)['State'])
+    client.close()
+    return bodies
+
+
+@pytest.mark.parametrize('metadata, throttled', [({}, False), ({'throttling': 'true'}, True),
+                                                 ({'throttling': 'false', 'throttle': 'gcra'}, False),
+                                                 ({'throttle': 'sliding_window'}, True), ({'throttle': 'nope'}, False),
+                                                 ({'throttling': True}, True)])
+def test_is_throttled(metadata, throttled):
+    assert is_throttled(metadata) is throttled
+
+
+def test_route_factory_sets_throttling():
+    assert RouteFactory.get_route(instance('a', 1, {'throttle': 'gcra'})).throttling
+    assert not RouteFactory.get_route(instance('a', 1, {})).throttling
+    redis_instance = ZookeeperServiceInstance(instance_id='b-1', service_id='b', host='127.0.0.1', port=1, rpc_type=2,
+                                              version=50000, metadata={'redis_host': 'r:6379', 'throttling': '1'})
+    assert RouteFactory.get_route(redis_instance).throttling
+
+
+@pytest.mark.parametrize('algorithm', ['token_bucket', 'sliding_window', 'gcra'])
+def test_throttles_the_routes_with_throttle_metadata(algorithm):
+    state = ThrottleError().state
+
+    async def test(url):
+        return await replies(f'{url}/limited/50000/m', 5), await replies(f'{url}/free/50000/m', 5)
+
+    limited, free = run_with_gateway(test, {'limited': {'throttle': algorithm}, 'free': {}})
+    assert limited == ['ok'] * 3 + [state] * 2
+    assert free == ['ok'] * 5
+
+
+def test_route_metadata_overrides_the_rates():
+    state = ThrottleError().state
+
+    async def test(url):
+        return await replies(f'{url}/svc/50000/m', 7)
+
+    bodies = run_with_gateway(test, {'svc': {'throttling': 'true', 'throttle_burst': '5'}})
+    assert bodies == ['ok'] * 5 + [state] * 2
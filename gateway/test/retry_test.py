@@ -0,0 +1,149 @@
+# coding=utf-8
+"""
+Behavior tests of the retries and hedged requests of the http routing, against upstreams running in process::
+
+    python -m pytest gateway/test/retry_test.py
+"""
+import asyncio
+from unittest import mock
+
+import pytest
+import tornado.web
+from tornado.httpserver import HTTPServer
+from tornado.httputil import HTTPServerRequest, HTTPHeaders
+from tornado.testing import bind_unused_port
+
+from gateway.filters import HttpRoutingFilter
+from gateway.handler import DefaultGatewayFilterChain
+from gateway.retry import RetryBudget, LatencyTracker, RetryPolicy
+from gateway.route.definition import Route
+from gateway.web import DefaultServerWebExchange, TornadoServerHttpRequest, RecordingServerHttpResponse, \
+    GATEWAY_REQUEST_ROUTE_ATTR, GATEWAY_ROUTE_ATTR, MICRO_SERVICE_NAME, REQUEST_METHOD_NAME
+from rpc import pool
+
+
+class Clock:
+    """stands in for the ``time`` module of :mod:`gateway.retry`"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+class UpstreamHandler(tornado.web.RequestHandler):
+    """answers with the ``status`` of its upstream after its ``delay``"""
+
+    def initialize(self, upstream):
+        self.upstream = upstream
+
+    async def get(self, path):
+        self.upstream['hits'] += 1
+        await asyncio.sleep(self.upstream['delay'])
+        self.set_status(self.upstream['status'])
+        self.write(self.upstream['name'])
+
+    post = get
+
+
+def listen(name: str, status: int = 200, delay: float = 0, metadata: dict = None):
+    """:return: the route of a new upstream and its state"""
+    upstream = {'name': name, 'status': status, 'delay': delay, 'hits': 0}
+    sock, port = bind_unused_port()
+    HTTPServer(tornado.web.Application([(r'/(.*)', UpstreamHandler, {'upstream': upstream})])).add_sockets([sock])
+    return Route('svc', f'127.0.0.1:{port}', instance_id=name, metadata=metadata), upstream
+
+
+async def forward(routing_filter: 'HttpRoutingFilter', method: str, route: 'Route', routes) -> 'tuple':
+    """:return: status and body of the request routed to ``route``, the other ``routes`` are the retries"""
+    request = HTTPServerRequest(method=method, uri='/svc/50000/m', headers=HTTPHeaders())
+    response = RecordingServerHttpResponse()
+    exchange = DefaultServerWebExchange(TornadoServerHttpRequest(request), response)
+    exchange.set_attributes(MICRO_SERVICE_NAME, 'svc')
+    exchange.set_attributes(GATEWAY_REQUEST_ROUTE_ATTR, route)
+    exchange.set_attributes(GATEWAY_ROUTE_ATTR, routes)
+    exchange.set_attributes(REQUEST_METHOD_NAME, 'm')
+    await routing_filter.filter(exchange, DefaultGatewayFilterChain([]))
+    return response.get_status_code(), response.get_response_body()
+
+
+def run(test):
+    async def main():
+        pool.configure()
+        try:
+            return await test()
+        finally:
+            pool.get_connection_pool().close()
+
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize('method, metadata, reply', [('GET', None, (200, b'good')), ('POST', None, (503, b'bad')),
+                                                     ('GET', {'retry_attempts': '0'}, (503, b'bad'))])
+def test_retries_idempotent_requests_on_another_instance(method, metadata, reply):
+    async def test():
+        bad, bad_upstream = listen('bad', status=503, metadata=metadata)
+        good, good_upstream = listen('good')
+        routing_filter = HttpRoutingFilter(RetryPolicy(hedge=False))
+        return await forward(routing_filter, method, bad, [bad, good]), bad_upstream['hits'], good_upstream['hits']
+
+    assert run(test) == (reply, 1, 1 if reply[1] == b'good' else 0)
+
+
+def test_hedges_a_request_slower_than_the_p95():
+    async def test():
+        slow, slow_upstream = listen('slow', delay=1)
+        fast, fast_upstream = listen('fast')
+        policy = RetryPolicy(retries=0, hedge_min_samples=20)
+        for _ in range(20):
+            policy.get_latency_tracker('svc').record(0.02)
+        start = asyncio.get_running_loop().time()
+        reply = await forward(HttpRoutingFilter(policy), 'GET', slow, [slow, fast])
+        return reply, asyncio.get_running_loop().time() - start, slow_upstream['hits'], fast_upstream['hits']
+
+    reply, elapsed, slow_hits, fast_hits = run(test)
+    assert reply == (200, b'fast')
+    assert elapsed < 0.5
+    assert (slow_hits, fast_hits) == (1, 1)
+
+
+def test_no_hedge_without_enough_latency_samples():
+    policy = RetryPolicy(hedge_min_samples=3)
+    for _ in range(2):
+        policy.get_latency_tracker('svc').record(0.1)
+    assert policy.get_hedge_delay('svc') is None
+    policy.get_latency_tracker('svc').record(0.001)
+    assert policy.get_hedge_delay('svc') == 0.1
+
+
+def test_retry_budget():
+    clock = Clock()
+    with mock.patch('gateway.retry.time', clock):
+        budget = RetryBudget(ratio=0.5, min_per_second=1, window=2)
+        assert [budget.withdraw() for _ in range(3)] == [True, True, False]
+        # every request adds ``ratio`` of a retry
+        budget.deposit()
+        budget.deposit()
+        assert [budget.withdraw() for _ in range(2)] == [True, False]
+        # and every second ``min_per_second``
+        clock.now += 1
+        assert [budget.withdraw() for _ in range(2)] == [True, False]
+
+
+def test_latency_percentiles():
+    tracker = LatencyTracker(size=100, refresh=10)
+    assert tracker.percentile(0.5) is None
+    for latency in range(1, 101):
+        tracker.record(latency / 100)
+    assert (tracker.percentile(0.5), tracker.percentile(0.95), tracker.percentile(1)) == (0.51, 0.96, 1.0)
+
+
+@pytest.mark.parametrize('metadata, retries, hedged', [({}, 1, True),
+                                                       ({'retry_attempts': '3', 'hedge': 'false'}, 3, False),
+                                                       ({'retry_attempts': 'x', 'hedge': 'YES'}, 1, True),
+                                                       ({'retry_attempts': -1, 'hedge': 0}, 0, False)])
+def test_route_metadata_overrides_the_policy(metadata, retries, hedged):
+    policy = RetryPolicy(retries=1, hedge=True)
+    route = Route('svc', '127.0.0.1:1', metadata=metadata)
+    assert (policy.get_retries(route), policy.is_hedged(route)) == (retries, hedged)
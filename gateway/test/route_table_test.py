@@ -0,0 +1,46 @@
+# coding=utf-8
+"""
+Behavior tests of the version resolution of :class:`gateway.route.table.RouteTable`::
+
+    python -m pytest gateway/test/route_table_test.py
+"""
+import pytest
+
+from gateway.route.definition import Route
+from gateway.route.table import RouteTable
+
+
+def route(version, instance_id: str = None) -> 'Route':
+    return Route('svc', '127.0.0.1:1', version=version, instance_id=instance_id or str(version))
+
+
+def served(route_table: 'RouteTable', version):
+    return sorted(r.instance_id for r in route_table.get_compatible_routes('svc', version))
+
+
+@pytest.mark.parametrize('version, resolved', [(50000, 50000), ('50000', 50000), (50001, 50000), (60001, 60000),
+                                               (49999, None), ('latest', None), ('', None), (None, None)])
+def test_resolve_version(version, resolved):
+    route_table = RouteTable([route('50000'), route(60000)])
+    assert route_table.resolve_version('svc', version) == resolved
+
+
+@pytest.mark.parametrize('version, instances', [(50000, ['50000']), (70000, ['60000']), (49999, []),
+                                                ('latest', []), ('v1', [])])
+def test_numeric_versions_only(version, instances):
+    route_table = RouteTable([route('50000'), route(60000)])
+    assert served(route_table, version) == instances
+
+
+@pytest.mark.parametrize('version, instances', [(50000, ['50000']), (49999, ['canary', 'v1']),
+                                                ('latest', ['canary', 'v1']), ('canary', ['canary'])])
+def test_routes_without_numeric_version_stay_reachable(version, instances):
+    route_table = RouteTable([route('50000'), route('v1'), route('canary')])
+    assert served(route_table, version) == instances
+
+
+def test_service_without_numeric_versions_serves_every_route():
+    route_table = RouteTable([route('v1'), route(None, 'none')])
+    assert served(route_table, 50000) == ['none', 'v1']
+    assert served(route_table, 'latest') == ['none', 'v1']
+    assert route_table.get_compatible_routes('other', 50000) == ()
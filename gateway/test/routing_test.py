@@ -0,0 +1,107 @@
+# coding=utf-8
+"""
+Behavior tests of the upstream http routing, a gateway and its upstream run in process::
+
+    python -m pytest gateway/test/routing_test.py
+"""
+import asyncio
+
+import pytest
+import tornado.web
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.httputil import HTTPServerRequest, HTTPHeaders
+from tornado.routing import AnyMatches, Rule
+from tornado.testing import bind_unused_port
+
+from gateway.filters import LoadBalancerClientFilter, ForwardRoutingFilter, HttpRoutingFilter, has_response_body
+from gateway.handler import FilteringWebHandler, RequestForwardingHandler, StreamingRequestForwardingHandler, \
+    DefaultGatewayFilterChain
+from gateway.retry import RetryPolicy
+from gateway.route.definition import Route
+from gateway.route.table import RouteTable
+from gateway.web import DefaultServerWebExchange, TornadoServerHttpRequest, RecordingServerHttpResponse, \
+    GATEWAY_REQUEST_ROUTE_ATTR, REQUEST_METHOD_NAME
+from rpc import pool
+
+
+class StatusHandler(tornado.web.RequestHandler):
+    """answers ``/<status>`` with that status, and a body where one is allowed"""
+
+    def get(self, status):
+        self.set_status(int(status))
+        if int(status) not in (204, 304):
+            self.write(f'status {status}')
+
+    def head(self, status):
+        self.set_status(int(status))
+        self.set_header('Content-Length', '42')
+
+
+class StaticRouteLocator:
+
+    def __init__(self, routes):
+        self.route_table = RouteTable(routes)
+
+    def get_route_table(self) -> 'RouteTable':
+        return self.route_table
+
+
+def listen(app: 'tornado.web.Application') -> int:
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    return port
+
+
+def run_with_gateway(test, streaming: bool = False):
+    """runs ``test(url, upstream)``, the gateway routes ``/svc/50000/<method>`` to the upstream"""
+
+    async def main():
+        pool.configure()
+        upstream = listen(tornado.web.Application([(r'/(\d+)', StatusHandler)]))
+        web_handler = FilteringWebHandler([LoadBalancerClientFilter(), ForwardRoutingFilter(RetryPolicy(), 5)])
+        route_locator = StaticRouteLocator([Route('svc', f'127.0.0.1:{upstream}')])
+        handler = StreamingRequestForwardingHandler if streaming else RequestForwardingHandler
+        port = listen(tornado.web.Application([Rule(AnyMatches(), handler, {'web_handler': web_handler,
+                                                                             'route_locator': route_locator})]))
+        try:
+            return await test(f'http://127.0.0.1:{port}', upstream)
+        finally:
+            pool.get_connection_pool().close()
+
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+@pytest.mark.parametrize('status', [200, 204, 304, 404, 503])
+def test_passes_the_upstream_status_through(status, streaming):
+    async def test(url, upstream):
+        client = AsyncHTTPClient(force_instance=True)
+        response = await client.fetch(f'{url}/svc/50000/{status}', raise_error=False)
+        client.close()
+        return response.code, response.body
+
+    code, body = run_with_gateway(test, streaming)
+    assert code == status
+    assert body == (b'' if status in (204, 304) else f'status {status}'.encode())
+
+
+def test_head_response_has_no_body():
+    async def test(url, upstream):
+        request = HTTPServerRequest(method='HEAD', uri='/svc/50000/200', headers=HTTPHeaders())
+        response = RecordingServerHttpResponse()
+        exchange = DefaultServerWebExchange(TornadoServerHttpRequest(request), response)
+        exchange.set_attributes(GATEWAY_REQUEST_ROUTE_ATTR, Route('svc', f'127.0.0.1:{upstream}'))
+        exchange.set_attributes(REQUEST_METHOD_NAME, '200')
+        await HttpRoutingFilter().filter(exchange, DefaultGatewayFilterChain([]))
+        return response.get_status_code(), response.headers.get('Content-Length'), response.get_response_body()
+
+    assert run_with_gateway(test) == (200, '42', None)
+
+
+@pytest.mark.parametrize('method, code, body', [('GET', 200, True), ('POST', 404, True), ('GET', 101, False),
+                                                ('GET', 103, False), ('GET', 204, False), ('GET', 304, False),
+                                                ('HEAD', 200, False)])
+def test_has_response_body(method, code, body):
+    assert has_response_body(method, code) is body
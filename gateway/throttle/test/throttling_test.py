@@ -1,27 +1,427 @@
+# coding=utf-8
+"""
+Correctness tests and benchmark of the throttles in :mod:`gateway.throttle.throttling`.
+
+The tests run against an in-process stand-in of redis (:class:`FakeRedis`), the redis scripts of the
+throttles are replaced by python ports of the same logic. When the redis-server of ``THROTTLE_TEST_REDIS``
+(``host:port/db``, default ``localhost:6379/15``, the db is flushed) answers, the tests run the shipped
+scripts against it as well, and every port is checked to reply like its script. The benchmark compares
+decisions per second and decision latency of every throttle with 1, 100 and 10k distinct keys at several
+concurrency levels, against the stand-in or a real redis-server::
+
+    python -m pytest gateway/throttle/test/throttling_test.py
+    python -m gateway.throttle.test.throttling_test --redis localhost:6379
+"""
+import argparse
+import asyncio
+import inspect
+import math
+import os
 import threading
-from time import sleep
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
 
-from ycyj_zhongtai.gateway.throttle.throttling import TokenBucketThrottle
+import pytest
+from redis import Redis
+from redis.exceptions import RedisError
 
+from gateway.throttle.throttling import TokenBucketThrottle, HybridTokenBucketThrottle, SlidingWindowThrottle, \
+    GCRAThrottle, BaseThrottle
 
 
+class FakeRedis:
+    """
+    The part of redis the throttles use, held in process. ``latency`` seconds are slept per script
+    call to stand in for the network round trip
+    """
 
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.data = dict()  # type: Dict[str, Any]
+        self.expires = dict()  # type: Dict[str, float]
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.scripts = {
+            TokenBucketThrottle.Lua: self._token_bucket,
+            HybridTokenBucketThrottle.LeaseLua: self._lease,
+            HybridTokenBucketThrottle.ReturnLua: self._return,
+            SlidingWindowThrottle.Lua: self._sliding_window,
+            GCRAThrottle.Lua: self._gcra,
+        }
 
+    def register_script(self, script: str) -> Callable:
+        function = self.scripts[script]
 
+        def call(keys: List[str], args: List[Any]):
+            if self.latency:
+                time.sleep(self.latency)
+            with self._lock:
+                self.calls += 1
+                return function(keys, args)
 
+        return call
 
+    def _get(self, key: str, default: Any = None) -> Any:
+        expire = self.expires.get(key)
+        if expire is not None and expire <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key, default)
 
+    def _set(self, key: str, value: Any, expire: float = None):
+        self.data[key] = value
+        if expire is not None:
+            self.expires[key] = time.monotonic() + expire
 
-def run():
-    throttle.allow_request("192.168.10.15:GetSMSCode")
+    def keys(self) -> int:
+        return sum(1 for key in list(self.data) if self._get(key) is not None)
 
+    def _token_bucket(self, keys, args):
+        rate, capacity, req_token_num, now = (float(arg) for arg in args)
+        bucket = self._get(keys[0], dict())
+        last_token_num = bucket.get('token_num_key', capacity)
+        delta = max(0.0, now - bucket.get('last_timestamp_key', 0))
+        filled_token_num = min(capacity, last_token_num + delta / 1000 * rate)
+        allowed = filled_token_num >= req_token_num
+        new_token_num = filled_token_num - req_token_num if allowed else filled_token_num
+        self._set(keys[0], {'token_num_key': new_token_num, 'last_timestamp_key': now}, 10)
+        # lua numbers are truncated to integers in the reply
+        return [int(allowed), int(new_token_num)]
 
+    def _lease(self, keys, args):
+        rate, capacity, req_token_num, now = (float(arg) for arg in args)
+        bucket = self._get(keys[0], dict())
+        last_token_num = bucket.get('token_num_key', capacity)
+        delta = max(0.0, now - bucket.get('last_timestamp_key', 0))
+        filled_token_num = min(capacity, last_token_num + delta / 1000 * rate)
+        granted = min(req_token_num, math.floor(filled_token_num))
+        self._set(keys[0], {'token_num_key': filled_token_num - granted, 'last_timestamp_key': now},
+                  math.ceil(capacity / rate) + 1)
+        return int(granted)
+
+    def _return(self, keys, args):
+        capacity, returned = (float(arg) for arg in args)
+        bucket = self._get(keys[0])
+        if bucket is not None:
+            bucket['token_num_key'] = min(capacity, bucket['token_num_key'] + returned)
+        return 0
+
+    def _sliding_window(self, keys, args):
+        limit, window, elapsed = (float(arg) for arg in args)
+        current = self._get(keys[0], 0)
+        previous = self._get(keys[1], 0)
+        if previous * (window - elapsed) / window + current + 1 > limit:
+            return [0, current, previous]
+        current += 1
+        self._set(keys[0], current, math.ceil(window * 2) / 1000 if current == 1 else None)
+        return [1, current, previous]
+
+    def _gcra(self, keys, args):
+        emission_interval, burst_tolerance, now = (float(arg) for arg in args)
+        tat = max(float(self._get(keys[0], now)), now)
+        new_tat = tat + emission_interval
+        allow_at = new_tat - burst_tolerance
+        if now < allow_at:
+            return [0, '%.3f' % (allow_at - now)]
+        self._set(keys[0], '%.3f' % new_tat, max(1, math.ceil(new_tat - now)) / 1000)
+        return [1, '0']
+
+
+TEST_REDIS = os.environ.get('THROTTLE_TEST_REDIS', 'localhost:6379/15')
+
+
+def connect_test_redis() -> Optional['Redis']:
+    """:return: the flushed db of ``TEST_REDIS``, None when no redis-server answers"""
+    address, _, db = TEST_REDIS.partition('/')
+    host, _, port = address.partition(':')
+    redis = Redis(host=host or 'localhost', port=int(port or 6379), db=int(db or 0), socket_connect_timeout=0.5)
+    try:
+        redis.flushdb()
+    except RedisError:
+        return None
+    return redis
+
+
+def create_throttle(name: str, redis: Any, rate: float, burst: int) -> 'BaseThrottle':
+    if name == 'token_bucket':
+        return TokenBucketThrottle(redis=redis, rate=rate, capacity=burst)
+    if name == 'hybrid':
+        return HybridTokenBucketThrottle(redis=redis, rate=rate, capacity=burst)
+    if name == 'sliding_window':
+        return SlidingWindowThrottle(redis=redis, limit=burst, window=burst / rate)
+    if name == 'gcra':
+        return GCRAThrottle(redis=redis, rate=rate, burst=burst)
+    raise ValueError(name)
+
+
+THROTTLE_NAMES = ['token_bucket', 'hybrid', 'sliding_window', 'gcra']
+# throttles which also work without redis, keeping their state in process
+LOCAL_THROTTLE_NAMES = ['hybrid', 'sliding_window', 'gcra']
+
+
+def run_sequence(throttle: 'BaseThrottle', key: str, requests: int) -> List[bool]:
+    async def sequence():
+        results = list()
+        for _ in range(requests):
+            allowed = throttle.allow_request(key)
+            results.append(await allowed if inspect.isawaitable(allowed) else allowed)
+        return results
+
+    return asyncio.run(sequence())
+
+
+def measure_rate(throttle: 'BaseThrottle', key: str, duration: float, interval: float = 0.002) -> int:
+    """:return: requests allowed while sending one request every ``interval`` seconds for ``duration``"""
+
+    async def send():
+        allowed_requests = 0
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            allowed = throttle.allow_request(key)
+            if await allowed if inspect.isawaitable(allowed) else allowed:
+                allowed_requests += 1
+            await asyncio.sleep(interval)
+        return allowed_requests
+
+    return asyncio.run(send())
+
+
+def percentile(samples: List[float], percent: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percent))]
+
+
+def benchmark(throttle: 'BaseThrottle', keys: int, concurrency: int, requests: int) -> Dict[str, float]:
+    """
+    ``requests`` decisions spread round robin over ``keys`` distinct keys by ``concurrency`` workers,
+    threads for the blocking throttles and tasks for the asynchronous ones
+    """
+    key_names = [f'10.0.{index // 256}.{index % 256}:bench:method' for index in range(keys)]
+    per_worker = max(1, requests // concurrency)
+    latencies = list()  # type: List[float]
+
+    def worker_keys(worker: int):
+        return (key_names[(worker * per_worker + index) % keys] for index in range(per_worker))
+
+    if inspect.iscoroutinefunction(throttle.allow_request):
+        async def task(worker: int):
+            for key in worker_keys(worker):
+                start = time.perf_counter()
+                await throttle.allow_request(key)
+                latencies.append(time.perf_counter() - start)
+
+        async def run():
+            await asyncio.gather(*(task(worker) for worker in range(concurrency)))
+
+        started = time.perf_counter()
+        asyncio.run(run())
+    else:
+        def thread(worker: int):
+            samples = list()
+            for key in worker_keys(worker):
+                start = time.perf_counter()
+                throttle.allow_request(key)
+                samples.append(time.perf_counter() - start)
+            latencies.extend(samples)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(thread, range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {'decisions_per_second': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000}
+
+
+@pytest.fixture(params=['redis', 'redis-server', 'local'])
+def redis_mode(request):
+    return request.param
+
+
+@pytest.fixture
+def redis_server():
+    redis = connect_test_redis()
+    if redis is None:
+        pytest.skip(f'no redis-server at {TEST_REDIS}')
+    return redis
 
-if __name__ == '__main__':
-    throttle = TokenBucketThrottle()
-    while True:
-        threading.Thread(target=run).start()
 
-        #if s / 100 == 0:
-        sleep(0.03)
+def new_throttle(name: str, redis_mode: str, rate: float, burst: int) -> Optional['BaseThrottle']:
+    if redis_mode == 'local':
+        if name not in LOCAL_THROTTLE_NAMES:
+            pytest.skip(f'{name} needs redis')
+        return create_throttle(name, None, rate, burst)
+    if redis_mode == 'redis-server':
+        redis = connect_test_redis()
+        if redis is None:
+            pytest.skip(f'no redis-server at {TEST_REDIS}')
+        return create_throttle(name, redis, rate, burst)
+    return create_throttle(name, FakeRedis(), rate, burst)
 
+
+@pytest.mark.parametrize('name', THROTTLE_NAMES)
+def test_burst(name, redis_mode):
+    throttle = new_throttle(name, redis_mode, rate=1, burst=20)
+    results = run_sequence(throttle, 'burst', 30)
+    assert results[:20] == [True] * 20
+    assert not any(results[20:])
+
+
+@pytest.mark.parametrize('name', THROTTLE_NAMES)
+def test_rate(name, redis_mode):
+    rate, burst, duration = 100, 20, 1.0
+    throttle = new_throttle(name, redis_mode, rate=rate, burst=burst)
+    allowed = measure_rate(throttle, 'rate', duration)
+    expected = burst + rate * duration
+    assert expected * 0.8 <= allowed <= expected * 1.1
+
+
+@pytest.mark.parametrize('name', THROTTLE_NAMES)
+def test_keys_are_independent(name, redis_mode):
+    throttle = new_throttle(name, redis_mode, rate=1, burst=3)
+    assert run_sequence(throttle, 'first', 4) == [True, True, True, False]
+    assert run_sequence(throttle, 'second', 1) == [True]
+
+
+@pytest.mark.parametrize('name', THROTTLE_NAMES)
+def test_wait(name, redis_mode):
+    rate = 10
+    throttle = new_throttle(name, redis_mode, rate=rate, burst=2)
+    assert throttle.wait('wait') is None
+    run_sequence(throttle, 'wait', 3)
+    wait = throttle.wait('wait')
+    # a full sliding window fades out over the next window, up to 1.5 windows
+    assert wait is not None and 0 < wait <= 1.5 * 2 / rate
+    time.sleep(wait + 0.01)
+    assert run_sequence(throttle, 'wait', 1) == [True]
+    assert throttle.wait('wait') is None
+
+
+def test_gcra_keeps_a_single_key():
+    redis = FakeRedis()
+    throttle = create_throttle('gcra', redis, rate=1000, burst=10)
+    run_sequence(throttle, 'gcra', 5)
+    assert redis.keys() == 1
+    time.sleep(0.02)
+    # back to a full burst, nothing is left in redis
+    assert redis.keys() == 0
+
+
+class SwitchingDict(dict):
+    """lets the other threads run between a read of the state of a key and the write depending on it"""
+
+    def get(self, key, default=None):
+        value = super(SwitchingDict, self).get(key, default)
+        time.sleep(0.0001)
+        return value
+
+    def items(self):
+        for key in self.keys():
+            time.sleep(0.0001)
+            yield key, self[key]
+
+
+@pytest.mark.parametrize('name, state', [('sliding_window', 'counters'), ('gcra', 'arrival_times')])
+def test_local_throttles_are_thread_safe(name, state):
+    throttle = create_throttle(name, None, rate=0.001, burst=50)
+    setattr(throttle, state, SwitchingDict())
+    with ThreadPoolExecutor(20) as executor:
+        shared = list(executor.map(lambda _: throttle.allow_request('shared'), range(200)))
+    assert shared.count(True) == 50
+
+    # small enough to rebuild the dicts of the rejected and counted keys while other threads use them
+    throttle.MaxWaitingKeys = 20
+    setattr(throttle, state, SwitchingDict())
+    with ThreadPoolExecutor(20) as executor:
+        list(executor.map(lambda index: throttle.allow_request(f'key-{index % 100}'), range(1000)))
+
+
+def test_hybrid_saves_round_trips():
+    redis = FakeRedis()
+    throttle = create_throttle('hybrid', redis, rate=1, burst=100)
+    assert all(run_sequence(throttle, 'hybrid', 100))
+    assert redis.calls <= 100 / throttle.lease_size + 1
+
+
+# script calls replayed on redis and on the port of the script, timestamps are arguments so both see the same
+SCRIPT_CALLS = {
+    'token_bucket': [(TokenBucketThrottle.Lua, ['bucket'], [10, 5, 1, 1000 + 37 * index]) for index in range(12)]
+    + [(TokenBucketThrottle.Lua, ['bucket'], [10, 5, 1, 2000])],
+    'hybrid': [(HybridTokenBucketThrottle.LeaseLua, ['lease'], [10, 20, 8, 1000 + 100 * index]) for index in range(4)]
+    + [(HybridTokenBucketThrottle.ReturnLua, ['lease'], [20, 3]),
+       (HybridTokenBucketThrottle.LeaseLua, ['lease'], [10, 20, 8, 1400])],
+    'sliding_window': [(SlidingWindowThrottle.Lua, ['window:1', 'window:0'], [5, 1000, 100 * index])
+                       for index in range(7)]
+    + [(SlidingWindowThrottle.Lua, ['window:2', 'window:1'], [5, 1000, 300 + 100 * index]) for index in range(5)],
+    'gcra': [(GCRAThrottle.Lua, ['gcra'], [100.0, 400.0, 1000.0 + 30 * index]) for index in range(10)]
+    + [(GCRAThrottle.Lua, ['gcra'], [100.0, 400.0, 2000.0])],
+}
+
+
+def normalize_reply(reply: Any) -> Any:
+    if isinstance(reply, bytes):
+        return reply.decode('utf-8')
+    if isinstance(reply, list):
+        return [normalize_reply(item) for item in reply]
+    return reply
+
+
+@pytest.mark.parametrize('name', sorted(SCRIPT_CALLS))
+def test_ports_reply_like_the_scripts(name, redis_server):
+    fake = FakeRedis()
+    for script, keys, args in SCRIPT_CALLS[name]:
+        expected = normalize_reply(redis_server.register_script(script)(keys, args))
+        actual = fake.register_script(script)(keys, args)
+        if isinstance(actual, list):
+            # the token bucket script replies some debugging values after the ones the throttle reads
+            expected = expected[:len(actual)]
+        assert actual == expected, (script.strip().splitlines()[0], keys, args)
+
+
+def test_benchmark():
+    result = benchmark(create_throttle('gcra', FakeRedis(), rate=1000, burst=100), keys=100, concurrency=4,
+                       requests=400)
+    assert result['decisions_per_second'] > 0
+    assert result['p50_ms'] <= result['p99_ms']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='throttle benchmark')
+    parser.add_argument('--redis', help='host:port of a redis-server, the in-process stand-in by default')
+    parser.add_argument('--latency', type=float, default=0.0, help='round trip seconds of the stand-in')
+    parser.add_argument('--requests', type=int, default=20000, help='decisions per run')
+    parser.add_argument('--rate', type=float, default=1000.0)
+    parser.add_argument('--burst', type=int, default=100)
+    parser.add_argument('--throttles', default=','.join(THROTTLE_NAMES))
+    parser.add_argument('--keys', default='1,100,10000')
+    parser.add_argument('--concurrency', default='1,16,64')
+    options = parser.parse_args()
+
+    def new_redis():
+        if options.redis:
+            host, _, port = options.redis.partition(':')
+            redis = Redis(host=host, port=int(port or 6379))
+            redis.flushdb()
+            return redis
+        return FakeRedis(options.latency)
+
+    print(f'{"throttle":<16}{"keys":>8}{"workers":>9}{"decisions/s":>14}{"p50 ms":>10}{"p99 ms":>10}')
+    for name in options.throttles.split(','):
+        for keys in (int(keys) for keys in options.keys.split(',')):
+            for concurrency in (int(concurrency) for concurrency in options.concurrency.split(',')):
+                throttle = create_throttle(name, new_redis(), options.rate, options.burst)
+                result = benchmark(throttle, keys, concurrency, options.requests)
+                print(f'{name:<16}{keys:>8}{concurrency:>9}{result["decisions_per_second"]:>14.0f}'
+                      f'{result["p50_ms"]:>10.3f}{result["p99_ms"]:>10.3f}')
+
+    print()
+    print(f'{"throttle":<16}{"rate":>8}{"burst":>8}{"allowed":>10}{"expected":>10}')
+    for name in options.throttles.split(','):
+        rate, burst, duration = 100, 20, 2.0
+        allowed = measure_rate(create_throttle(name, new_redis(), rate, burst), 'accuracy', duration)
+        print(f'{name:<16}{rate:>8}{burst:>8}{allowed:>10}{burst + rate * duration:>10.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,36 @@
+import asyncio
+import functools
+import threading
 import time
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Dict, Optional, Mapping
 
 
 from redis import Redis
 from logger.log import gen_log
 
+# route metadata keys, set when the instance is registered
+THROTTLING_METADATA = 'throttling'
+THROTTLE_METADATA = 'throttle'
+THROTTLE_RATE_METADATA = 'throttle_rate'
+THROTTLE_BURST_METADATA = 'throttle_burst'
+
 """
 GateWay 限流实现模块
 """
 class BaseThrottle:
     """
        Rate throttling of requests.
+       The synchronous throttles are called from the threads of an executor, their state in
+       process is only changed while holding ``lock``
        """
+    # rejected keys remembered for wait(), swept beyond this size
+    MaxWaitingKeys = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> time.monotonic() at which the key may send the next request
+        self.next_allowed = dict()  # type: Dict[str, float]
 
     def allow_request(self, key):
         """
@@ -21,25 +41,38 @@ class BaseThrottle:
     def get_key(self, ident):
         pass
 
-    def throttle_success(self) -> bool:
+    def throttle_success(self, key=None) -> bool:
         """
         Inserts the current request's timestamp along with the key
         into the cache.
         """
+        if key is not None:
+            with self.lock:
+                self.next_allowed.pop(key, None)
         return True
 
-    def throttle_failure(self) -> bool:
+    def throttle_failure(self, key=None, wait: float = None) -> bool:
         """
-        Called when a request to the API has failed due to throttling.
+        Called when a request to the API has failed due to throttling,
+        ``wait`` is the number of seconds until the key is allowed again.
         """
+        if key is not None and wait is not None:
+            now = time.monotonic()
+            with self.lock:
+                if len(self.next_allowed) >= self.MaxWaitingKeys:
+                    self.next_allowed = {k: until for k, until in self.next_allowed.items() if until > now}
+                self.next_allowed[key] = now + max(0.0, wait)
         return False
 
-    def wait(self):
+    def wait(self, key=None):
         """
         Optionally, return a recommended number of seconds to wait before
-        the next request.
+        the next request of the last rejected ``key``.
         """
-        return None
+        until = self.next_allowed.get(key)
+        if until is None:
+            return None
+        return max(0.0, until - time.monotonic())
 
 
 class TokenBucketThrottle(BaseThrottle):
@@ -89,20 +122,377 @@ class TokenBucketThrottle(BaseThrottle):
     
     """
 
-    def __init__(self, redis=Redis()):
+    def __init__(self, redis=Redis(), rate: float = ReplenishRate, capacity: float = BurstCapacity):
+        super(TokenBucketThrottle, self).__init__()
         self.redis = redis
+        self.rate = rate
+        self.capacity = capacity
+        # registered once, the script object sends EVALSHA and loads the script again when needed
+        self.script = redis.register_script(TokenBucketThrottle.Lua) if redis is not None else None
 
     def allow_request(self, key):
 
         if self.redis is None:
             return self.throttle_failure()
-        cmd = self.redis.register_script(TokenBucketThrottle.Lua)
+        cmd = self.script
         timestamp = int(round(time.time() * 1000))
-        result = cmd([key], [TokenBucketThrottle.ReplenishRate, TokenBucketThrottle.BurstCapacity, TokenBucketThrottle.TokenReqPerTime, timestamp])
+        result = cmd([key], [self.rate, self.capacity, TokenBucketThrottle.TokenReqPerTime, timestamp])
         gen_log.debug(result)
         if len(result) > 0:
             if result[0] == 1:
-                return self.throttle_success()
+                return self.throttle_success(key)
+            return self.throttle_failure(key, (TokenBucketThrottle.TokenReqPerTime - float(result[1])) / self.rate)
+        return self.throttle_failure()
+
+
+class LocalTokenBucket:
+    """token bucket held in process, ``rate`` tokens per second up to ``capacity``"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+
+    def take(self, tokens: float = 1) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def wait(self, tokens: float = 1) -> float:
+        """seconds until ``tokens`` are available"""
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+
+class _TokenLease:
+
+    def __init__(self):
+        self.tokens = 0
+        self.leased_at = 0.0
+        # while the redis bucket is empty requests are rejected locally
+        self.empty_until = 0.0
+        self.future = None  # type: Optional[asyncio.Future]
+
+
+class HybridTokenBucketThrottle(BaseThrottle):
+    """
+    Token bucket shared through redis without a redis round trip per request.
+    Every gateway leases batches of ``lease_size`` tokens from the redis bucket (same hash as
+    :class:`TokenBucketThrottle`) and serves requests from the lease, the next batch is fetched in the
+    background when the lease runs low. Leases older than ``lease_ttl`` give their tokens back to redis,
+    so the limit stays global within a lease per gateway.
+    When redis can not be reached, ``fail_open`` throttles with a local bucket of the same rate instead
+    of rejecting every request
+    """
+    LeaseLua = """
+        local key = KEYS[1]
+
+        local replenish_rate = tonumber(ARGV[1])
+        local capacity = tonumber(ARGV[2])
+        local req_token_num = tonumber(ARGV[3])
+        local now_micros = tonumber(ARGV[4])
+
+        local last_token_num = tonumber(redis.call("HGET", key, "token_num_key"))
+        if last_token_num == nil then
+            last_token_num = capacity
+        end
+
+        local last_refresh_time = tonumber(redis.call("HGET", key, "last_timestamp_key"))
+        if last_refresh_time == nil then
+            last_refresh_time = 0
+        end
+
+        local delta = math.max(0, now_micros - last_refresh_time)
+        local filled_token_num = math.min(capacity, last_token_num + (delta / 1000) * replenish_rate)
+        local granted = math.min(req_token_num, math.floor(filled_token_num))
+
+        redis.call("HSET", key, "token_num_key", filled_token_num - granted)
+        redis.call("HSET", key, "last_timestamp_key", now_micros)
+        redis.call("EXPIRE", key, math.ceil(capacity / replenish_rate) + 1)
+
+        return granted
+    """
+
+    ReturnLua = """
+        local key = KEYS[1]
+
+        local capacity = tonumber(ARGV[1])
+        local returned = tonumber(ARGV[2])
+
+        local last_token_num = tonumber(redis.call("HGET", key, "token_num_key"))
+        if last_token_num ~= nil then
+            redis.call("HSET", key, "token_num_key", math.min(capacity, last_token_num + returned))
+        end
+        return 0
+    """
+
+    # leases and returns go through the blocking redis client
+    executor = ThreadPoolExecutor(8)
+
+    def __init__(self, redis=None, rate: float = TokenBucketThrottle.ReplenishRate,
+                 capacity: float = TokenBucketThrottle.BurstCapacity, lease_size: int = 10,
+                 lease_ttl: float = 1.0, fail_open: bool = True, retry_interval: float = 5.0):
+        super(HybridTokenBucketThrottle, self).__init__()
+        self.redis = redis
+        self.rate = rate
+        self.capacity = capacity
+        # a lease never holds more than the whole bucket
+        self.lease_size = max(1, min(lease_size, int(capacity)))
+        self.lease_ttl = lease_ttl
+        self.fail_open = fail_open
+        self.retry_interval = retry_interval
+        self.lease_script = redis.register_script(self.LeaseLua) if redis is not None else None
+        self.return_script = redis.register_script(self.ReturnLua) if redis is not None else None
+        self.leases = dict()  # type: Dict[str, _TokenLease]
+        self.local_buckets = dict()  # type: Dict[str, LocalTokenBucket]
+        # redis is not asked again before this time once it failed
+        self.redis_down_until = 0.0 if redis is not None else float('inf')
+        self.reconcile_task = None  # type: Optional[asyncio.Task]
+
+    async def allow_request(self, key):
+        now = time.monotonic()
+        if now < self.redis_down_until:
+            return self.allow_local(key)
+        if self.reconcile_task is None:
+            self.reconcile_task = asyncio.ensure_future(self._reconcile_loop())
+
+        lease = self.leases.get(key)
+        if lease is None:
+            lease = self.leases[key] = _TokenLease()
+        if lease.tokens >= 1:
+            lease.tokens -= 1
+            if lease.tokens < self.lease_size / 2 and lease.future is None and now >= lease.empty_until:
+                # fetch the next batch before this one runs out
+                self._start_lease(key, lease)
+            return self.throttle_success(key)
+        if now < lease.empty_until:
+            return self.throttle_failure(key, lease.empty_until - now)
+
+        if lease.future is None:
+            self._start_lease(key, lease)
+        try:
+            await asyncio.shield(lease.future)
+        except Exception:
+            return self.allow_local(key) if self.fail_open else self.throttle_failure()
+        if lease.tokens >= 1:
+            lease.tokens -= 1
+            return self.throttle_success(key)
+        return self.throttle_failure(key, max(0.0, lease.empty_until - time.monotonic()) or 1 / self.rate)
 
+    def allow_local(self, key) -> bool:
+        if not self.fail_open:
+            return self.throttle_failure()
+        bucket = self.local_buckets.get(key)
+        if bucket is None:
+            bucket = self.local_buckets[key] = LocalTokenBucket(self.rate, self.capacity)
+        if bucket.take():
+            return self.throttle_success(key)
+        return self.throttle_failure(key, bucket.wait())
+
+    def _start_lease(self, key: str, lease: '_TokenLease'):
+        lease.future = asyncio.ensure_future(self._lease(key, lease))
+        # a failed background lease is logged in _lease already
+        lease.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+    async def _lease(self, key: str, lease: '_TokenLease'):
+        try:
+            loop = asyncio.get_event_loop()
+            timestamp = int(round(time.time() * 1000))
+            granted = await loop.run_in_executor(self.executor, functools.partial(
+                self.lease_script, [key], [self.rate, self.capacity, self.lease_size, timestamp]))
+            granted = int(granted)
+            lease.tokens += granted
+            lease.leased_at = time.monotonic()
+            if granted < self.lease_size:
+                # redis bucket is drained, wait until a whole batch has been replenished
+                lease.empty_until = lease.leased_at + (self.lease_size - granted) / self.rate
+        except Exception as ex:
+            gen_log.warning(f'token lease of {key} failed, throttle locally: {ex}')
+            self.redis_down_until = time.monotonic() + self.retry_interval
+            raise
+        finally:
+            lease.future = None
+
+    async def _reconcile_loop(self):
+        while True:
+            await asyncio.sleep(self.lease_ttl)
+            try:
+                await self.reconcile()
+            except Exception as ex:
+                gen_log.warning(f'token lease reconcile failed: {ex}')
+
+    async def reconcile(self):
+        """give the tokens of expired leases back to redis and forget idle keys"""
+        now = time.monotonic()
+        expired = [(key, lease) for key, lease in self.leases.items()
+                   if lease.future is None and now - lease.leased_at >= self.lease_ttl and now >= lease.empty_until]
+        loop = asyncio.get_event_loop()
+        for key, lease in expired:
+            self.leases.pop(key, None)
+            if lease.tokens >= 1 and now >= self.redis_down_until:
+                await loop.run_in_executor(self.executor, functools.partial(
+                    self.return_script, [key], [self.capacity, int(lease.tokens)]))
+        if now >= self.redis_down_until:
+            # redis is back, local buckets are only used while it is down
+            self.local_buckets.clear()
+
+
+class SlidingWindowThrottle(BaseThrottle):
+    """
+    Sliding window counter, at most ``limit`` requests per ``window`` seconds. The count of the previous
+    fixed window is weighted by how much of it still overlaps the sliding window, so a key costs two
+    counters instead of a timestamp per request. Without redis the counters are kept in process
+    """
+    Lua = """
+        local current_key = KEYS[1]
+        local previous_key = KEYS[2]
+
+        local limit = tonumber(ARGV[1])
+        local window = tonumber(ARGV[2])
+        local elapsed = tonumber(ARGV[3])
+
+        local current = tonumber(redis.call("GET", current_key)) or 0
+        local previous = tonumber(redis.call("GET", previous_key)) or 0
+        local weight = (window - elapsed) / window
+
+        if previous * weight + current + 1 > limit then
+            return {0, current, previous}
+        end
+        current = redis.call("INCR", current_key)
+        if current == 1 then
+            redis.call("PEXPIRE", current_key, math.ceil(window * 2))
+        end
+        return {1, current, previous}
+    """
+
+    def __init__(self, redis=None, limit: int = TokenBucketThrottle.ReplenishRate, window: float = 1.0):
+        super(SlidingWindowThrottle, self).__init__()
+        self.redis = redis
+        self.limit = limit
+        self.window = window
+        self.script = redis.register_script(SlidingWindowThrottle.Lua) if redis is not None else None
+        # key -> [window index, previous count, current count]
+        self.counters = dict()  # type: Dict[str, list]
+
+    def allow_request(self, key):
+        now = time.time()
+        index = int(now // self.window)
+        elapsed = now - index * self.window
+        if self.redis is None:
+            with self.lock:
+                allowed, current, previous = self._count_local(key, index, elapsed)
+        else:
+            allowed, current, previous = self.script([f'{key}:{index}', f'{key}:{index - 1}'],
+                                                     [self.limit, int(self.window * 1000), int(elapsed * 1000)])
+        if allowed == 1:
+            return self.throttle_success(key)
+        return self.throttle_failure(key, self._wait(int(current), int(previous), elapsed))
+
+    def _count_local(self, key: str, index: int, elapsed: float):
+        counter = self.counters.get(key)
+        if counter is None or counter[0] < index - 1:
+            if len(self.counters) >= self.MaxWaitingKeys:
+                self.counters = {k: c for k, c in self.counters.items() if c[0] >= index - 1}
+            counter = self.counters[key] = [index, 0, 0]
+        elif counter[0] == index - 1:
+            counter[:] = [index, counter[2], 0]
+        weight = (self.window - elapsed) / self.window
+        if counter[1] * weight + counter[2] + 1 > self.limit:
+            return 0, counter[2], counter[1]
+        counter[2] += 1
+        return 1, counter[2], counter[1]
 
+    def _wait(self, current: int, previous: int, elapsed: float) -> float:
+        """seconds until the weighted count leaves room for one more request"""
+        room = self.limit - 1 - current
+        if room >= 0 and previous > 0:
+            # the previous window slides out of the sliding window
+            return max(0.0, self.window * (1 - room / previous) - elapsed)
+        # the current window is full, its count only starts to fade in the next one
+        next_room = self.limit - 1
+        wait = self.window - elapsed
+        if current > next_room:
+            wait += self.window * (1 - next_room / current)
+        return wait
 
+
+class GCRAThrottle(BaseThrottle):
+    """
+    Generic cell rate algorithm, ``rate`` requests per second with bursts of ``burst`` requests.
+    A key is a single value, its theoretical arrival time, which expires as soon as the key is
+    back to a full burst. Without redis the arrival times are kept in process
+    """
+    Lua = """
+        local key = KEYS[1]
+
+        local emission_interval = tonumber(ARGV[1])
+        local burst_tolerance = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+
+        local tat = tonumber(redis.call("GET", key)) or now
+        tat = math.max(tat, now)
+        local new_tat = tat + emission_interval
+        local allow_at = new_tat - burst_tolerance
+        if now < allow_at then
+            return {0, string.format("%.3f", allow_at - now)}
+        end
+        redis.call("SET", key, string.format("%.3f", new_tat), "PX", math.max(1, math.ceil(new_tat - now)))
+        return {1, "0"}
+    """
+
+    def __init__(self, redis=None, rate: float = TokenBucketThrottle.ReplenishRate,
+                 burst: int = TokenBucketThrottle.BurstCapacity):
+        super(GCRAThrottle, self).__init__()
+        self.redis = redis
+        self.rate = rate
+        self.burst = max(1, burst)
+        # milliseconds between two requests and the advance a burst may take on them
+        self.emission_interval = 1000.0 / rate
+        self.burst_tolerance = self.emission_interval * self.burst
+        self.script = redis.register_script(GCRAThrottle.Lua) if redis is not None else None
+        self.arrival_times = dict()  # type: Dict[str, float]
+
+    def allow_request(self, key):
+        now = time.time() * 1000
+        if self.redis is None:
+            with self.lock:
+                allowed, wait = self._allow_local(key, now)
+        else:
+            allowed, wait = self.script([key], [self.emission_interval, self.burst_tolerance, now])
+        if int(allowed) == 1:
+            return self.throttle_success(key)
+        return self.throttle_failure(key, float(wait) / 1000)
+
+    def _allow_local(self, key: str, now: float):
+        tat = max(self.arrival_times.get(key, now), now)
+        allow_at = tat + self.emission_interval - self.burst_tolerance
+        if now < allow_at:
+            return 0, allow_at - now
+        if len(self.arrival_times) >= self.MaxWaitingKeys:
+            self.arrival_times = {k: t for k, t in self.arrival_times.items() if t > now}
+        self.arrival_times[key] = tat + self.emission_interval
+        return 1, 0
+
+
+THROTTLES = {
+    'token_bucket': TokenBucketThrottle,
+    'sliding_window': SlidingWindowThrottle,
+    'gcra': GCRAThrottle,
+}
+
+
+def is_throttled(metadata: Mapping[str, str]) -> bool:
+    """
+    :return: whether the requests of an instance are throttled, ``throttling`` metadata turns it on or off,
+             without it an instance naming its ``throttle`` algorithm is throttled
+    """
+    throttling = metadata.get(THROTTLING_METADATA)
+    if throttling is not None:
+        if isinstance(throttling, str):
+            return throttling.strip().lower() in ('true', '1', 'yes')
+        return bool(throttling)
+    return metadata.get(THROTTLE_METADATA) in THROTTLES
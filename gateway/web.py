@@ -3,12 +3,13 @@
 @Time : 2021/5/25 13:28 
 @Author : Peaker
 """
+import asyncio
 import collections
 import typing
 from http.cookies import Morsel, SimpleCookie
-from typing import Dict, Union, Any, List, Iterator
+from typing import Dict, Union, Any, List, Iterator, Optional, Awaitable
 
-from tornado.httputil import HTTPServerRequest, HTTPHeaders, HTTPFile
+from tornado.httputil import HTTPServerRequest, HTTPHeaders, HTTPFile, parse_body_arguments
 from tornado.web import RequestHandler
 
 GATEWAY_ROUTE_ATTR = 'gatewayRoute'
@@ -16,6 +17,14 @@ GATEWAY_REQUEST_ROUTE_ATTR = 'targetGatewayRoute'
 MICRO_SERVICE_NAME = 'microServiceName'
 REQUEST_METHOD_NAME = 'methodName'
 MICRO_SERVICE_VERSION = 'microServiceVersion'
+REQUEST_DEADLINE_ATTR = 'requestDeadline'
+# set when the upstream response is shared by clients, it is asked for unencoded, each client gets
+# it compressed on the way out
+UPSTREAM_IDENTITY_ATTR = 'upstreamIdentityEncoding'
+
+# hop-by-hop headers are never forwarded between client and upstream
+HOP_BY_HOP_HEADERS = frozenset(['Connection', 'Keep-Alive', 'Proxy-Authenticate', 'Proxy-Authorization',
+                                'Te', 'Trailer', 'Transfer-Encoding', 'Upgrade'])
 
 
 class ServerWebExchange:
@@ -32,6 +41,10 @@ class ServerWebExchange:
     def set_attributes(self, key: str, value: Any):
         raise NotImplementedError()
 
+    def mutate(self, response: 'ServerHttpResponse' = None) -> 'ServerWebExchange':
+        """:return: exchange of the same request with another response and a copy of the attributes"""
+        raise NotImplementedError()
+
 
 class ServerHTTPHeaders(dict):
     pass
@@ -72,6 +85,17 @@ class ServerHttpRequest:
     def get_header(self) -> ServerHTTPHeaders:
         pass
 
+    def is_streaming(self) -> bool:
+        """request body is not buffered, read it from ``get_body_stream``"""
+        return False
+
+    def get_body_stream(self) -> Optional['RequestBodyStream']:
+        return None
+
+    async def read_body(self) -> bytes:
+        """read the whole body, parse form arguments and files of a streamed body"""
+        raise NotImplementedError()
+
 
 class ServerHttpResponse:
 
@@ -93,6 +117,88 @@ class ServerHttpResponse:
     def set_response_body(self, body: Union[str, bytes, dict]):
         raise NotImplementedError()
 
+    def set_header(self, name: str, value: str):
+        raise NotImplementedError()
+
+    def add_header(self, name: str, value: str):
+        raise NotImplementedError()
+
+    def clear_header(self, name: str):
+        raise NotImplementedError()
+
+    def get_headers(self) -> 'HTTPHeaders':
+        raise NotImplementedError()
+
+    def write(self, chunk: bytes) -> Awaitable[None]:
+        """send a chunk of the body to the client right away, headers are sent with the first chunk"""
+        raise NotImplementedError()
+
+    def is_streaming(self) -> bool:
+        """body has been partly sent with ``write``, status and headers can not be changed any more"""
+        raise NotImplementedError()
+
+
+class RequestBodyStream:
+    """
+    Request body chunks in flight between ~.RequestHandler.data_received and the upstream body producer.
+    ``put`` waits while ``max_buffer_size`` bytes are buffered, so a slow upstream slows the client down
+    """
+
+    def __init__(self, max_buffer_size: int = 1024 * 1024):
+        self.max_buffer_size = max_buffer_size
+        self.chunks = collections.deque()
+        self.buffer_size = 0
+        self.finished = False
+        self.discarded = False
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    async def put(self, chunk: bytes):
+        if self.discarded:
+            return
+        self.chunks.append(chunk)
+        self.buffer_size += len(chunk)
+        self._readable.set()
+        if self.buffer_size >= self.max_buffer_size:
+            self._writable.clear()
+            await self._writable.wait()
+
+    def finish(self):
+        self.finished = True
+        self._readable.set()
+
+    def discard(self):
+        """nobody reads the rest of the body, drop it"""
+        self.discarded = True
+        self.chunks.clear()
+        self.buffer_size = 0
+        self._writable.set()
+
+    async def read(self) -> Optional[bytes]:
+        """
+        :return: next chunk, None at the end of the body
+        """
+        while not self.chunks:
+            if self.finished or self.discarded:
+                return None
+            self._readable.clear()
+            await self._readable.wait()
+        chunk = self.chunks.popleft()
+        self.buffer_size -= len(chunk)
+        if self.buffer_size < self.max_buffer_size:
+            self._writable.set()
+        return chunk
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        chunk = await self.read()
+        if chunk is None:
+            raise StopAsyncIteration()
+        return chunk
+
 
 class DefaultServerWebExchange(ServerWebExchange):
 
@@ -113,6 +219,11 @@ class DefaultServerWebExchange(ServerWebExchange):
     def set_attributes(self, name: str, value: Any):
         self.attributes[name] = value
 
+    def mutate(self, response: 'ServerHttpResponse' = None) -> 'ServerWebExchange':
+        exchange = DefaultServerWebExchange(self.server_http_request, response or self.server_http_response)
+        exchange.attributes = dict(self.attributes)
+        return exchange
+
 
 class TornadoServerHttpHeaders(ServerHTTPHeaders):
     pass
@@ -123,6 +234,7 @@ class TornadoServerHttpResponse(ServerHttpResponse):
     def __init__(self, request_handler: 'RequestHandler'):
         self.request_handler = request_handler
         self.response_body = None
+        self.streaming = False
 
     def get_response_body(self) -> Union[str, bytes, dict]:
         return self.response_body
@@ -133,8 +245,8 @@ class TornadoServerHttpResponse(ServerHttpResponse):
     def get_status_code(self) -> int:
         return self.request_handler.get_status()
 
-    def set_status_code(self, status_code: int):
-        self.request_handler.set_status(status_code=status_code)
+    def set_status_code(self, status_code: int, reason: str = None):
+        self.request_handler.set_status(status_code, reason=reason)
 
     def get_cookies(self) -> Dict[str, Morsel]:
         return self.request_handler.cookies
@@ -142,11 +254,120 @@ class TornadoServerHttpResponse(ServerHttpResponse):
     def add_cookies(self, key, cookie):
         self.request_handler.cookies[key] = cookie
 
+    def set_header(self, name: str, value: str):
+        self.request_handler.set_header(name, value)
+
+    def add_header(self, name: str, value: str):
+        self.request_handler.add_header(name, value)
+
+    def clear_header(self, name: str):
+        self.request_handler.clear_header(name)
+
+    def get_headers(self) -> 'HTTPHeaders':
+        return self.request_handler._headers
+
+    def write(self, chunk: bytes) -> Awaitable[None]:
+        self.streaming = True
+        self.request_handler.write(chunk)
+        return self.request_handler.flush()
+
+    def is_streaming(self) -> bool:
+        return self.streaming
+
+
+class RecordingServerHttpResponse(ServerHttpResponse):
+    """
+    Keeps a copy of status, headers and body of a response, every call is passed on to ``response``.
+    Without ``response`` the response only ends up in the copy.
+    Recording stops once the body grows beyond ``max_body_size``
+    """
+
+    def __init__(self, response: 'ServerHttpResponse' = None, max_body_size: int = None):
+        self.response = response
+        self.max_body_size = max_body_size
+        self.status_code = 200
+        self.reason = None
+        self.headers = HTTPHeaders()
+        self.response_body = None
+        self.chunks = list()  # type: List[bytes]
+        self.chunks_size = 0
+        self.streaming = False
+        self.truncated = False
+
+    def get_status_code(self) -> int:
+        return self.response.get_status_code() if self.response is not None else self.status_code
+
+    def set_status_code(self, status_code: int, reason: str = None):
+        self.status_code = status_code
+        self.reason = reason
+        if self.response is not None:
+            self.response.set_status_code(status_code, reason)
+
+    def get_cookies(self) -> SimpleCookie:
+        return self.response.get_cookies() if self.response is not None else SimpleCookie()
+
+    def add_cookies(self, key, cookie):
+        if self.response is not None:
+            self.response.add_cookies(key, cookie)
+
+    def get_response_body(self):
+        return self.response.get_response_body() if self.response is not None else self.response_body
+
+    def set_response_body(self, body: Union[str, bytes, dict]):
+        self.response_body = body
+        if self.response is not None:
+            self.response.set_response_body(body)
+
+    def set_header(self, name: str, value: str):
+        self.headers[name] = value
+        if self.response is not None:
+            self.response.set_header(name, value)
+
+    def add_header(self, name: str, value: str):
+        self.headers.add(name, value)
+        if self.response is not None:
+            self.response.add_header(name, value)
+
+    def clear_header(self, name: str):
+        if name in self.headers:
+            del self.headers[name]
+        if self.response is not None:
+            self.response.clear_header(name)
+
+    def get_headers(self) -> 'HTTPHeaders':
+        return self.response.get_headers() if self.response is not None else self.headers
+
+    def write(self, chunk: bytes) -> Awaitable[None]:
+        self.streaming = True
+        if not self.truncated:
+            self.chunks.append(chunk)
+            self.chunks_size += len(chunk)
+            if self.max_body_size is not None and self.chunks_size > self.max_body_size:
+                self.truncated = True
+                self.chunks = list()
+        if self.response is not None:
+            return self.response.write(chunk)
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(None)
+        return future
+
+    def is_streaming(self) -> bool:
+        return self.response.is_streaming() if self.response is not None else self.streaming
+
+    def get_recorded_body(self) -> Union[str, bytes, dict, None]:
+        """:return: the body set or written, None when it has grown too large"""
+        if self.truncated:
+            return None
+        if self.streaming:
+            return b''.join(self.chunks)
+        return self.response_body
+
 
 class TornadoServerHttpRequest(ServerHttpRequest):
 
-    def __init__(self, request: 'HTTPServerRequest'):
+    def __init__(self, request: 'HTTPServerRequest', body_stream: 'RequestBodyStream' = None):
         self.http_request = request
+        self.body_stream = body_stream
 
     def get_remote_ip(self):
         remote_ip = self.http_request.headers.get('Remoteip')
@@ -176,6 +397,23 @@ class TornadoServerHttpRequest(ServerHttpRequest):
     def get_body(self):
         return self.http_request.body
 
+    def is_streaming(self) -> bool:
+        return self.body_stream is not None
+
+    def get_body_stream(self) -> Optional['RequestBodyStream']:
+        return self.body_stream
+
+    async def read_body(self) -> bytes:
+        if self.body_stream is not None and not self.http_request.body:
+            body = b''.join([chunk async for chunk in self.body_stream])
+            self.http_request.body = body
+            parse_body_arguments(self.http_request.headers.get('Content-Type', ''), body,
+                                 self.http_request.body_arguments, self.http_request.files,
+                                 self.http_request.headers)
+            for name, values in self.http_request.body_arguments.items():
+                self.http_request.arguments.setdefault(name, []).extend(values)
+        return self.http_request.body
+
     def get_files(self) -> Dict[str, List["HTTPFile"]]:
         return self.http_request.files
 
@@ -8,7 +8,7 @@ import os
 import yaml
 
 from ctx.config import ENV_YAML_DIC, CURRENT_ENV, AbsConfigOption, \
-    create_app_config, create_discovery_config, create_redis_config
+    create_app_config, create_discovery_config, create_redis_config, create_rpc_server_config
 
 
 class ConfigOption(AbsConfigOption):
@@ -26,3 +26,4 @@ class ConfigOption(AbsConfigOption):
         self.app_config = create_app_config(app_config_info)
         self.discovery_config = create_discovery_config(app_config_info)
         self.redis_config = create_redis_config(app_config_info)
+        self.rpc_server_config = create_rpc_server_config(app_config_info)
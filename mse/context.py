@@ -3,7 +3,7 @@
 @Time : 2021/6/17 16:07 
 @Author : Peaker
 """
-from ctx.config import CURRENT_ENV, DiscoveryConfig, RedisConfig
+from ctx.config import CURRENT_ENV, DiscoveryConfig, RedisConfig, RpcServerConfig
 from ctx.context import ConfApplicationContext
 from mse.config import ConfigOption
 
@@ -31,6 +31,9 @@ class ApplicationContext(ConfApplicationContext):
     def get_redis_config(self) -> 'RedisConfig':
         return self.config_option.get_redis_config()
 
+    def get_rpc_server_config(self) -> 'RpcServerConfig':
+        return self.config_option.get_rpc_server_config()
+
 
 def create_app_context(config_path: 'str') -> 'ApplicationContext':
     return ApplicationContext(config_path)
@@ -1,6 +1,7 @@
 import json
 
 from kazoo.client import KazooClient
+from kazoo.exceptions import NoNodeError
 
 from discovery.instance import ServiceInstance
 from discovery.service import ServiceProvider
@@ -17,6 +18,13 @@ class ZookeeperServiceRegistry(ServiceProvider):
         service_data = json.dumps(service, default=lambda x: x.__dict__)
         self.zookeeper.set(path, service_data)
 
+    def unregister_service(self, service: 'ServiceInstance') -> None:
+        path = f'{self.root_path}/{service.get_service_id()}/{service.get_instance_id()}'
+        try:
+            self.zookeeper.delete(path)
+        except NoNodeError:
+            pass
+
     def start(self) -> None:
         self.zookeeper.start()
 
@@ -4,15 +4,37 @@
 @Author : Peaker
 Flexible routing implementation for rpc.
 """
-from typing import Any
+from typing import Any, Dict, List, Optional, Tuple, Type
 
 from mse.rpc.rpcutil import RpcServerRequest, RpcMessageDelegate
 
 
 class RuleRouter:
+    """
+    Method name to handler table, compiled once from rules like tornado's:
+    ``(method, handler_class)`` or ``(method, handler_class, handler_kwargs)``
+    """
 
-    def find_handler(self, request: 'RpcServerRequest', **kwargs: Any) -> RpcMessageDelegate:
-        pass
+    def __init__(self, rules: List[tuple] = None):
+        self.rules = dict()  # type: Dict[str, Tuple[Type, Dict[str, Any]]]
+        if rules:
+            self.add_rules(rules)
 
-    def get_target_delegate(self) -> RpcMessageDelegate:
-        pass
+    def add_rules(self, rules: List[tuple]):
+        for rule in rules:
+            if len(rule) not in (2, 3):
+                raise ValueError(f'rpc rule must be (method, handler_class[, kwargs]): {rule!r}')
+            method, target = rule[0], rule[1]
+            self.rules[method] = (target, rule[2] if len(rule) == 3 else dict())
+
+    def find_handler(self, request: 'RpcServerRequest', **kwargs: Any) -> Optional[RpcMessageDelegate]:
+        """:return: delegate of the handler of ``request.method``, None when no handler serves it"""
+        rule = self.rules.get(request.method)
+        if rule is None:
+            return None
+        target, target_params = rule
+        return self.get_target_delegate(target, request, **target_params)
+
+    def get_target_delegate(self, target: Any, request: 'RpcServerRequest',
+                            **target_params: Any) -> RpcMessageDelegate:
+        raise NotImplementedError()
@@ -3,13 +3,20 @@
 @Time : 2021/6/18 10:12 
 @Author : Peaker
 """
+import asyncio
+import functools
+import inspect
 import json
+import os
+import signal
+import threading
 import time
 import uuid
 from concurrent.futures.thread import ThreadPoolExecutor
-from typing import Any, Dict, Optional, Type, Union
+from typing import Any, Callable, Dict, Optional, Tuple, Type, Union
 
 from redis import Redis
+from tornado.ioloop import IOLoop
 from tornado.routing import _RuleList
 from discovery.instance import ServiceInstance
 from exception.definition import CommonException
@@ -18,7 +25,13 @@ from logger.log import gen_log
 from mse.rpc.routing import RuleRouter
 from mse.rpc.rpcutil import RpcMessageDelegate, RpcServerRequest
 from mse.server import RouteType, Application
+from mse.supervisor import WorkerSupervisor
 from mse.utils import get_local_ip
+from rpc import redispool
+from rpc.message import decode_message, encode_message
+from rpc.redispool import AsyncRedisClient
+from rpc.redis import heartbeat_key
+from rpc.stream import StreamConsumer, stream_key, TRANSPORT_METADATA, TRANSPORT_STREAM, STREAM_MAX_LEN_METADATA
 from zookeeper.discovery import ZookeeperServiceInstance
 
 
@@ -29,6 +42,9 @@ class RequestHandler:
     directly and subclasses should not override ``__init__``
      (override`~RequestHandler.initialize` instead).
 
+    ``handle_request`` may be a coroutine, which runs on the IOLoop of the server,
+    or a plain method, which runs on the worker threads of the server.
+
     """
 
     def __init__(
@@ -38,17 +54,23 @@ class RequestHandler:
             **kwargs: 'Any'):
         self.server = server
         self.request = request
+        self._result = None  # type: Optional[Union[str, bytes, dict]]
         self.initialize(**kwargs)
 
     def initialize(self, **kwargs):
         """subclass override for initialization. Called for each request."""
         pass
 
-    def execute(self):
-        result = self.handler.handle_request()
+    async def execute(self) -> Union[str, bytes, dict]:
+        if inspect.iscoroutinefunction(self.handle_request):
+            result = await self.handle_request()
+        else:
+            result = await asyncio.get_event_loop().run_in_executor(self.server.thread_pool, self.handle_request)
+        return self._result if result is None else result
 
     def write(self, chunk: Union[str, bytes, dict]) -> None:
-        pass
+        """sets the reply, used when ``handle_request`` returns None"""
+        self._result = chunk
 
     def handle_request(self) -> Union[str, bytes, dict]:
         """subclass must implement the method for handle rpc request and return data"""
@@ -68,64 +90,276 @@ class _HandlerDelegate(RpcMessageDelegate):
         self.handler_class = handler_class
         self.handler_kwargs = handler_kwargs
 
-    def execute(self):
+    async def execute(self) -> Union[str, bytes, dict]:
         self.handler = self.handler_class(
             self.server, self.request, **self.handler_kwargs
         )
-        self.handler.execute()
+        return await self.handler.execute()
 
 
+# seconds between two heartbeats, the heartbeat key expires after three missed ones
+HEARTBEAT_INTERVAL = 5
+# seconds a reply waits for its caller
+REPLY_TTL = 60
+# replies written in one pipeline at most
+REPLY_BATCH_SIZE = 500
+# the forked process which registers the instance, the workers serving it follow
+REGISTRY_PROCESS_ID = 0
 
 
 class RpcServer(Application, RuleRouter):
+    """
+    Serves the ``handlers`` rules, ``(method, handler_class[, kwargs])``, for the requests of the gateway
+    and rpc clients. Requests are read in batches on an IOLoop and handled concurrently, at most
+    ``concurrency`` at once, the replies are written back in pipelines.
+    With ``processes`` above 1 the instance is registered by a forked process and served by that many
+    forked workers, which consume the same queue and are restarted when they die
+    """
 
     def __init__(self, handlers: '_RuleList' = None, config_path: 'str' = None):
         super(RpcServer, self).__init__(config_path=config_path)
+        RuleRouter.__init__(self, handlers)
         self.handlers = handlers
-        self.thread_pool = ThreadPoolExecutor(50)
+        self.rpc_server_config = self.context.get_rpc_server_config()
+        # sync handlers run on these threads
+        self.thread_pool = ThreadPoolExecutor(self.rpc_server_config.workers)
         host = self.context.get_redis_config().host
         pwd = self.context.get_redis_config().password
         self.redis = Redis(host=host, password=pwd, retry_on_timeout=True)
+        self.service_instance = None  # type: Optional[ServiceInstance]
+        # index of the forked worker, None in a single process
+        self.worker_id = None  # type: Optional[int]
+        self.stopping = False
+        self.async_redis = None  # type: Optional[AsyncRedisClient]
+        self.concurrency = None  # type: Optional[asyncio.Semaphore]
+        self.reply_queue = None  # type: Optional[asyncio.Queue]
 
     def start(self) -> None:
         if self.service_name is None:
             raise CommonException(CommonErrorCode.NameNoSetting_Error)
 
+        self.service_instance = self.create_service_instance()
+        if self.rpc_server_config.processes > 1:
+            self.start_prefork(self.rpc_server_config.processes, self.rpc_server_config.shutdown_timeout)
+            return
         self.service_registry.start()
-        self.service_registry.register_service(self.create_service_instance())
+        self.service_registry.register_service(self.service_instance)
+        self.start_heartbeat()
         self.listen()
 
-    def _create_channel(self):
-        return f'rpc:channel:{self.service_name}:{self.version}'
+    def start_prefork(self, processes: int, shutdown_timeout: float):
+        """
+        this process only supervises, the zookeeper client and heartbeat threads are started after the forks:
+        one process registers the instance and ``processes`` workers serve it, each with its heartbeat
+        """
+        supervisor = WorkerSupervisor(self._run_process, processes + 1, shutdown_timeout=shutdown_timeout)
+        # the instance leaves the routes before its workers stop reading
+        supervisor.run(on_stop=lambda: supervisor.stop_worker(REGISTRY_PROCESS_ID))
+
+    def _run_process(self, worker_id: int):
+        # the loop of the supervisor is not shared with the forked processes
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        if worker_id == REGISTRY_PROCESS_ID:
+            self._run_registry()
+        else:
+            self._run_worker(worker_id)
+
+    def _run_registry(self):
+        """keeps the instance registered until SIGTERM or until the supervisor has gone"""
+        stopped = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+        supervisor_pid = os.getppid()
+        self.service_registry.start()
+        try:
+            self.service_registry.register_service(self.service_instance)
+            while not stopped.wait(1) and os.getppid() == supervisor_pid:
+                pass
+            self.service_registry.unregister_service(self.service_instance)
+        finally:
+            self.service_registry.stop()
+
+    def _run_worker(self, worker_id: int):
+        self.worker_id = worker_id
+        signal.signal(signal.SIGTERM, lambda signum, frame: IOLoop.current().add_callback_from_signal(self.stop))
+        # the heartbeat stops with the last worker
+        self.start_heartbeat()
+        self.listen()
 
-    def listen(self):
-        self._read_message()
+    def stop(self):
+        """stops reading requests, the requests being handled are replied before :meth:`serve` returns"""
+        self.stopping = True
 
-    def _read_message(self):
+    def start_heartbeat(self):
+        """the gateway health check takes the instance out of the routes once the heartbeat key expires"""
+        heartbeat = threading.Thread(target=self._send_heartbeat, name='rpc-heartbeat', daemon=True)
+        heartbeat.start()
+
+    def _send_heartbeat(self):
+        key = heartbeat_key(self.service_name, self.service_instance.get_instance_id())
         while True:
             try:
-                channel, request = self.redis.brpop(self._create_channel())
-                self.thread_pool.submit(self._handle_request, request)
+                self.redis.set(key, int(time.time()), ex=HEARTBEAT_INTERVAL * 3)
             except Exception as ex:
                 gen_log.exception(ex)
-                time.sleep(5)
-
-    def _handle_request(self, request: 'Dict'):
-
-        return_id = request['id']
-        method = request['method']
-        kwargs = request['params']
-
-        request = RpcServerRequest(return_id=return_id, method=method, kwargs=kwargs)
+            time.sleep(HEARTBEAT_INTERVAL)
 
-        handler = self.find_handler(request)
-        # handler.
-
-    def find_handler(self, request: 'RpcServerRequest', **kwargs: Any) -> RpcMessageDelegate:
-        pass
+    def _create_channel(self):
+        # the queue the gateway and rpc.redis push to
+        return f'work:{self.service_name}:{self.version}'
 
-    def get_target_delegate(self) -> RpcMessageDelegate:
-        pass
+    def listen(self):
+        IOLoop.current().run_sync(self.serve)
+
+    async def serve(self):
+        """reads and handles requests until :meth:`stop`"""
+        redis_config = self.context.get_redis_config()
+        self.async_redis = redispool.get_async_redis(redis_config.host, password=redis_config.password,
+                                                     username=redis_config.user)
+        self.concurrency = asyncio.Semaphore(self.rpc_server_config.concurrency)
+        self.reply_queue = asyncio.Queue()
+        writer = asyncio.ensure_future(self._write_replies())
+        try:
+            if self.rpc_server_config.transport == TRANSPORT_STREAM:
+                await self._read_stream()
+            else:
+                await self._read_message()
+        finally:
+            writer.cancel()
+
+    async def _read_message(self):
+        key = self._create_channel()
+        batch_size = self.rpc_server_config.batch_size
+        block = max(1, int(self.rpc_server_config.block))
+        while not self.stopping:
+            try:
+                reply = await self.async_redis.brpop(key, block)
+                if reply is None:
+                    continue
+                messages = [reply[1]]
+                if batch_size > 1:
+                    # the oldest requests are at the tail, taken together with the one popped
+                    replies = await self.async_redis.pipeline([('MULTI',), ('LRANGE', key, 1 - batch_size, -1),
+                                                               ('LTRIM', key, 0, -batch_size), ('EXEC',)])
+                    messages.extend(reversed(replies[-1][0]))
+            except Exception as ex:
+                gen_log.exception(ex)
+                await asyncio.sleep(5)
+                continue
+            for message in messages:
+                await self._dispatch(message)
+        await self._drain()
+
+    async def _read_stream(self):
+        config = self.rpc_server_config
+        consumer_name = self.service_instance.get_instance_id()
+        if self.worker_id is not None:
+            # a dead worker is another consumer, its pending requests are claimed by the others
+            consumer_name = f'{consumer_name}:{self.worker_id}'
+        consumer = StreamConsumer(self.redis, stream_key(self.service_name, self.version),
+                                  consumer=consumer_name, batch_size=config.batch_size,
+                                  block=config.block, claim_idle=config.claim_idle,
+                                  max_deliveries=config.max_deliveries)
+        loop = asyncio.get_event_loop()
+        # the blocking reads get their own thread, busy sync handlers must not hold them up
+        reader = ThreadPoolExecutor(1)
+        await loop.run_in_executor(reader, consumer.create_group)
+        last_claim = time.monotonic()
+        while not self.stopping:
+            try:
+                messages = await loop.run_in_executor(reader, consumer.read)
+                if time.monotonic() - last_claim >= config.claim_idle / 2:
+                    # requests of servers which died before acking them
+                    messages.extend(await loop.run_in_executor(reader, consumer.claim))
+                    last_claim = time.monotonic()
+            except Exception as ex:
+                gen_log.exception(ex)
+                await asyncio.sleep(5)
+                continue
+            for message_id, message in messages:
+                # acked once the reply is written, requests of a dead server are delivered again
+                await self._dispatch(message, functools.partial(consumer.ack, message_id))
+        await self._drain()
+        await loop.run_in_executor(reader, consumer.flush_acks)
+
+    async def _drain(self):
+        """waits for the requests being handled and their replies"""
+        for _ in range(self.rpc_server_config.concurrency):
+            await self.concurrency.acquire()
+        await self.reply_queue.join()
+
+    async def _dispatch(self, message: bytes, on_replied: 'Callable[[], None]' = None):
+        try:
+            request = decode_message(message)
+        except ValueError as ex:
+            gen_log.error(f'bad rpc request: {ex}')
+            if on_replied is not None:
+                on_replied()
+            return
+        # reading stops while ``concurrency`` requests are being handled
+        await self.concurrency.acquire()
+        task = asyncio.ensure_future(self._handle_request(request, on_replied))
+        task.add_done_callback(lambda _: self.concurrency.release())
+
+    async def _handle_request(self, message: 'Dict', on_replied: 'Callable[[], None]' = None):
+        request = RpcServerRequest(return_id=message['id'], method=message['method'],
+                                   kwargs=message.get('params'), reply_to=message.get('reply_to'),
+                                   deadline=message.get('deadline'))
+        if request.deadline and time.time() > request.deadline:
+            gen_log.warning(f'rpc request {request.return_id} of {request.method} dropped, its caller has given up')
+            if on_replied is not None:
+                on_replied()
+            return
+        delegate = self.find_handler(request)
+        if delegate is None:
+            reply = {'id': request.return_id, 'error': f'{request.method} 方法不存在'}
+        else:
+            try:
+                reply = {'id': request.return_id, 'result': await delegate.execute()}
+            except Exception as ex:
+                gen_log.exception(ex)
+                reply = {'id': request.return_id, 'error': str(ex) or type(ex).__name__}
+        try:
+            key, message = self._encode_reply(request, reply)
+        except (TypeError, ValueError) as ex:
+            # encoded here, one reply which can not be sent must not fail the pipeline of the others
+            gen_log.error(f'rpc reply {request.return_id} of {request.method} can not be encoded: {ex}')
+            key, message = self._encode_reply(request, {'id': request.return_id,
+                                                       'error': f'{request.method} 返回值无法编码: {ex}'})
+        self.reply_queue.put_nowait((key, message, on_replied))
+
+    @staticmethod
+    def _encode_reply(request: 'RpcServerRequest', reply: 'Dict') -> Tuple[str, Union[str, bytes]]:
+        """:return: the list the reply is pushed to and the reply"""
+        if request.reply_to:
+            return request.reply_to, encode_message(reply)
+        # callers without a reply list wait on the request id for the bare result, as json unless it is text
+        result = reply.get('result', reply.get('error'))
+        return request.return_id, result if isinstance(result, (str, bytes)) else json.dumps(result)
+
+    async def _write_replies(self):
+        while True:
+            replies = [await self.reply_queue.get()]
+            while not self.reply_queue.empty() and len(replies) < REPLY_BATCH_SIZE:
+                replies.append(self.reply_queue.get_nowait())
+            commands = list()
+            for key, message, _ in replies:
+                commands.append(('LPUSH', key, message))
+                commands.append(('EXPIRE', key, REPLY_TTL))
+            try:
+                await self.async_redis.pipeline(commands)
+            except Exception as ex:
+                gen_log.exception(ex)
+            else:
+                for _, _, on_replied in replies:
+                    if on_replied is not None:
+                        on_replied()
+            finally:
+                for _ in replies:
+                    self.reply_queue.task_done()
+
+    def get_target_delegate(self, target: 'Type[RequestHandler]', request: 'RpcServerRequest',
+                            **target_params: Any) -> RpcMessageDelegate:
+        return _HandlerDelegate(self, request, target, target_params)
 
     def create_service_instance(self) -> 'ServiceInstance':
         instance_id = str(uuid.uuid4())
@@ -136,6 +370,10 @@ class RpcServer(Application, RuleRouter):
         metadata['redis_host'] = self.context.get_redis_config().host
         metadata['password'] = self.context.get_redis_config().password
         metadata['user'] = self.context.get_redis_config().user
+        metadata['heartbeat_interval'] = HEARTBEAT_INTERVAL
+        metadata[TRANSPORT_METADATA] = self.rpc_server_config.transport
+        if self.rpc_server_config.transport == TRANSPORT_STREAM:
+            metadata[STREAM_MAX_LEN_METADATA] = self.rpc_server_config.stream_max_len
         service = ZookeeperServiceInstance(instance_id=instance_id, service_id=service_id,
                                            host=host, port=port,
                                            version=self.version,
@@ -3,17 +3,23 @@
 @Time : 2021/7/1 18:19 
 @Author : Peaker
 """
+from typing import Any, Awaitable, Dict, Union
 
 
 class RpcServerRequest:
 
-    def __init__(self, return_id: 'str' = None, method: 'str' = None, **kwargs: 'any'):
+    def __init__(self, return_id: 'str' = None, method: 'str' = None, kwargs: 'Dict[str, Any]' = None,
+                 reply_to: 'str' = None, deadline: 'float' = None):
         self.return_id = return_id
         self.method = method
-        self.kwargs = kwargs
+        self.kwargs = kwargs or dict()
+        # reply list of the caller, the reply is pushed to ``return_id`` without it
+        self.reply_to = reply_to
+        # epoch seconds after which the caller has given up
+        self.deadline = deadline
 
 
 class RpcMessageDelegate:
 
-    def execute(self):
+    def execute(self) -> Awaitable[Union[str, bytes, dict]]:
         raise NotImplementedError()
@@ -0,0 +1,138 @@
+# coding=utf-8
+"""
+Supervisor of forked worker processes: starts them, restarts the ones which die and stops them
+together on SIGTERM or SIGINT
+"""
+import os
+import signal
+import time
+from typing import Callable, Dict, List
+
+from logger.log import gen_log
+
+# a worker which dies sooner after its start is restarted after ``RESTART_DELAY`` seconds
+MIN_UPTIME = 1.0
+RESTART_DELAY = 1.0
+
+
+class WorkerSupervisor:
+    """
+    Forks ``processes`` workers, each runs ``target(worker_id)`` and exits when it returns.
+    Workers are asked to stop with SIGTERM and killed after ``shutdown_timeout`` seconds
+    """
+
+    def __init__(self, target: Callable[[int], None], processes: int, shutdown_timeout: float = 30.0,
+                 poll_interval: float = 0.5):
+        self.target = target
+        self.processes = processes
+        self.shutdown_timeout = shutdown_timeout
+        self.poll_interval = poll_interval
+        self.workers = dict()  # type: Dict[int, int]
+        self.started = dict()  # type: Dict[int, float]
+        self.restart_at = dict()  # type: Dict[int, float]
+        self.stopping = False
+
+    def run(self, on_stop: Callable[[], None] = None) -> None:
+        """supervises the workers until a stop signal, ``on_stop`` runs before the workers are stopped"""
+        previous = {sig: signal.signal(sig, self._stop_signal) for sig in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            for worker_id in range(self.processes):
+                self._spawn(worker_id)
+            while not self.stopping:
+                self._reap()
+                self._restart()
+                time.sleep(self.poll_interval)
+            if on_stop is not None:
+                on_stop()
+            self._shutdown()
+        finally:
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+
+    def alive(self) -> int:
+        """:return: number of running workers"""
+        return len(self.workers)
+
+    def stop_worker(self, worker_id: int):
+        """stops the worker ``worker_id`` like :meth:`run` stops them all, it is not restarted"""
+        self.restart_at.pop(worker_id, None)
+        self._terminate([pid for pid, worker in self.workers.items() if worker == worker_id])
+
+    def _stop_signal(self, signum, frame):
+        gen_log.info(f'supervisor got signal {signum}, stopping {len(self.workers)} workers')
+        self.stopping = True
+
+    def _spawn(self, worker_id: int):
+        pid = os.fork()
+        if pid == 0:
+            # worker, stopped by the supervisor only
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                self.target(worker_id)
+            except BaseException as ex:
+                gen_log.exception(ex)
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers[pid] = worker_id
+        self.started[worker_id] = time.monotonic()
+        gen_log.info(f'worker {worker_id} started, pid {pid}')
+
+    def _reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker_id = self.workers.pop(pid, None)
+            if worker_id is None:
+                continue
+            gen_log.error(f'worker {worker_id} (pid {pid}) exited with status {status}')
+            if self.stopping:
+                continue
+            delay = RESTART_DELAY if time.monotonic() - self.started[worker_id] < MIN_UPTIME else 0
+            self.restart_at[worker_id] = time.monotonic() + delay
+
+    def _restart(self):
+        now = time.monotonic()
+        for worker_id, restart_at in list(self.restart_at.items()):
+            if restart_at <= now:
+                del self.restart_at[worker_id]
+                self._spawn(worker_id)
+
+    def _shutdown(self):
+        self._terminate(list(self.workers))
+        self.workers.clear()
+
+    def _terminate(self, pids: List[int]):
+        """SIGTERM to ``pids``, the ones still running after ``shutdown_timeout`` seconds are killed"""
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        pending = set(pids)
+        deadline = time.monotonic() + self.shutdown_timeout
+        while pending and time.monotonic() < deadline:
+            for pid in list(pending):
+                try:
+                    exited, _ = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    exited = pid
+                if exited:
+                    pending.discard(pid)
+                    self.workers.pop(pid, None)
+            if pending:
+                time.sleep(0.1)
+        for pid in pending:
+            gen_log.error(f'worker pid {pid} did not stop in {self.shutdown_timeout}s, killed')
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+            self.workers.pop(pid, None)
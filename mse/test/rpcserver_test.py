@@ -0,0 +1,196 @@
+# coding=utf-8
+"""
+Behavior tests of the replies of :class:`mse.rpc.rpcserver.RpcServer`, written to a small RESP server
+in process::
+
+    python -m pytest mse/test/rpcserver_test.py
+"""
+import asyncio
+import os
+import signal
+import threading
+import time
+from typing import Dict, List
+
+import yaml
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.tcpserver import TCPServer
+from tornado.testing import bind_unused_port
+
+from ctx.config import ENV_YAML_DIC, CURRENT_ENV
+from mse.rpc.rpcserver import RequestHandler, RpcServer
+from rpc.message import decode_message
+from rpc.redispool import AsyncRedisClient
+
+
+class FakeRedisServer(TCPServer):
+    """answers LPUSH and EXPIRE, any other command with an error"""
+
+    def __init__(self):
+        super(FakeRedisServer, self).__init__()
+        self.lists = dict()  # type: Dict[bytes, List[bytes]]
+
+    async def handle_stream(self, stream: 'IOStream', address):
+        try:
+            while True:
+                count = int((await stream.read_until(b'\r\n'))[1:-2])
+                args = []
+                for _ in range(count):
+                    length = int((await stream.read_until(b'\r\n'))[1:-2])
+                    args.append((await stream.read_bytes(length + 2))[:-2])
+                await stream.write(self.reply(args[0].upper(), args[1:]))
+        except StreamClosedError:
+            pass
+
+    def reply(self, command: bytes, args: List[bytes]) -> bytes:
+        if command == b'LPUSH':
+            values = self.lists.setdefault(args[0], [])
+            values[:0] = reversed(args[1:])
+            return b':%d\r\n' % len(values)
+        if command == b'EXPIRE':
+            return b':1\r\n'
+        return b'-ERR unknown command\r\n'
+
+
+class ResultHandler(RequestHandler):
+    """returns the ``result`` it is configured with"""
+
+    def initialize(self, result=None):
+        self.result = result
+
+    async def handle_request(self):
+        return self.result
+
+
+HANDLERS = [('none', ResultHandler), ('list', ResultHandler, {'result': [1, 'a']}),
+            ('dict', ResultHandler, {'result': {'a': 1}}), ('text', ResultHandler, {'result': 'ok'}),
+            ('object', ResultHandler, {'result': object()})]
+
+
+class RecordingRegistry:
+    """appends ``<pid> <event> <threads running>`` to ``path`` for each call, from any process"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def record(self, event: str):
+        with open(self.path, 'a') as file:
+            file.write(f'{os.getpid()} {event} {threading.active_count()}\n')
+
+    def start(self):
+        self.record('start')
+        # like the zookeeper client
+        threading.Thread(target=time.sleep, args=(60,), daemon=True).start()
+
+    def register_service(self, service):
+        self.record('register')
+
+    def unregister_service(self, service):
+        self.record('unregister')
+
+    def stop(self):
+        self.record('stop')
+
+
+def read_events(path: str) -> List[List[str]]:
+    """:return: the ``RecordingRegistry`` events, split"""
+    if not os.path.exists(path):
+        return []
+    with open(path) as file:
+        return [line.split() for line in file.read().splitlines()]
+
+
+def create_server(tmp_path, processes: int = 1) -> 'RpcServer':
+    config = {'application': {'name': 'svc', 'port': 8000,
+                              'discovery': {'name': 'zookeeper', 'url': '127.0.0.1:1', 'root_path': '/mse'},
+                              'redis': {'host': '127.0.0.1:1'},
+                              'rpc_server': {'processes': processes, 'shutdown_timeout': 5}}}
+    (tmp_path / ENV_YAML_DIC[CURRENT_ENV]).write_text(yaml.dump(config), encoding='utf-8')
+    return RpcServer(HANDLERS, config_path=str(tmp_path))
+
+
+def run_with_server(tmp_path, requests: List[Dict]):
+    """handles ``requests`` at once, :return: the lists replies were pushed to and the requests replied"""
+
+    async def main():
+        sock, port = bind_unused_port()
+        redis_server = FakeRedisServer()
+        redis_server.add_sockets([sock])
+        server = create_server(tmp_path)
+        server.async_redis = AsyncRedisClient(f'127.0.0.1:{port}')
+        server.reply_queue = asyncio.Queue()
+        writer = asyncio.ensure_future(server._write_replies())
+        replied = []
+        try:
+            await asyncio.gather(*(server._handle_request(request, lambda i=request['id']: replied.append(i))
+                                   for request in requests))
+            await server.reply_queue.join()
+            return redis_server.lists, replied
+        finally:
+            writer.cancel()
+            server.async_redis.close()
+            redis_server.stop()
+
+    return asyncio.run(main())
+
+
+def test_bare_results_are_json_unless_text(tmp_path):
+    requests = [{'id': f'id-{method}', 'method': method} for method in ('none', 'list', 'dict', 'text', 'nope')]
+    lists, replied = run_with_server(tmp_path, requests)
+    assert {key.decode(): value[0].decode() for key, value in lists.items()} == {
+        'id-none': 'null', 'id-list': '[1, "a"]', 'id-dict': '{"a": 1}', 'id-text': 'ok', 'id-nope': 'nope 方法不存在'}
+    assert sorted(replied) == sorted(request['id'] for request in requests)
+
+
+def test_an_unencodable_result_does_not_fail_the_other_replies(tmp_path):
+    requests = [{'id': 'id-object', 'method': 'object', 'reply_to': 'replies'},
+                {'id': 'id-list', 'method': 'list', 'reply_to': 'replies'},
+                {'id': 'id-bare', 'method': 'object'}]
+    lists, replied = run_with_server(tmp_path, requests)
+    replies = {reply['id']: reply for reply in map(decode_message, lists[b'replies'])}
+    assert replies['id-list'] == {'id': 'id-list', 'result': [1, 'a']}
+    assert 'result' not in replies['id-object'] and 'object' in replies['id-object']['error']
+    assert b'object' in lists[b'id-bare'][0]
+    assert sorted(replied) == ['id-bare', 'id-list', 'id-object']
+
+
+def test_prefork_starts_threads_after_the_forks(tmp_path):
+    events = str(tmp_path / 'events')
+    server = create_server(tmp_path, processes=2)
+    registry = server.service_registry = RecordingRegistry(events)
+    server.start_heartbeat = lambda: registry.record('heartbeat')
+
+    async def serve():
+        registry.record('serve')
+        while not server.stopping:
+            await asyncio.sleep(0.01)
+        registry.record('served')
+
+    server.listen = lambda: IOLoop.current().run_sync(serve)
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            server.start()
+            code = 0
+        finally:
+            os._exit(code)
+    try:
+        # two workers serving, the instance registered
+        deadline = time.monotonic() + 10
+        while len(read_events(events)) < 6 and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    by_pid = dict()
+    for event_pid, event, threads in read_events(events):
+        by_pid.setdefault(event_pid, []).append((event, int(threads)))
+    assert str(pid) not in by_pid
+    assert sorted(by_pid.values()) == [[('heartbeat', 1), ('serve', 1), ('served', 1)]] * 2 + [
+        [('start', 1), ('register', 2), ('unregister', 2), ('stop', 2)]]
+    # the instance leaves the routes before the workers stop reading
+    events = [event for _, event, _ in read_events(events)]
+    assert events.index('unregister') < events.index('served')
@@ -0,0 +1,134 @@
+# coding=utf-8
+"""
+Behavior tests of :class:`mse.supervisor.WorkerSupervisor`, the supervisor runs in a forked process
+and its workers record their events in a file::
+
+    python -m pytest mse/test/supervisor_test.py
+"""
+import os
+import signal
+import time
+from typing import Callable, List
+
+import pytest
+
+from mse import supervisor
+from mse.supervisor import WorkerSupervisor
+
+
+class Events:
+    """lines of ``<event> <worker id> <pid>`` appended by any process"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def record(self, event: str, worker_id: int):
+        with open(self.path, 'a') as file:
+            file.write(f'{event} {worker_id} {os.getpid()}\n')
+
+    def read(self) -> List[List[str]]:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as file:
+            return [line.split() for line in file.read().splitlines()]
+
+    def wait_for(self, condition: 'Callable[[List[List[str]]], bool]', timeout: float = 10):
+        deadline = time.monotonic() + timeout
+        while not condition(self.read()):
+            assert time.monotonic() < deadline, self.read()
+            time.sleep(0.02)
+
+
+def serve(events: 'Events', worker_id: int):
+    """a worker which runs until SIGTERM"""
+    stopped = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.append(signum))
+    events.record('start', worker_id)
+    while not stopped:
+        time.sleep(0.01)
+    events.record('stop', worker_id)
+
+
+def run_supervisor(events: 'Events', target, processes: int, until, shutdown_timeout: float = 5,
+                   on_stop: 'Callable[[WorkerSupervisor], None]' = None) -> int:
+    """
+    forks a supervisor of ``target``, SIGTERM once ``until(events)`` holds
+    :return: exit status of the supervisor
+    """
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            supervisor.RESTART_DELAY = 0.1
+            worker_supervisor = WorkerSupervisor(target, processes, shutdown_timeout=shutdown_timeout,
+                                                 poll_interval=0.01)
+            worker_supervisor.run(on_stop=on_stop and (lambda: on_stop(worker_supervisor)))
+            events.record('supervisor-stop', -1)
+            code = 0
+        finally:
+            os._exit(code)
+    try:
+        events.wait_for(until)
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+    return os.waitstatus_to_exitcode(status)
+
+
+def started(count: int):
+    return lambda lines: sum(1 for line in lines if line[0] == 'start') >= count
+
+
+@pytest.fixture
+def events(tmp_path):
+    return Events(str(tmp_path / 'events'))
+
+
+def test_stops_every_worker_on_sigterm(events):
+    assert run_supervisor(events, lambda worker_id: serve(events, worker_id), 3, started(3)) == 0
+    lines = events.read()
+    assert sorted(int(worker_id) for event, worker_id, _ in lines if event == 'start') == [0, 1, 2]
+    assert sorted(int(worker_id) for event, worker_id, _ in lines if event == 'stop') == [0, 1, 2]
+    # the supervisor returns once its workers have stopped
+    assert lines[-1][0] == 'supervisor-stop'
+
+
+def test_restarts_a_dead_worker_with_its_id(events):
+    def target(worker_id):
+        if worker_id == 1 and sum(1 for line in events.read() if line[:2] == ['start', '1']) < 2:
+            events.record('start', worker_id)
+            os._exit(3)
+        serve(events, worker_id)
+
+    assert run_supervisor(events, target, 2, started(4)) == 0
+    starts = [(worker_id, pid) for event, worker_id, pid in events.read() if event == 'start']
+    assert sorted(worker_id for worker_id, _ in starts) == ['0', '1', '1', '1']
+    # every restart is another process
+    assert len({pid for _, pid in starts}) == 4
+
+
+def test_kills_a_worker_which_does_not_stop(events):
+    def target(worker_id):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        events.record('start', worker_id)
+        while True:
+            time.sleep(0.01)
+
+    start = time.monotonic()
+    assert run_supervisor(events, target, 1, started(1), shutdown_timeout=0.3) == 0
+    assert time.monotonic() - start < 5
+    pid = int(events.read()[0][2])
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+
+
+def test_on_stop_can_stop_a_worker_before_the_others(events):
+    def on_stop(worker_supervisor):
+        worker_supervisor.stop_worker(0)
+        events.record('stopped-first', worker_supervisor.alive())
+
+    assert run_supervisor(events, lambda worker_id: serve(events, worker_id), 3, started(3), on_stop=on_stop) == 0
+    stops = [(event, worker_id) for event, worker_id, _ in events.read() if event.startswith('stop')]
+    # worker 0 has stopped, without a restart, before the others were asked to
+    assert stops[:2] == [('stop', '0'), ('stopped-first', '2')]
+    assert sorted(stops[2:]) == [('stop', '1'), ('stop', '2')]
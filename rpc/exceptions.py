@@ -17,3 +17,15 @@ class MSNotFoundError(AbsException):
 
     def __str__(self):
         return self.msg
+
+
+class RpcServerError(AbsException):
+    """
+    error reply of a redis rpc server
+    """
+    def __init__(self, message=''):
+        super(RpcServerError, self).__init__(error_code=RPCErrorCode.Server_Error)
+        self.msg = message
+
+    def __str__(self):
+        return self.msg
@@ -4,8 +4,9 @@
 @Author : Peaker
 @rpc: mse rpc by http
 """
-from tornado.httpclient import HTTPClient
+import urllib.parse
 
+from rpc import pool
 from rpc.route import RouteDefinition
 
 
@@ -13,15 +14,11 @@ def request(route: 'RouteDefinition', method_name: 'str', **kwargs) -> str:
 
     params_val = ''
     if kwargs is not None and kwargs != {}:
-        for key, value in kwargs.items():
-            params_val = f'{key}={value}&'
-
-    if params_val and params_val != '':
-        params_val = params_val[:-1]
-        params_val = f'?{params_val}'
+        params_val = f'?{urllib.parse.urlencode(kwargs)}'
 
     host = route.uri
     real_request_url = f'http://{host}/{method_name}{params_val}'
-    http_client = HTTPClient()
+    # keep-alive connections of the current thread are reused between calls
+    http_client = pool.get_http_client()
     response = http_client.fetch(request=real_request_url)
-    return str(response.body)
+    return response.body.decode('utf-8')
@@ -0,0 +1,81 @@
+# coding=utf-8
+"""
+Redis rpc message envelope.
+
+A message without binary values is the plain json text it has always been. A message carrying
+bytes (such as uploaded files) is sent as a binary envelope instead of base64 strings inside the json::
+
+    MAGIC | version (1 byte) | header length (4 bytes, big endian) | json header | part 0 | part 1 | ...
+
+The json header holds the message with every bytes value replaced by ``{"$part": index}`` and the
+length of every part, the parts follow as raw bytes
+"""
+import json
+import struct
+from typing import Any, List, Union
+
+# starts with a byte json text never starts with
+MAGIC = b'\x00MSE'
+ENVELOPE_VERSION = 1
+PART_KEY = '$part'
+
+_PREFIX = struct.Struct('>4sBI')
+
+
+def _extract_parts(value: Any, parts: List[bytes]) -> Any:
+    """copy of ``value`` with the bytes values moved to ``parts``"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        parts.append(value)
+        return {PART_KEY: len(parts) - 1}
+    if isinstance(value, dict):
+        return {key: _extract_parts(item, parts) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_extract_parts(item, parts) for item in value]
+    return value
+
+
+def _restore_parts(value: Any, parts: List[bytes]) -> Any:
+    if isinstance(value, dict):
+        if len(value) == 1 and PART_KEY in value:
+            return parts[value[PART_KEY]]
+        return {key: _restore_parts(item, parts) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_restore_parts(item, parts) for item in value]
+    return value
+
+
+def encode_message(message: dict) -> bytes:
+    """:return: json text of ``message``, or a binary envelope when it holds bytes values"""
+    parts = list()  # type: List[Union[bytes, bytearray, memoryview]]
+    header = _extract_parts(message, parts)
+    if not parts:
+        return json.dumps(message).encode('utf-8')
+    header = json.dumps({'message': header, 'parts': [len(part) for part in parts]}).encode('utf-8')
+    return b''.join([_PREFIX.pack(MAGIC, ENVELOPE_VERSION, len(header)), header] + parts)
+
+
+def is_envelope(data: bytes) -> bool:
+    return data[:len(MAGIC)] == MAGIC
+
+
+def decode_message(data: Union[bytes, str], copy: bool = True) -> dict:
+    """
+    decodes json text and binary envelopes alike, the parts come back as bytes,
+    or as views of ``data`` without copying when ``copy`` is False
+    """
+    if isinstance(data, str) or not is_envelope(data):
+        return json.loads(data)
+    _, version, header_length = _PREFIX.unpack_from(data)
+    if version != ENVELOPE_VERSION:
+        raise ValueError(f'unsupported rpc envelope version {version}')
+    view = memoryview(data)
+    offset = _PREFIX.size + header_length
+    header = json.loads(bytes(view[_PREFIX.size:offset]))
+    parts = list()  # type: List[Union[bytes, memoryview]]
+    for length in header['parts']:
+        part = view[offset:offset + length]
+        parts.append(bytes(part) if copy else part)
+        offset += length
+    if offset != len(data):
+        raise ValueError('rpc envelope length does not match its parts')
+    return _restore_parts(header['message'], parts)
@@ -0,0 +1,405 @@
+# coding=utf-8
+"""
+Keep-alive upstream http connection pool shared by the gateway and rpc.http
+
+Tornado SimpleAsyncHTTPClient closes the connection after every request,
+the pool keeps idle connections per instance uri (host:port) and reuses them
+"""
+import asyncio
+import collections
+import functools
+import threading
+import time
+import urllib.parse
+from io import BytesIO
+from typing import Awaitable, Dict, Optional, Union, Deque, Tuple, List
+
+from tornado.http1connection import HTTP1Connection, HTTP1ConnectionParameters
+from tornado.httpclient import HTTPRequest, HTTPResponse
+from tornado.httputil import HTTPHeaders, HTTPMessageDelegate, RequestStartLine, ResponseStartLine, \
+    split_host_and_port
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.simple_httpclient import HTTPTimeoutError, HTTPStreamClosedError
+from tornado.tcpclient import TCPClient
+
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 64
+DEFAULT_IDLE_TIMEOUT = 60.0
+DEFAULT_CONNECT_TIMEOUT = 20.0
+DEFAULT_REQUEST_TIMEOUT = 20.0
+
+
+class _ResponseDelegate(HTTPMessageDelegate):
+
+    def __init__(self, request: 'HTTPRequest'):
+        self.request = request
+        self.start_line = None  # type: Optional[ResponseStartLine]
+        self.headers = None  # type: Optional[HTTPHeaders]
+        self.chunks = list()  # type: List[bytes]
+        self.finished = False
+        self.last_activity = time.monotonic()
+
+    def headers_received(self, start_line: 'ResponseStartLine', headers: 'HTTPHeaders'):
+        self.start_line = start_line
+        self.headers = headers
+        self.last_activity = time.monotonic()
+        if self.request.header_callback is not None:
+            self.request.header_callback('%s %s %s\r\n' % start_line)
+            for key, value in headers.get_all():
+                self.request.header_callback('%s: %s\r\n' % (key, value))
+            self.request.header_callback('\r\n')
+
+    def data_received(self, chunk: bytes):
+        self.last_activity = time.monotonic()
+        if self.request.streaming_callback is not None:
+            # an awaitable returned by the callback is awaited by HTTP1Connection, that is the back pressure
+            relayed = self.request.streaming_callback(chunk)
+            return self._relayed(relayed) if relayed is not None else None
+        self.chunks.append(chunk)
+
+    async def _relayed(self, relayed: 'Awaitable[None]'):
+        try:
+            await relayed
+        finally:
+            self.last_activity = time.monotonic()
+
+    def finish(self):
+        self.finished = True
+
+    def on_connection_close(self):
+        pass
+
+    def keep_alive(self) -> bool:
+        if not self.finished or self.start_line is None:
+            return False
+        connection = (self.headers.get('Connection') or '').lower()
+        if self.start_line.version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+
+class _HostPool:
+
+    def __init__(self, uri: str, max_connections: int):
+        self.uri = uri
+        self.max_connections = max_connections
+        self.idle = collections.deque()  # type: Deque[Tuple[IOStream, float]]
+        self.waiters = collections.deque()  # type: Deque[asyncio.Future]
+        self.active = 0
+        self.created = 0
+        self.reused = 0
+        self.closed = 0
+        self.requests = 0
+        self.timeouts = 0
+
+    def connections(self) -> int:
+        return self.active + len(self.idle)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {'connections': self.connections(),
+                'active': self.active,
+                'idle': len(self.idle),
+                'waiting': len(self.waiters),
+                'created': self.created,
+                'reused': self.reused,
+                'closed': self.closed,
+                'requests': self.requests,
+                'timeouts': self.timeouts}
+
+
+class HttpConnectionPool:
+    """
+    Async http client keeping keep-alive connections per upstream instance uri.
+    ``fetch`` takes a tornado HTTPRequest like AsyncHTTPClient, body_producer,
+    streaming_callback and header_callback are supported, redirects are not followed
+    and response body is never decompressed, the raw bytes are passed through
+    """
+
+    def __init__(self, max_connections_per_host: int = DEFAULT_MAX_CONNECTIONS_PER_HOST,
+                 idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 request_timeout: float = DEFAULT_REQUEST_TIMEOUT,
+                 max_body_size: int = None):
+        self.max_connections_per_host = max_connections_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.max_body_size = max_body_size
+        self.tcp_client = TCPClient()
+        self.hosts = dict()  # type: Dict[str, _HostPool]
+        self._last_sweep = time.monotonic()
+
+    async def fetch(self, request: Union[str, 'HTTPRequest'], raise_error: bool = True, read_timeout: float = None,
+                    **kwargs) -> 'HTTPResponse':
+        """
+        ``request_timeout`` covers the whole request. A streamed response (``streaming_callback``) takes as long
+        as it keeps sending, ``request_timeout`` only covers its headers, then at most ``read_timeout`` seconds
+        (default ``request_timeout`` of the pool) may pass between two chunks
+        """
+        if not isinstance(request, HTTPRequest):
+            request = HTTPRequest(url=request, **kwargs)
+        parsed = urllib.parse.urlsplit(request.url)
+        host, port = split_host_and_port(parsed.netloc)
+        port = port or 80
+        host_pool = self._get_host_pool(f'{host}:{port}')
+        host_pool.requests += 1
+
+        start_time = time.monotonic()
+        start_wall_time = time.time()
+        request_timeout = request.request_timeout or self.request_timeout
+        deadline = start_time + request_timeout if request_timeout else None
+        self._sweep_idle()
+
+        reuse = True
+        while True:
+            stream, reused = await self._acquire(host_pool, host, port, request, deadline, reuse)
+            delegate = _ResponseDelegate(request)
+            released = False
+            try:
+                if request.streaming_callback is None:
+                    timeout = deadline - time.monotonic() if deadline else None
+                    await asyncio.wait_for(self._send(stream, request, parsed, delegate), timeout=timeout)
+                else:
+                    await self._send_streamed(stream, request, parsed, delegate, deadline,
+                                              read_timeout or self.request_timeout)
+                self._release(host_pool, stream, delegate.keep_alive())
+                released = True
+                break
+            except asyncio.TimeoutError:
+                host_pool.timeouts += 1
+                raise HTTPTimeoutError('Timeout during request')
+            except StreamClosedError as ex:
+                # the upstream closed an idle keep-alive connection, resend once on a fresh one
+                if reused and delegate.start_line is None and request.body_producer is None:
+                    reuse = False
+                    continue
+                raise ex.real_error or HTTPStreamClosedError('Stream closed')
+            finally:
+                if not released:
+                    self._release(host_pool, stream, False)
+
+        response = HTTPResponse(request, delegate.start_line.code, reason=delegate.start_line.reason,
+                                headers=delegate.headers, buffer=BytesIO(b''.join(delegate.chunks)),
+                                request_time=time.monotonic() - start_time,
+                                start_time=start_wall_time, effective_url=request.url)
+        if raise_error:
+            response.rethrow()
+        return response
+
+    async def _send_streamed(self, stream: 'IOStream', request: 'HTTPRequest', parsed: 'urllib.parse.SplitResult',
+                             delegate: '_ResponseDelegate', deadline: Optional[float], read_timeout: Optional[float]):
+        """:raise asyncio.TimeoutError: no headers by ``deadline``, or no chunk relayed for ``read_timeout`` seconds"""
+        send = asyncio.ensure_future(self._send(stream, request, parsed, delegate))
+        try:
+            while True:
+                if delegate.start_line is None:
+                    expires = deadline
+                else:
+                    expires = delegate.last_activity + read_timeout if read_timeout else None
+                timeout = expires - time.monotonic() if expires is not None else None
+                if timeout is not None and timeout <= 0:
+                    raise asyncio.TimeoutError()
+                done, _ = await asyncio.wait({send}, timeout=timeout)
+                if done:
+                    return send.result()
+        finally:
+            if not send.done():
+                send.cancel()
+
+    async def _send(self, stream: 'IOStream', request: 'HTTPRequest', parsed: 'urllib.parse.SplitResult',
+                    delegate: '_ResponseDelegate'):
+        params = HTTP1ConnectionParameters(no_keep_alive=False, max_body_size=self.max_body_size)
+        connection = HTTP1Connection(stream, True, params)
+        headers = HTTPHeaders(request.headers)
+        headers['Host'] = parsed.netloc
+        headers['Connection'] = 'keep-alive'
+        if request.body is not None:
+            headers['Content-Length'] = str(len(request.body))
+        path = (parsed.path or '/') + ('?' + parsed.query if parsed.query else '')
+        connection.write_headers(RequestStartLine(request.method, path, 'HTTP/1.1'), headers)
+        if request.body is not None:
+            connection.write(request.body)
+        elif request.body_producer is not None:
+            future = request.body_producer(connection.write)
+            if future is not None:
+                await future
+        connection.finish()
+        await connection.read_response(delegate)
+
+    async def _acquire(self, host_pool: '_HostPool', host: str, port: int, request: 'HTTPRequest',
+                       deadline: Optional[float], reuse: bool) -> Tuple['IOStream', bool]:
+        while True:
+            self._evict_idle(host_pool)
+            if reuse and host_pool.idle:
+                # newest first, the oldest ones are left to expire
+                stream, _ = host_pool.idle.pop()
+                stream.set_close_callback(None)
+                host_pool.active += 1
+                host_pool.reused += 1
+                return stream, True
+            if host_pool.connections() < host_pool.max_connections or (not reuse and host_pool.idle):
+                if host_pool.connections() >= host_pool.max_connections:
+                    self._close_stream(host_pool, host_pool.idle.popleft()[0])
+                host_pool.active += 1
+                try:
+                    stream = await self._connect(host, port, request, deadline)
+                except BaseException:
+                    # cancelled as well, by a hedge which lost or a deadline
+                    host_pool.active -= 1
+                    self._notify(host_pool)
+                    raise
+                host_pool.created += 1
+                return stream, False
+
+            waiter = asyncio.get_running_loop().create_future()
+            host_pool.waiters.append(waiter)
+            try:
+                timeout = deadline - time.monotonic() if deadline else None
+                await asyncio.wait_for(waiter, timeout=timeout)
+            except BaseException as ex:
+                if waiter in host_pool.waiters:
+                    host_pool.waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # woken up but gone, the wakeup goes to the next waiter
+                    self._notify(host_pool)
+                if isinstance(ex, asyncio.TimeoutError):
+                    host_pool.timeouts += 1
+                    raise HTTPTimeoutError('Timeout while waiting for connection')
+                raise
+
+    async def _connect(self, host: str, port: int, request: 'HTTPRequest', deadline: Optional[float]) -> 'IOStream':
+        connect_timeout = request.connect_timeout or self.connect_timeout
+        if deadline:
+            connect_timeout = min(connect_timeout, deadline - time.monotonic()) if connect_timeout \
+                else deadline - time.monotonic()
+        try:
+            stream = await asyncio.wait_for(self.tcp_client.connect(host, port), timeout=connect_timeout or None)
+        except asyncio.TimeoutError:
+            self._get_host_pool(f'{host}:{port}').timeouts += 1
+            raise HTTPTimeoutError('Timeout while connecting')
+        except StreamClosedError as ex:
+            raise ex.real_error or HTTPStreamClosedError('Stream closed')
+        stream.set_nodelay(True)
+        return stream
+
+    def _release(self, host_pool: '_HostPool', stream: 'IOStream', reusable: bool):
+        host_pool.active -= 1
+        if reusable and not stream.closed():
+            host_pool.idle.append((stream, time.monotonic()))
+            stream.set_close_callback(functools.partial(self._on_idle_close, host_pool, stream))
+        else:
+            self._close_stream(host_pool, stream)
+        self._notify(host_pool)
+
+    def _on_idle_close(self, host_pool: '_HostPool', stream: 'IOStream'):
+        for item in host_pool.idle:
+            if item[0] is stream:
+                host_pool.idle.remove(item)
+                host_pool.closed += 1
+                self._notify(host_pool)
+                break
+
+    @staticmethod
+    def _close_stream(host_pool: '_HostPool', stream: 'IOStream'):
+        stream.set_close_callback(None)
+        stream.close()
+        host_pool.closed += 1
+
+    @staticmethod
+    def _notify(host_pool: '_HostPool'):
+        while host_pool.waiters:
+            waiter = host_pool.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def _evict_idle(self, host_pool: '_HostPool'):
+        if not self.idle_timeout:
+            return
+        expired = time.monotonic() - self.idle_timeout
+        while host_pool.idle and host_pool.idle[0][1] < expired:
+            self._close_stream(host_pool, host_pool.idle.popleft()[0])
+
+    def _sweep_idle(self):
+        if self.idle_timeout and time.monotonic() - self._last_sweep > self.idle_timeout / 2:
+            self._last_sweep = time.monotonic()
+            for host_pool in list(self.hosts.values()):
+                self._evict_idle(host_pool)
+                if host_pool.connections() == 0 and not host_pool.waiters:
+                    self.hosts.pop(host_pool.uri, None)
+
+    def _get_host_pool(self, uri: str) -> '_HostPool':
+        host_pool = self.hosts.get(uri)
+        if host_pool is None:
+            host_pool = _HostPool(uri, self.max_connections_per_host)
+            self.hosts[uri] = host_pool
+        return host_pool
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        :return: pool stats by instance uri
+        """
+        return {uri: host_pool.get_stats() for uri, host_pool in self.hosts.items()}
+
+    def close(self):
+        for host_pool in self.hosts.values():
+            while host_pool.idle:
+                self._close_stream(host_pool, host_pool.idle.popleft()[0])
+        self.hosts.clear()
+        self.tcp_client.close()
+
+
+class HttpClient:
+    """
+    Blocking client over a HttpConnectionPool, runs its own IOLoop like tornado HTTPClient.
+    Not thread safe, use ``get_http_client`` to get the one of the current thread
+    """
+
+    def __init__(self, **pool_options):
+        self._io_loop = IOLoop(make_current=False)
+        self.connection_pool = HttpConnectionPool(**pool_options)
+
+    def fetch(self, request: Union[str, 'HTTPRequest'], raise_error: bool = True, **kwargs) -> 'HTTPResponse':
+        fetch = functools.partial(self.connection_pool.fetch, request, raise_error, **kwargs)
+        return self._io_loop.run_sync(fetch)
+
+    def close(self):
+        self.connection_pool.close()
+        self._io_loop.close()
+
+
+_pool_options = dict()
+_connection_pool = None  # type: Optional[HttpConnectionPool]
+_thread_local = threading.local()
+
+
+def configure(max_connections_per_host: int = DEFAULT_MAX_CONNECTIONS_PER_HOST,
+              idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+              connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+              request_timeout: float = DEFAULT_REQUEST_TIMEOUT) -> None:
+    """configure the shared pools, must be called before the first request"""
+    global _connection_pool
+    _pool_options.update(max_connections_per_host=max_connections_per_host, idle_timeout=idle_timeout,
+                         connect_timeout=connect_timeout, request_timeout=request_timeout)
+    _connection_pool = None
+
+
+def get_connection_pool() -> 'HttpConnectionPool':
+    """
+    :return: the process wide async pool, connections belong to the IOLoop which uses them first
+    """
+    global _connection_pool
+    if _connection_pool is None:
+        _connection_pool = HttpConnectionPool(**_pool_options)
+    return _connection_pool
+
+
+def get_http_client() -> 'HttpClient':
+    """
+    :return: the blocking client of the current thread
+    """
+    http_client = getattr(_thread_local, 'http_client', None)
+    if http_client is None:
+        http_client = HttpClient(**_pool_options)
+        _thread_local.http_client = http_client
+    return http_client
@@ -1,14 +1,15 @@
 # coding=utf-8
-import functools
 import threading
-from typing import List
+import time
+from typing import Any, Dict, List, Optional
 
-from discovery.event import ServiceWatchedEvent
+from discovery.event import ServiceWatchedEvent, ServiceChangedEvent, InstancesChangedEvent, ServiceRemovedEvent
 from discovery.instance import ServiceInstance
 from discovery.service import DiscoveryClient
 from exception.definition import CommonException
 from exception.error_code import CommonErrorCode
-from gateway.loadbalancer import RandomRule
+from gateway.loadbalancer import LoadBalancerRuleSelector, get_load_balancer_stats, HASH_KEY_METADATA
+from gateway.route.table import RouteTable
 from rpc import http, redis
 from rpc.exceptions import MSNotFoundError
 from rpc.route import RouteDefinition, RpcType, RouteFactory
@@ -18,15 +19,17 @@ class RpcContext(object):
 
     def __init__(self, discovery_client: 'DiscoveryClient'):
         self.discovery_client = discovery_client
-        self.services = discovery_client.get_services()
-        self.service_instances = list()  # type: List[ServiceInstance]
+        # only serializes writers, readers use the current route table without locking
         self._run_lock = threading.Lock()
-        for service in self.services:
+        service_instances = list()  # type: List[ServiceInstance]
+        for service in discovery_client.get_services():
             instances = discovery_client.get_instances(service)  # type: List[ServiceInstance]
             if instances:
-                self.service_instances.extend(instances)
+                service_instances.extend(instances)
 
-        self.route_definitions = list(map(self._create_route_definition, self.service_instances))
+        self.route_table = RouteTable(map(self._create_route_definition, service_instances))
+        # shared by every call, stateful rules keep their rounds and rings across calls
+        self.load_balancer_rule = LoadBalancerRuleSelector()
 
         watcher = ServiceWatchedEvent(func=self.service_watched_event)
         self.discovery_client.add_watch(watcher)
@@ -35,24 +38,19 @@ class RpcContext(object):
         route_definition = RouteFactory.get_route(instance)
         return route_definition
 
-    def service_watched_event(self):
+    def service_watched_event(self, event: 'ServiceChangedEvent'):
         with self._run_lock:
-            services = self.discovery_client.get_services()
-            service_instances = list()  # type: List[ServiceInstance]
-
-            for service in services:
-                instances = self.discovery_client.get_instances(service)  # type: List[ServiceInstance]
-                if instances:
-                    service_instances.extend(instances)
-
-            route_definitions = list(map(self._create_route_definition, service_instances))
-            self.service_instances = service_instances
-            self.route_definitions = route_definitions
-            self.services = services
+            if isinstance(event, InstancesChangedEvent):
+                route_definitions = map(self._create_route_definition, event.instances or ())
+                self.route_table = self.route_table.with_service_routes(event.service_id, route_definitions)
+            elif isinstance(event, ServiceRemovedEvent):
+                self.route_table = self.route_table.without_service(event.service_id)
 
     def get_route_definitions(self) -> List[RouteDefinition]:
-        with self._run_lock:
-            return self.route_definitions
+        return list(self.route_table.get_routes())
+
+    def get_route_table(self) -> 'RouteTable':
+        return self.route_table
 
 
 class ClusterRpcProxy(object):
@@ -69,6 +67,7 @@ class ClusterRpcProxy(object):
 class ServiceProxy(object):
     def __init__(self, service_name: str = 'ServiceProxy', ctx: 'RpcContext' = None):
         self.service_name = service_name
+        self.service_version = None
         self._ctx = ctx
 
     def __getattr__(self, method_name):
@@ -88,24 +87,48 @@ class MethodProxy(object):
         self.service_version = service_version
         self.method_name = method_name
         self._ctx = ctx
-        self.load_balancer_rule = RandomRule()
+        self.load_balancer_stats = get_load_balancer_stats()
+
+    @staticmethod
+    def get_hash_key(routes: List['RouteDefinition'], kwargs: Dict[str, Any]) -> Optional[str]:
+        """
+        hash key of the call for consistent hashing, a ``query:<name>`` key of the ``hash_key`` metadata
+        is the ``name`` argument of the call, the gateway takes it from the query string
+        """
+        if not routes:
+            return None
+        hash_key = routes[0].metadata.get(HASH_KEY_METADATA)
+        if not hash_key:
+            return None
+        source, _, name = hash_key.partition(':')
+        if source == 'query' and kwargs.get(name) is not None:
+            return str(kwargs[name])
+        return None
 
     def __call__(self, *args, **kwargs):
-        lookup_route = functools.partial(self.look_up_route, self.service_name)
-        routes = list(filter(lookup_route, self._ctx.get_route_definitions()))
-        route = self.load_balancer_rule.choose(routes)
+        route_table = self._ctx.get_route_table()
+        if self.service_version is None:
+            routes = route_table.get_service_routes(self.service_name)
+        else:
+            routes = route_table.get_compatible_routes(self.service_name, self.service_version)
+        route = self._ctx.load_balancer_rule.choose(routes, self.get_hash_key(routes, kwargs))
 
         if not route:
             raise MSNotFoundError()
 
-        if route.rpc_type == RpcType.HTTP:
-            return http.request(route=route, method_name=self.method_name, kwargs=kwargs)
-        elif route.route_type == RpcType.REDIS_RPC:
-            return redis.request(route=route, service_name=self.service_name, method_name=self.method_name,
-                                 kwargs=kwargs)
-        else:
+        if route.rpc_type not in (RpcType.HTTP, RpcType.REDIS_RPC):
             raise CommonException(error_code=CommonErrorCode.Rpc_Type_Error)
 
-    @staticmethod
-    def look_up_route(service_name: str, route: 'RouteDefinition'):
-        return service_name == route.route_id
+        self.load_balancer_stats.on_start(route)
+        start = time.monotonic()
+        success = False
+        try:
+            if route.rpc_type == RpcType.HTTP:
+                result = http.request(route=route, method_name=self.method_name, **kwargs)
+            else:
+                result = redis.request(route=route, service_name=self.service_name, method_name=self.method_name,
+                                       **kwargs)
+            success = True
+            return result
+        finally:
+            self.load_balancer_stats.on_complete(route, time.monotonic() - start, success)
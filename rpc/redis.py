@@ -9,6 +9,8 @@ import uuid
 
 from redis import Redis
 
+from rpc import redispool, reply, stream
+from rpc.message import encode_message
 from rpc.route import RedisRpcRouteDefinition
 
 
@@ -18,9 +20,15 @@ class RedisClient(Redis):
     """
 
 
+def heartbeat_key(service_name: str, instance_id: str) -> str:
+    """redis key refreshed by a redis rpc server while it is consuming"""
+    return f'rpc:heartbeat:{service_name}:{instance_id}'
+
+
 def request(route: 'RedisRpcRouteDefinition', service_name, method_name, **kwargs) -> str:
     host = route.uri
-    redis = RedisClient(host=host, password=route.password, username=route.user)
+    # connections of the redis host are pooled and shared with the gateway
+    redis = redispool.get_redis_client(host, password=route.password, username=route.user)
     queue_name = 'work:{}:{}'.format(service_name, route.version)
 
     id = str(uuid.uuid4())
@@ -29,12 +37,28 @@ def request(route: 'RedisRpcRouteDefinition', service_name, method_name, **kwarg
     if kwargs is not None and kwargs != {}:
         params_val = kwargs
 
+    replies = reply.get_reply_channel(host, password=route.password, username=route.user)
     request_info = {'id': id,
                     'queue_name': queue_name,
                     'method': method_name,
-                    'params': params_val}
+                    'params': params_val,
+                    # reply list shared by every request of this process
+                    'reply_to': replies.key}
+
+    # bytes params are sent as raw parts of a binary envelope
+    message = encode_message(request_info)
+
+    def send():
+        if route.metadata.get(stream.TRANSPORT_METADATA) == stream.TRANSPORT_STREAM:
+            redis.xadd(stream.stream_key(service_name, route.version), {stream.MESSAGE_FIELD: message},
+                       maxlen=stream.get_max_len(route), approximate=True)
+            return
+        pipeline = redis.pipeline(transaction=False)
+        pipeline.lpush(queue_name, message)
+        pipeline.expire(queue_name, 15)
+        pipeline.execute()
 
-    redis.lpush(queue_name, json.dumps(request_info))
-    redis.expire(queue_name, 15)
-    channel, response = redis.brpop(id, 15)  # 如果超时会抛异常
-    return response.decode('utf-8')
+    response = reply.get_reply_result(replies.request(id, send, 15))  # 如果超时会抛异常
+    if isinstance(response, bytes):
+        return response.decode('utf-8')
+    return response if isinstance(response, str) else json.dumps(response)
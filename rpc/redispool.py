@@ -0,0 +1,287 @@
+# coding=utf-8
+"""
+Redis connections shared by the gateway and rpc.redis, one bounded pool per redis host.
+
+``AsyncRedisClient`` speaks RESP over tornado IOStreams, so thousands of rpc replies can be
+awaited on the IOLoop at once instead of blocking one thread each. Only the commands the rpc
+path needs are wrapped, any other command goes through ``execute_command``.
+Blocking code uses the redis-py clients of ``get_redis_client``, one connection pool per host as well
+"""
+import asyncio
+import collections
+import threading
+import time
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple
+
+from redis import ConnectionPool, Redis
+from redis.exceptions import AuthenticationError, ConnectionError, ResponseError, TimeoutError
+from tornado.httputil import split_host_and_port
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.tcpclient import TCPClient
+
+DEFAULT_REDIS_PORT = 6379
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 512
+DEFAULT_IDLE_TIMEOUT = 60.0
+DEFAULT_CONNECT_TIMEOUT = 5.0
+
+
+def _encode_command(args: Sequence[Any]) -> bytes:
+    chunks = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode('utf-8')
+        elif isinstance(arg, (int, float)):
+            arg = repr(arg).encode('ascii')
+        chunks.append(b'$%d\r\n' % len(arg))
+        chunks.append(arg)
+        chunks.append(b'\r\n')
+    return b''.join(chunks)
+
+
+class RedisConnection:
+    """one RESP connection, commands are pipelined and their replies read in order"""
+
+    def __init__(self, stream: 'IOStream'):
+        self.stream = stream
+        self.last_used = time.monotonic()
+
+    async def execute(self, commands: Sequence[Sequence[Any]]) -> List[Any]:
+        """
+        :return: one reply per command, an error reply is returned as its ResponseError,
+                 the replies of the other commands are still read so the connection stays usable
+        """
+        try:
+            await self.stream.write(b''.join(_encode_command(command) for command in commands))
+            return [await self._read_reply() for _ in commands]
+        except StreamClosedError as ex:
+            raise ConnectionError(f'redis connection closed: {ex.real_error or ex}')
+
+    async def _read_reply(self) -> Any:
+        line = await self.stream.read_until(b'\r\n')
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b'+':
+            return payload.decode('utf-8')
+        if prefix == b'-':
+            return ResponseError(payload.decode('utf-8'))
+        if prefix == b':':
+            return int(payload)
+        if prefix == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            return (await self.stream.read_bytes(length + 2))[:-2]
+        if prefix == b'*':
+            length = int(payload)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise ConnectionError(f'unexpected redis reply {line[:32]!r}')
+
+    def closed(self) -> bool:
+        return self.stream.closed()
+
+    def close(self):
+        self.stream.close()
+
+
+class AsyncRedisClient:
+    """
+    Async client of one redis host, at most ``max_connections`` connections, idle ones are reused.
+    A command waiting for a connection longer than ``connect_timeout`` fails with a TimeoutError.
+    A connection is closed when its command fails or is cancelled, its reply could still arrive
+    """
+
+    def __init__(self, host: str, password: str = None, username: str = None,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS_PER_HOST, idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT, tcp_client: 'TCPClient' = None):
+        self.host, port = split_host_and_port(host)
+        self.port = port or DEFAULT_REDIS_PORT
+        self.password = password
+        self.username = username
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.tcp_client = tcp_client or TCPClient()
+        self.idle = collections.deque()  # type: Deque[RedisConnection]
+        self.waiters = collections.deque()  # type: Deque[asyncio.Future]
+        self.active = 0
+        self.created = 0
+        self.commands = 0
+
+    async def execute_command(self, *args: Any) -> Any:
+        return (await self.pipeline([args]))[0]
+
+    async def pipeline(self, commands: Sequence[Sequence[Any]]) -> List[Any]:
+        """sends ``commands`` in one round trip, the first error reply is raised after all replies are read"""
+        self.commands += len(commands)
+        connection = await self._acquire()
+        reusable = False
+        try:
+            replies = await connection.execute(commands)
+            reusable = True
+        finally:
+            self._release(connection, reusable)
+        for reply in replies:
+            if isinstance(reply, ResponseError):
+                raise reply
+        return replies
+
+    async def lpush(self, name: str, *values: Any) -> int:
+        return await self.execute_command('LPUSH', name, *values)
+
+    async def expire(self, name: str, seconds: int) -> bool:
+        return bool(await self.execute_command('EXPIRE', name, seconds))
+
+    async def brpop(self, keys: Any, timeout: int = 0) -> Optional[Tuple[bytes, bytes]]:
+        """:return: key and value, None once ``timeout`` whole seconds have passed"""
+        keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+        reply = await self.execute_command('BRPOP', *keys, timeout)
+        return tuple(reply) if reply else None
+
+    async def exists(self, *names: str) -> int:
+        return await self.execute_command('EXISTS', *names)
+
+    async def _acquire(self) -> 'RedisConnection':
+        deadline = time.monotonic() + self.connect_timeout if self.connect_timeout else None
+        while True:
+            self._evict_idle()
+            while self.idle:
+                # newest first, the oldest ones are left to expire
+                connection = self.idle.pop()
+                if not connection.closed():
+                    self.active += 1
+                    return connection
+            if self.active < self.max_connections:
+                self.active += 1
+                try:
+                    return await self._connect(deadline)
+                except BaseException:
+                    # cancelled as well, by the timeout of a caller
+                    self.active -= 1
+                    self._notify()
+                    raise
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, timeout=deadline - time.monotonic() if deadline else None)
+            except BaseException as ex:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # woken up but gone, the wakeup goes to the next waiter
+                    self._notify()
+                if isinstance(ex, asyncio.TimeoutError):
+                    raise TimeoutError(f'no free redis connection to {self.host}:{self.port}')
+                raise
+
+    async def _connect(self, deadline: Optional[float]) -> 'RedisConnection':
+        try:
+            stream = await asyncio.wait_for(self.tcp_client.connect(self.host, self.port),
+                                            timeout=deadline - time.monotonic() if deadline else None)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f'timeout connecting to redis {self.host}:{self.port}')
+        except StreamClosedError as ex:
+            raise ConnectionError(f'error connecting to redis {self.host}:{self.port}: {ex.real_error or ex}')
+        stream.set_nodelay(True)
+        connection = RedisConnection(stream)
+        if self.password:
+            auth = ('AUTH', self.username, self.password) if self.username else ('AUTH', self.password)
+            try:
+                reply = (await connection.execute([auth]))[0]
+            except BaseException:
+                connection.close()
+                raise
+            if isinstance(reply, ResponseError):
+                connection.close()
+                raise AuthenticationError(str(reply))
+        self.created += 1
+        return connection
+
+    def _release(self, connection: 'RedisConnection', reusable: bool):
+        self.active -= 1
+        if reusable and not connection.closed():
+            connection.last_used = time.monotonic()
+            self.idle.append(connection)
+        else:
+            connection.close()
+        self._notify()
+
+    def _notify(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def _evict_idle(self):
+        if not self.idle_timeout:
+            return
+        expired = time.monotonic() - self.idle_timeout
+        while self.idle and self.idle[0].last_used < expired:
+            self.idle.popleft().close()
+
+    def get_stats(self) -> Dict[str, int]:
+        return {'active': self.active, 'idle': len(self.idle), 'waiting': len(self.waiters),
+                'created': self.created, 'commands': self.commands}
+
+    def close(self):
+        while self.idle:
+            self.idle.popleft().close()
+
+
+_pool_options = dict()
+_async_clients = dict()  # type: Dict[Tuple[str, Optional[str], Optional[str]], AsyncRedisClient]
+_clients = dict()  # type: Dict[Tuple[str, Optional[str], Optional[str]], Redis]
+_lock = threading.Lock()
+
+
+def configure(max_connections_per_host: int = DEFAULT_MAX_CONNECTIONS_PER_HOST,
+              idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+              connect_timeout: float = DEFAULT_CONNECT_TIMEOUT) -> None:
+    """configure the shared pools, must be called before the first command"""
+    _pool_options.update(max_connections_per_host=max_connections_per_host, idle_timeout=idle_timeout,
+                         connect_timeout=connect_timeout)
+    _async_clients.clear()
+    _clients.clear()
+
+
+def get_async_redis(host: str, password: str = None, username: str = None) -> 'AsyncRedisClient':
+    """
+    :return: the process wide async client of ``host``, connections belong to the IOLoop which uses them first
+    """
+    key = (host, username, password)
+    client = _async_clients.get(key)
+    if client is None:
+        client = AsyncRedisClient(host, password=password, username=username,
+                                  max_connections=_pool_options.get('max_connections_per_host',
+                                                                    DEFAULT_MAX_CONNECTIONS_PER_HOST),
+                                  idle_timeout=_pool_options.get('idle_timeout', DEFAULT_IDLE_TIMEOUT),
+                                  connect_timeout=_pool_options.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT))
+        _async_clients[key] = client
+    return client
+
+
+def get_redis_client(host: str, password: str = None, username: str = None) -> 'Redis':
+    """:return: the process wide blocking client of ``host``, thread safe"""
+    key = (host, username, password)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                # redis-py connects to localhost when no host is configured
+                redis_host, port = split_host_and_port(host or 'localhost')
+                connection_pool = ConnectionPool(host=redis_host, port=port or DEFAULT_REDIS_PORT, password=password,
+                                                 username=username,
+                                                 max_connections=_pool_options.get('max_connections_per_host',
+                                                                                   DEFAULT_MAX_CONNECTIONS_PER_HOST),
+                                                 socket_connect_timeout=_pool_options.get('connect_timeout',
+                                                                                          DEFAULT_CONNECT_TIMEOUT))
+                client = Redis(connection_pool=connection_pool)
+                _clients[key] = client
+    return client
+
+
+def get_stats() -> Dict[str, Dict[str, int]]:
+    """:return: async pool stats by redis host"""
+    return {f'{client.host}:{client.port}': client.get_stats() for client in _async_clients.values()}
@@ -0,0 +1,183 @@
+# coding=utf-8
+"""
+Multiplexed replies of redis rpc requests.
+
+Every process owns one reply list per redis host and sends it as ``reply_to`` with its requests.
+The rpc server pushes ``{"id": request id, "result": ...}`` (or ``"error"``) to that list, and a single
+reader resolves the future of the request from an ``id -> future`` map. The connections held while
+waiting no longer grow with the number of outstanding requests, one blocking read serves them all
+"""
+import asyncio
+import concurrent.futures
+import os
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
+
+from logger.log import gen_log
+from rpc import redispool
+from rpc.exceptions import RpcServerError
+from rpc.message import decode_message
+
+# replies taken from the list in one round trip once a blocking read has returned
+REPLY_BATCH_SIZE = 100
+# seconds of one blocking read, the reader checks whether it is still needed in between
+REPLY_POLL_TIMEOUT = 1
+
+
+def reply_key() -> str:
+    """new reply list of this process"""
+    return f'rpc:reply:{os.getpid()}:{uuid.uuid4().hex}'
+
+
+def get_reply_result(reply: Dict[str, Any]) -> Union[str, bytes, dict]:
+    """:return: the result of a reply message, an ``error`` reply is raised as RpcServerError"""
+    if reply.get('error') is not None:
+        raise RpcServerError(reply['error'])
+    return reply.get('result')
+
+
+def _batch_commands(key: str) -> List[tuple]:
+    # replies are pushed to the head, the tail trimmed here only holds the replies read
+    return [('LRANGE', key, -REPLY_BATCH_SIZE, -1), ('LTRIM', key, 0, -REPLY_BATCH_SIZE - 1)]
+
+
+class AsyncReplyChannel:
+    """replies of one redis host for the IOLoop, the reader task runs while requests are waiting"""
+
+    def __init__(self, host: str, password: str = None, username: str = None):
+        self.redis = redispool.get_async_redis(host, password=password, username=username)
+        self.key = reply_key()
+        self.waiters = dict()  # type: Dict[str, asyncio.Future]
+        self.reader = None  # type: Optional[asyncio.Task]
+
+    async def request(self, request_id: str, send: Callable[[], Awaitable[Any]], timeout: float) -> Dict[str, Any]:
+        """
+        sends a request with ``send`` and waits for the reply to ``request_id``, the waiter is registered
+        first so a fast reply is not missed
+        :raise asyncio.TimeoutError: no reply within ``timeout`` seconds
+        """
+        future = asyncio.get_event_loop().create_future()
+        self.waiters[request_id] = future
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.ensure_future(self._read_loop())
+        try:
+            await send()
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.waiters.pop(request_id, None)
+
+    async def _read_loop(self):
+        while self.waiters:
+            try:
+                reply = await self.redis.brpop(self.key, REPLY_POLL_TIMEOUT)
+                if reply is None:
+                    continue
+                messages = [reply[1]]
+                batch, _ = await self.redis.pipeline(_batch_commands(self.key))
+                messages.extend(batch)
+            except Exception as ex:
+                gen_log.exception(ex)
+                await asyncio.sleep(REPLY_POLL_TIMEOUT)
+                continue
+            for message in messages:
+                self._resolve(message)
+
+    def _resolve(self, message: bytes):
+        try:
+            reply = decode_message(message)
+        except ValueError as ex:
+            gen_log.error(f'bad rpc reply on {self.key}: {ex}')
+            return
+        future = self.waiters.get(reply.get('id'))
+        if future is not None and not future.done():
+            future.set_result(reply)
+        # otherwise the caller has given up already
+
+
+class ReplyChannel:
+    """replies of one redis host for blocking callers, read by a daemon thread"""
+
+    def __init__(self, host: str, password: str = None, username: str = None):
+        self.redis = redispool.get_redis_client(host, password=password, username=username)
+        self.key = reply_key()
+        self.waiters = dict()  # type: Dict[str, concurrent.futures.Future]
+        self.lock = threading.Lock()
+        self.reader = None  # type: Optional[threading.Thread]
+
+    def request(self, request_id: str, send: Callable[[], Any], timeout: float) -> Dict[str, Any]:
+        """
+        :raise concurrent.futures.TimeoutError: no reply within ``timeout`` seconds
+        """
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.waiters[request_id] = future
+            if self.reader is None or not self.reader.is_alive():
+                self.reader = threading.Thread(target=self._read_loop, name='rpc-reply', daemon=True)
+                self.reader.start()
+        try:
+            send()
+            return future.result(timeout)
+        finally:
+            with self.lock:
+                self.waiters.pop(request_id, None)
+
+    def _read_loop(self):
+        while True:
+            with self.lock:
+                if not self.waiters:
+                    self.reader = None
+                    return
+            try:
+                reply = self.redis.brpop(self.key, REPLY_POLL_TIMEOUT)
+                if reply is None:
+                    continue
+                messages = [reply[1]]
+                pipeline = self.redis.pipeline(transaction=False)
+                for command in _batch_commands(self.key):
+                    pipeline.execute_command(*command)
+                batch, _ = pipeline.execute()
+                messages.extend(batch)
+            except Exception as ex:
+                gen_log.exception(ex)
+                time.sleep(REPLY_POLL_TIMEOUT)
+                continue
+            for message in messages:
+                self._resolve(message)
+
+    def _resolve(self, message: bytes):
+        try:
+            reply = decode_message(message)
+        except ValueError as ex:
+            gen_log.error(f'bad rpc reply on {self.key}: {ex}')
+            return
+        future = self.waiters.get(reply.get('id'))
+        if future is not None and not future.done():
+            future.set_result(reply)
+
+
+_async_channels = dict()  # type: Dict[tuple, AsyncReplyChannel]
+_channels = dict()  # type: Dict[tuple, ReplyChannel]
+_lock = threading.Lock()
+
+
+def get_async_reply_channel(host: str, password: str = None, username: str = None) -> 'AsyncReplyChannel':
+    key = (os.getpid(), host, username, password)
+    channel = _async_channels.get(key)
+    if channel is None:
+        channel = AsyncReplyChannel(host, password=password, username=username)
+        _async_channels[key] = channel
+    return channel
+
+
+def get_reply_channel(host: str, password: str = None, username: str = None) -> 'ReplyChannel':
+    key = (os.getpid(), host, username, password)
+    channel = _channels.get(key)
+    if channel is None:
+        with _lock:
+            channel = _channels.get(key)
+            if channel is None:
+                channel = ReplyChannel(host, password=password, username=username)
+                _channels[key] = channel
+    return channel
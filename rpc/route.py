@@ -4,6 +4,7 @@
 @Author : Peaker
 """
 from enum import Enum
+from typing import Dict
 
 from discovery.instance import ServiceInstance
 from exception.definition import CommonException
@@ -16,17 +17,22 @@ class RpcType(Enum):
 
 
 class RouteDefinition:
-    def __init__(self, route_id: str, uri: str, rpc_type: 'RpcType', version='v1'):
+    def __init__(self, route_id: str, uri: str, rpc_type: 'RpcType', version='v1', instance_id: str = None,
+                 metadata: Dict[str, str] = None):
         self.route_id = route_id
         self.uri = uri
         self.rpc_type = rpc_type
         self.version = version
+        self.instance_id = instance_id
+        self.metadata = metadata or dict()
 
 
 class RedisRpcRouteDefinition(RouteDefinition):
 
-    def __init__(self, route_id: str, uri: str, rpc_type: 'RpcType', password: 'str', user: 'str'):
-        super(RedisRpcRouteDefinition).__init__(route_id, uri, rpc_type)
+    def __init__(self, route_id: str, uri: str, rpc_type: 'RpcType', password: 'str', user: 'str',
+                 version='v1', instance_id: str = None, metadata: Dict[str, str] = None):
+        super(RedisRpcRouteDefinition, self).__init__(route_id, uri, rpc_type, version=version,
+                                                      instance_id=instance_id, metadata=metadata)
         self.password = password
         self.user = user
 
@@ -36,13 +42,19 @@ class RouteFactory:
     @staticmethod
     def get_route(instance: 'ServiceInstance'):
         service_id = instance.get_service_id()
+        version = instance.get_version()
+        instance_id = instance.get_instance_id()
         uri = f'{instance.get_host()}:{instance.get_port()}'
+        metadata = instance.get_meta_data() or dict()
         if instance.get_rpc_type() == RpcType.HTTP.value:
-            return RouteDefinition(route_id=service_id, uri=uri, rpc_type=instance.get_rpc_type())
+            return RouteDefinition(route_id=service_id, uri=uri, rpc_type=RpcType.HTTP, version=version,
+                                   instance_id=instance_id, metadata=metadata)
         elif instance.get_rpc_type() == RpcType.REDIS_RPC.value:
+            uri = instance.get_meta_data().get('redis_host')
             pwd = instance.get_meta_data().get('password')
             user = instance.get_meta_data().get('user')
-            return RedisRpcRouteDefinition(route_id=service_id, uri=uri, rpc_type=instance.get_rpc_type(),
-                                           password=pwd, user=user)
+            return RedisRpcRouteDefinition(route_id=service_id, uri=uri, rpc_type=RpcType.REDIS_RPC,
+                                           password=pwd, user=user, version=version, instance_id=instance_id,
+                                           metadata=metadata)
         else:
             raise CommonException(error_code=CommonErrorCode.Rpc_Type_Error)
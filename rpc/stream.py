@@ -0,0 +1,149 @@
+# coding=utf-8
+"""
+Redis Streams transport of rpc requests.
+
+Producers ``XADD`` the request to the stream of the service, trimmed to about ``max_len`` entries.
+Servers read it with ``XREADGROUP`` in batches as members of one consumer group, so every request
+is handled by one server, and ``XACK`` it once handled. A request read by a server that dies before
+acking stays pending and is claimed by another server after ``claim_idle`` seconds, requests are
+delivered at least once
+"""
+import collections
+import threading
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from redis import Redis
+from redis.exceptions import ResponseError
+
+from logger.log import gen_log
+
+# route metadata keys, set when the instance is registered
+TRANSPORT_METADATA = 'transport'
+STREAM_MAX_LEN_METADATA = 'stream_max_len'
+
+TRANSPORT_LIST = 'list'
+TRANSPORT_STREAM = 'stream'
+
+STREAM_GROUP = 'rpc-server'
+# stream field holding the encoded request
+MESSAGE_FIELD = b'message'
+DEFAULT_MAX_LEN = 100000
+
+
+def stream_key(service_name: str, version: Any) -> str:
+    return f'rpc:stream:{service_name}:{version}'
+
+
+def get_max_len(route: 'Any', default: int = DEFAULT_MAX_LEN) -> int:
+    metadata = getattr(route, 'metadata', None) or dict()
+    try:
+        return int(metadata.get(STREAM_MAX_LEN_METADATA, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def xadd_command(key: str, message: bytes, max_len: int = DEFAULT_MAX_LEN) -> Tuple[Any, ...]:
+    """``XADD`` of one request, for pipelines of the async client"""
+    return 'XADD', key, 'MAXLEN', '~', max_len, '*', MESSAGE_FIELD, message
+
+
+class StreamConsumer:
+    """
+    One consumer of the group of a stream, reads and acks are blocking.
+    ``ack`` may be called from any thread, the acks are sent together with the next read
+    """
+
+    def __init__(self, redis: 'Redis', key: str, consumer: str, group: str = STREAM_GROUP,
+                 batch_size: int = 100, block: float = 5.0, claim_idle: float = 30.0, max_deliveries: int = 5):
+        self.redis = redis
+        self.key = key
+        self.consumer = consumer
+        self.group = group
+        self.batch_size = batch_size
+        self.block = block
+        self.claim_idle = claim_idle
+        self.max_deliveries = max_deliveries
+        self.pending_acks = collections.deque()  # type: Deque[bytes]
+        self._lock = threading.Lock()
+
+    def create_group(self):
+        """creates the stream and its group unless they exist, new servers start with new requests"""
+        try:
+            self.redis.xgroup_create(self.key, self.group, id='$', mkstream=True)
+        except ResponseError as ex:
+            if 'BUSYGROUP' not in str(ex):
+                raise
+
+    def read(self) -> List[Tuple[bytes, bytes]]:
+        """
+        sends the pending acks and reads up to ``batch_size`` new requests, waiting at most ``block`` seconds
+        :return: message ids and requests
+        """
+        self.flush_acks()
+        streams = self.redis.xreadgroup(self.group, self.consumer, {self.key: '>'}, count=self.batch_size,
+                                        block=int(self.block * 1000))
+        messages = list()
+        for _, entries in streams or []:
+            for message_id, fields in entries:
+                if fields and MESSAGE_FIELD in fields:
+                    messages.append((message_id, fields[MESSAGE_FIELD]))
+                else:
+                    # trimmed away while pending or not a request
+                    self.ack(message_id)
+        return messages
+
+    def claim(self) -> List[Tuple[bytes, bytes]]:
+        """
+        takes over the requests pending longer than ``claim_idle`` seconds with other consumers,
+        requests delivered ``max_deliveries`` times are dropped
+        :return: message ids and requests
+        """
+        min_idle_time = int(self.claim_idle * 1000)
+        pending = self.redis.xpending_range(self.key, self.group, '-', '+', self.batch_size)
+        # requests of this consumer are still being handled
+        stale = [entry for entry in pending
+                 if entry['time_since_delivered'] >= min_idle_time and entry['consumer'] != self.consumer.encode()]
+        if not stale:
+            return []
+        for entry in stale:
+            if entry['times_delivered'] >= self.max_deliveries:
+                gen_log.error(f'rpc request {entry["message_id"]} of {self.key} dropped after '
+                              f'{entry["times_delivered"]} deliveries')
+                self.ack(entry['message_id'])
+        message_ids = [entry['message_id'] for entry in stale if entry['times_delivered'] < self.max_deliveries]
+        if not message_ids:
+            self.flush_acks()
+            return []
+        claimed = self.redis.xclaim(self.key, self.group, self.consumer, min_idle_time, message_ids)
+        messages = list()
+        for message_id, fields in claimed:
+            if fields and MESSAGE_FIELD in fields:
+                messages.append((message_id, fields[MESSAGE_FIELD]))
+            else:
+                self.ack(message_id)
+        if messages:
+            gen_log.warning(f'claimed {len(messages)} stale rpc requests of {self.key}')
+        return messages
+
+    def ack(self, message_id: bytes):
+        self.pending_acks.append(message_id)
+
+    def flush_acks(self):
+        """acks every handled request with one ``XACK``"""
+        with self._lock:
+            message_ids = list()
+            while self.pending_acks:
+                message_ids.append(self.pending_acks.popleft())
+            if not message_ids:
+                return
+            try:
+                self.redis.xack(self.key, self.group, *message_ids)
+            except Exception:
+                # acked with the next read, meanwhile the requests stay pending
+                self.pending_acks.extendleft(reversed(message_ids))
+                raise
+
+    def get_backlog(self) -> Dict[str, Optional[int]]:
+        """:return: length of the stream and requests read but not acked yet"""
+        pending = self.redis.xpending(self.key, self.group)
+        return {'length': self.redis.xlen(self.key), 'pending': pending['pending'] if pending else 0}
@@ -0,0 +1,138 @@
+# coding=utf-8
+"""
+Behavior tests of :class:`rpc.pool.HttpConnectionPool` against a local tornado upstream::
+
+    python -m pytest rpc/test/pool_test.py
+"""
+import asyncio
+
+import pytest
+import tornado.web
+from tornado.httpclient import HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.simple_httpclient import HTTPTimeoutError
+from tornado.testing import bind_unused_port
+
+from rpc.pool import HttpConnectionPool
+
+
+class EchoHandler(tornado.web.RequestHandler):
+
+    async def get(self, path):
+        if path == 'slow':
+            await asyncio.sleep(0.2)
+        self.write(path)
+
+
+def run_with_upstream(test):
+    """runs ``test(url)`` with an upstream on a free port"""
+
+    async def main():
+        sock, port = bind_unused_port()
+        server = HTTPServer(tornado.web.Application([(r'/(.*)', EchoHandler)]))
+        server.add_sockets([sock])
+        try:
+            return await test(f'http://127.0.0.1:{port}')
+        finally:
+            server.stop()
+
+    return asyncio.run(main())
+
+
+def hanging_connect(calls: list):
+    """a ``_connect`` which never connects, ``calls`` gets one entry per attempt"""
+
+    async def connect(host, port, request, deadline):
+        calls.append((host, port))
+        await asyncio.get_running_loop().create_future()
+
+    return connect
+
+
+def test_keeps_connections_alive():
+    async def test(url):
+        pool = HttpConnectionPool()
+        first = await pool.fetch(url + '/a')
+        second = await pool.fetch(url + '/b')
+        stats = list(pool.get_stats().values())[0]
+        pool.close()
+        return first.body, second.body, stats
+
+    first, second, stats = run_with_upstream(test)
+    assert (first, second) == (b'a', b'b')
+    assert (stats['created'], stats['reused'], stats['active'], stats['idle']) == (1, 1, 0, 1)
+
+
+def test_limits_connections_per_host():
+    async def test(url):
+        pool = HttpConnectionPool(max_connections_per_host=2)
+        responses = await asyncio.gather(*(pool.fetch(url + '/slow') for _ in range(4)))
+        stats = list(pool.get_stats().values())[0]
+        pool.close()
+        return responses, stats
+
+    responses, stats = run_with_upstream(test)
+    assert [response.code for response in responses] == [200] * 4
+    assert (stats['created'], stats['reused'], stats['active'], stats['waiting']) == (2, 2, 0, 0)
+
+
+def test_request_timeout_while_waiting_for_connection():
+    async def test(url):
+        pool = HttpConnectionPool(max_connections_per_host=1)
+        slow = asyncio.ensure_future(pool.fetch(url + '/slow'))
+        await asyncio.sleep(0.05)
+        with pytest.raises(HTTPTimeoutError):
+            await pool.fetch(HTTPRequest(url + '/a', request_timeout=0.05))
+        await slow
+        stats = list(pool.get_stats().values())[0]
+        pool.close()
+        return stats
+
+    stats = run_with_upstream(test)
+    assert (stats['timeouts'], stats['active'], stats['waiting']) == (1, 0, 0)
+
+
+def test_cancelled_connect_releases_its_slot():
+    async def test():
+        pool = HttpConnectionPool(max_connections_per_host=2)
+        calls = []
+        pool._connect = hanging_connect(calls)
+        fetches = [asyncio.ensure_future(pool.fetch('http://127.0.0.1:1/')) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for fetch in fetches:
+            fetch.cancel()
+        await asyncio.gather(*fetches, return_exceptions=True)
+        stats = pool.get_stats()['127.0.0.1:1']
+        # the slots are free again
+        third = asyncio.ensure_future(pool.fetch('http://127.0.0.1:1/'))
+        await asyncio.sleep(0.01)
+        third.cancel()
+        await asyncio.gather(third, return_exceptions=True)
+        return stats, len(calls)
+
+    stats, calls = asyncio.run(test())
+    assert (stats['active'], stats['connections'], stats['created']) == (0, 0, 0)
+    assert calls == 3
+
+
+def test_cancelled_waiter_passes_its_wakeup_on():
+    async def test():
+        pool = HttpConnectionPool(max_connections_per_host=1, request_timeout=0)
+        calls = []
+        pool._connect = hanging_connect(calls)
+        fetches = [asyncio.ensure_future(pool.fetch('http://127.0.0.1:1/')) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        assert len(calls) == 1
+        # the first frees its slot and wakes the second, which is cancelled before it runs
+        fetches[0].cancel()
+        await asyncio.sleep(0)
+        fetches[1].cancel()
+        await asyncio.sleep(0.01)
+        connecting = len(calls)
+        fetches[2].cancel()
+        await asyncio.gather(*fetches, return_exceptions=True)
+        return connecting, pool.get_stats()['127.0.0.1:1']
+
+    connecting, stats = asyncio.run(test())
+    assert connecting == 2
+    assert (stats['active'], stats['waiting']) == (0, 0)
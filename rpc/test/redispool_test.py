@@ -0,0 +1,180 @@
+# coding=utf-8
+"""
+Behavior tests of :class:`rpc.redispool.AsyncRedisClient` against a small RESP server in process::
+
+    python -m pytest rpc/test/redispool_test.py
+"""
+import asyncio
+from typing import Dict, List
+
+import pytest
+from redis.exceptions import ResponseError, TimeoutError
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.tcpserver import TCPServer
+from tornado.testing import bind_unused_port
+
+from rpc.redispool import AsyncRedisClient
+
+
+class FakeRedisServer(TCPServer):
+    """answers PING, EXISTS, LPUSH and BRPOP (without blocking), any other command with an error"""
+
+    def __init__(self):
+        super(FakeRedisServer, self).__init__()
+        self.lists = dict()  # type: Dict[bytes, List[bytes]]
+        self.connections = 0
+
+    async def handle_stream(self, stream: 'IOStream', address):
+        self.connections += 1
+        try:
+            while True:
+                count = int((await stream.read_until(b'\r\n'))[1:-2])
+                args = []
+                for _ in range(count):
+                    length = int((await stream.read_until(b'\r\n'))[1:-2])
+                    args.append((await stream.read_bytes(length + 2))[:-2])
+                await stream.write(self.reply(args[0].upper(), args[1:]))
+        except StreamClosedError:
+            pass
+
+    def reply(self, command: bytes, args: List[bytes]) -> bytes:
+        if command == b'PING':
+            return b'+PONG\r\n'
+        if command == b'EXISTS':
+            return b':%d\r\n' % sum(1 for key in args if self.lists.get(key))
+        if command == b'LPUSH':
+            values = self.lists.setdefault(args[0], [])
+            values[:0] = reversed(args[1:])
+            return b':%d\r\n' % len(values)
+        if command == b'BRPOP':
+            for key in args[:-1]:
+                if self.lists.get(key):
+                    value = self.lists[key].pop()
+                    return b'*2\r\n$%d\r\n%s\r\n$%d\r\n%s\r\n' % (len(key), key, len(value), value)
+            return b'*-1\r\n'
+        return b'-ERR unknown command\r\n'
+
+
+def run_with_server(test):
+    """runs ``test(server, host)`` with a server on a free port"""
+
+    async def main():
+        sock, port = bind_unused_port()
+        server = FakeRedisServer()
+        server.add_sockets([sock])
+        try:
+            return await test(server, f'127.0.0.1:{port}')
+        finally:
+            server.stop()
+
+    return asyncio.run(main())
+
+
+def hanging_connect(calls: list):
+    """a ``_connect`` which never connects, ``calls`` gets one entry per attempt"""
+
+    async def connect(deadline):
+        calls.append(deadline)
+        await asyncio.get_running_loop().create_future()
+
+    return connect
+
+
+def test_commands():
+    async def test(server, host):
+        client = AsyncRedisClient(host)
+        pushed = await client.lpush('replies', 'a', b'b')
+        exists = await client.exists('replies', 'other')
+        popped = await client.brpop('replies', timeout=1)
+        empty = await client.brpop(['other'], timeout=1)
+        client.close()
+        return pushed, exists, popped, empty
+
+    assert run_with_server(test) == (2, 1, (b'replies', b'a'), None)
+
+
+def test_error_reply_keeps_the_connection():
+    async def test(server, host):
+        client = AsyncRedisClient(host)
+        with pytest.raises(ResponseError):
+            await client.pipeline([('NOPE',), ('PING',)])
+        pong = await client.execute_command('PING')
+        stats = client.get_stats()
+        client.close()
+        return pong, stats, server.connections
+
+    pong, stats, connections = run_with_server(test)
+    assert pong == 'PONG'
+    assert (stats['created'], stats['active'], stats['idle'], connections) == (1, 0, 1, 1)
+
+
+def test_limits_connections():
+    async def test(server, host):
+        client = AsyncRedisClient(host, max_connections=2)
+        replies = await asyncio.gather(*(client.execute_command('PING') for _ in range(10)))
+        stats = client.get_stats()
+        client.close()
+        return replies, stats
+
+    replies, stats = run_with_server(test)
+    assert replies == ['PONG'] * 10
+    assert (stats['created'], stats['active'], stats['waiting']) == (2, 0, 0)
+
+
+def test_waiting_for_a_connection_times_out():
+    async def test():
+        client = AsyncRedisClient('127.0.0.1:1', max_connections=1, connect_timeout=0.05)
+        client._connect = hanging_connect([])
+        first = asyncio.ensure_future(client.exists('key'))
+        await asyncio.sleep(0)
+        with pytest.raises(TimeoutError):
+            await client.exists('key')
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        return client.get_stats()
+
+    stats = asyncio.run(test())
+    assert (stats['active'], stats['waiting']) == (0, 0)
+
+
+def test_cancelled_connect_releases_its_slot():
+    async def test():
+        client = AsyncRedisClient('127.0.0.1:1', max_connections=2)
+        calls = []
+        client._connect = hanging_connect(calls)
+        # like the health checker, which gives up on a slow redis
+        for _ in range(2):
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(client.exists('key'), 0.01)
+        stats = client.get_stats()
+        # the slots are free again
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(client.exists('key'), 0.01)
+        return stats, len(calls)
+
+    stats, calls = asyncio.run(test())
+    assert (stats['active'], stats['created']) == (0, 0)
+    assert calls == 3
+
+
+def test_cancelled_waiter_passes_its_wakeup_on():
+    async def test():
+        client = AsyncRedisClient('127.0.0.1:1', max_connections=1, connect_timeout=0)
+        calls = []
+        client._connect = hanging_connect(calls)
+        commands = [asyncio.ensure_future(client.exists('key')) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        assert len(calls) == 1
+        # the first frees its slot and wakes the second, which is cancelled before it runs
+        commands[0].cancel()
+        await asyncio.sleep(0)
+        commands[1].cancel()
+        await asyncio.sleep(0.01)
+        connecting = len(calls)
+        commands[2].cancel()
+        await asyncio.gather(*commands, return_exceptions=True)
+        return connecting, client.get_stats()
+
+    connecting, stats = asyncio.run(test())
+    assert connecting == 2
+    assert (stats['active'], stats['waiting']) == (0, 0)
@@ -0,0 +1,174 @@
+# coding=utf-8
+"""
+Behavior tests of the multiplexed rpc replies against a small RESP server in process::
+
+    python -m pytest rpc/test/reply_test.py
+"""
+import asyncio
+from typing import Dict, List
+
+import pytest
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.tcpserver import TCPServer
+from tornado.testing import bind_unused_port
+
+from rpc.exceptions import RpcServerError
+from rpc.message import encode_message
+from rpc.redispool import AsyncRedisClient
+from rpc.reply import AsyncReplyChannel, ReplyChannel, get_reply_result
+
+
+class FakeRedisServer(TCPServer):
+    """answers LPUSH, BRPOP (blocking), LRANGE and LTRIM of lists, any other command with an error"""
+
+    def __init__(self):
+        super(FakeRedisServer, self).__init__()
+        self.lists = dict()  # type: Dict[bytes, List[bytes]]
+        self.connections = 0
+
+    async def handle_stream(self, stream: 'IOStream', address):
+        self.connections += 1
+        try:
+            while True:
+                count = int((await stream.read_until(b'\r\n'))[1:-2])
+                args = []
+                for _ in range(count):
+                    length = int((await stream.read_until(b'\r\n'))[1:-2])
+                    args.append((await stream.read_bytes(length + 2))[:-2])
+                await stream.write(await self.reply(args[0].upper(), args[1:]))
+        except StreamClosedError:
+            pass
+
+    async def reply(self, command: bytes, args: List[bytes]) -> bytes:
+        if command == b'LPUSH':
+            values = self.lists.setdefault(args[0], [])
+            values[:0] = reversed(args[1:])
+            return b':%d\r\n' % len(values)
+        if command == b'BRPOP':
+            deadline = asyncio.get_running_loop().time() + float(args[-1])
+            while asyncio.get_running_loop().time() < deadline:
+                for key in args[:-1]:
+                    if self.lists.get(key):
+                        value = self.lists[key].pop()
+                        return b'*2\r\n' + bulk(key) + bulk(value)
+                await asyncio.sleep(0.005)
+            return b'*-1\r\n'
+        if command == b'LRANGE':
+            values = self.lists.get(args[0], [])
+            start, stop = int(args[1]), int(args[2])
+            selected = values[max(0, len(values) + start) if start < 0 else start:
+                              len(values) + stop + 1 if stop < 0 else stop + 1]
+            return b'*%d\r\n' % len(selected) + b''.join(map(bulk, selected))
+        if command == b'LTRIM':
+            values = self.lists.get(args[0], [])
+            start, stop = int(args[1]), int(args[2])
+            values[:] = values[start:len(values) + stop + 1 if stop < 0 else stop + 1]
+            return b'+OK\r\n'
+        return b'-ERR unknown command\r\n'
+
+
+def bulk(value: bytes) -> bytes:
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+async def sent():
+    """a request sent by someone else"""
+
+
+def run_with_server(test):
+    """runs ``test(server, host)`` with a server on a free port"""
+
+    async def main():
+        sock, port = bind_unused_port()
+        server = FakeRedisServer()
+        server.add_sockets([sock])
+        try:
+            return await test(server, f'127.0.0.1:{port}')
+        finally:
+            server.stop()
+
+    return asyncio.run(main())
+
+
+def test_replies_resolve_their_own_requests():
+    async def test(server, host):
+        channel = AsyncReplyChannel(host)
+        rpc_server = AsyncRedisClient(host, max_connections=1)
+
+        async def request(index):
+            async def send():
+                # replied out of order, by a server sharing nothing but the list
+                await asyncio.sleep((10 - index) * 0.002)
+                await rpc_server.lpush(channel.key, encode_message({'id': str(index), 'result': {'index': index}}))
+
+            return await channel.request(str(index), send, 5)
+
+        replies = await asyncio.gather(*(request(index) for index in range(10)))
+        rpc_server.close()
+        await asyncio.sleep(1.1)
+        return replies, channel.reader.done(), server.connections
+
+    replies, reader_done, connections = run_with_server(test)
+    assert replies == [{'id': str(index), 'result': {'index': index}} for index in range(10)]
+    # the reader stops once nobody is waiting
+    assert reader_done
+    # one connection waits for every reply, the other one sends them
+    assert connections == 2
+
+
+def test_reads_the_replies_in_batches():
+    async def test(server, host):
+        channel = AsyncReplyChannel(host)
+
+        async def send():
+            server.lists[channel.key.encode()] = [encode_message({'id': str(index), 'result': index})
+                                                  for index in range(5)]
+
+        first = asyncio.ensure_future(channel.request('0', send, 5))
+        others = [asyncio.ensure_future(channel.request(str(index), sent, 5)) for index in range(1, 5)]
+        replies = await asyncio.gather(first, *others)
+        return [get_reply_result(reply) for reply in replies], server.lists[channel.key.encode()]
+
+    results, left = run_with_server(test)
+    assert sorted(results) == [0, 1, 2, 3, 4]
+    assert left == []
+
+
+def test_times_out_and_drops_late_replies():
+    async def test(server, host):
+        channel = AsyncReplyChannel(host)
+        with pytest.raises(asyncio.TimeoutError):
+            await channel.request('late', sent, 0.05)
+        server.lists[channel.key.encode()] = [b'not json', encode_message({'id': 'late', 'result': 1})]
+
+        async def send():
+            server.lists[channel.key.encode()].insert(0, encode_message({'id': 'next', 'result': b'\x00bytes'}))
+
+        reply = await channel.request('next', send, 5)
+        return reply, channel.waiters
+
+    reply, waiters = run_with_server(test)
+    assert reply == {'id': 'next', 'result': b'\x00bytes'}
+    assert waiters == {}
+
+
+def test_blocking_channel():
+    async def test(server, host):
+        channel = ReplyChannel(host)
+
+        def send(index):
+            reply = {'id': str(index), 'error': 'boom'} if index == 2 else {'id': str(index), 'result': index}
+            server.lists.setdefault(channel.key.encode(), []).insert(0, encode_message(reply))
+
+        loop = asyncio.get_running_loop()
+        replies = await asyncio.gather(*(loop.run_in_executor(None, channel.request, str(index),
+                                                              lambda i=index: send(i), 5) for index in range(3)))
+        # the reader thread stops once nobody is waiting
+        while channel.reader is not None:
+            await asyncio.sleep(0.05)
+        return replies
+
+    replies = run_with_server(test)
+    assert [get_reply_result(reply) for reply in replies[:2]] == [0, 1]
+    with pytest.raises(RpcServerError):
+        get_reply_result(replies[2])
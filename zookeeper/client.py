@@ -35,7 +35,7 @@ class ZookeeperMicroClient(KazooClient):
 
     def get(self, path, watch=None):
         try:
-            val = super(ZookeeperMicroClient, self).get(path)
+            val = super(ZookeeperMicroClient, self).get(path, watch)
             if val is None:
                 return ''
             return val[0].decode('utf-8')
@@ -3,14 +3,18 @@
 @Time : 2021/5/25 13:21 
 @Author : Peaker
 """
+import functools
 import json
-from typing import List, Dict
+import threading
+from typing import Callable, List, Dict, Optional, Set
 
 from kazoo.client import KazooClient
+from kazoo.exceptions import NoNodeError
 from kazoo.protocol.states import KazooState
 from kazoo.recipe.watchers import ChildrenWatch
 
-from discovery.event import WatchedEvent
+from discovery.event import WatchedEvent, ServiceChangedEvent, ServiceAddedEvent, ServiceRemovedEvent, \
+    InstancesChangedEvent
 from discovery.instance import ServiceCache, ServiceInstance
 from discovery.service import ServiceDiscovery, DiscoveryClient
 
@@ -21,6 +25,11 @@ class ZookeeperServiceCache(ServiceCache):
         self._name = name
         self.watch = None  # type: [ChildrenWatch]
         self.instances = None
+        self.instance_nodes = dict()  # type: Dict[str, ServiceInstance]
+        self.watch_initialized = False
+        # instance nodes with a data watch set
+        self.data_watches = set()  # type: Set[str]
+        self.destroyed = False
 
     def get_instances(self) -> List[ServiceInstance]:
         return self.instances
@@ -28,15 +37,27 @@ class ZookeeperServiceCache(ServiceCache):
     def set_instances(self, instances: List[ServiceInstance]) -> None:
         self.instances = instances
 
+    def get_instance_nodes(self) -> Dict[str, ServiceInstance]:
+        """
+        :return: instances by their zookeeper node name
+        """
+        return self.instance_nodes
+
+    def set_instance_nodes(self, instance_nodes: Dict[str, ServiceInstance]) -> None:
+        self.instance_nodes = instance_nodes
+        self.instances = list(instance_nodes.values()) if instance_nodes else None
+
     def get_name(self) -> str:
         return self._name
 
     def destroy(self):
+        self.destroyed = True
         if self.watch:
             self.watch._stopped = True
 
     def clear(self):
         self.instances = None
+        self.instance_nodes = dict()
 
     def set_watch(self, watch: 'ChildrenWatch'):
         self.watch = watch
@@ -76,6 +97,12 @@ class ZookeeperServiceInstance(ServiceInstance):
     def get_rpc_type(self) -> int:
         return self.rpc_type
 
+    def __eq__(self, other):
+        return isinstance(other, ZookeeperServiceInstance) and self.__dict__ == other.__dict__
+
+    def __hash__(self):
+        return hash(self.instance_id)
+
 
 class ZookeeperServiceDiscovery(ServiceDiscovery):
 
@@ -84,6 +111,11 @@ class ZookeeperServiceDiscovery(ServiceDiscovery):
         self.service_nodes = dict()  # type:Dict[str, ZookeeperServiceCache]
         self.watches = set()  # type: [WatchedEvent]
         self.root_path = root_path
+        # services announced to the watchers, survives stop() so a restart reports deltas only
+        self.known_services = set()
+        self.previous_instance_nodes = dict()  # type: Dict[str, Dict[str, ServiceInstance]]
+        # the children watches and the data watches of a service run on different threads
+        self._lock = threading.Lock()
 
     def start(self) -> None:
         self.start_service_watch()
@@ -93,64 +125,133 @@ class ZookeeperServiceDiscovery(ServiceDiscovery):
         ChildrenWatch(client=self.zookeeper, path=self.root_path, func=self._service_node_change)
 
     def _service_node_change(self, nodes: List[str]):
-        old_nodes = [service for service in self.service_nodes.keys()]
-        invalid_nodes = list(set(old_nodes).difference(set(nodes)))
-        new_nodes = list(set(nodes).difference(set(old_nodes)))
+        old_nodes = set(self.known_services)
+        invalid_nodes = old_nodes.difference(set(nodes))
         for node in invalid_nodes:
             self.remove_service_instance(node)
-        for node in new_nodes:
-            self.create_service_instance(node)
-
-        for watch in self.watches:
-            if callable(watch.func):
-                watch.func()
+            self.known_services.discard(node)
+            self._notify(ServiceRemovedEvent(node))
+        for node in nodes:
+            if node not in self.service_nodes:
+                # new service, or a service watched again after the zookeeper session has been lost
+                previous_instance_nodes = self.previous_instance_nodes.pop(node, dict())
+                if node not in old_nodes:
+                    self.known_services.add(node)
+                    self._notify(ServiceAddedEvent(node))
+                self.create_service_instance(node, previous_instance_nodes)
 
     def remove_service_instance(self, service_id: str):
         service_cache = self.service_nodes.pop(service_id, None)
         if service_cache is not None:
             service_cache.destroy()
 
-    def create_service_instance(self, service_id: str) -> None:
+    def create_service_instance(self, service_id: str, previous_instance_nodes: Dict[str, ServiceInstance] = None) -> None:
         node_path = f'{self.root_path}/{service_id}'
         service_cache = ZookeeperServiceCache(name=service_id)
         if self.service_nodes.get(service_id) is not None:
             self.service_nodes.pop(service_id).destroy()
+        if previous_instance_nodes:
+            # diff the first children list against what was known before the rewatch
+            service_cache.set_instance_nodes(previous_instance_nodes)
         self.service_nodes[service_id] = service_cache
 
         def child_node_change(nodes: List[str]) -> None:
-            if nodes is not None and len(nodes) > 0:
-                service_instances = list()
-                for node in nodes:
-                    instance_path = f'{node_path}/{node}'
-                    instance_data = self.zookeeper.get(instance_path)
-                    service_instance = json.loads(str(instance_data))
-                    instance_id = service_instance.get('instance_id')
-                    service_name = service_instance.get('service_id')
-                    host = service_instance.get('host')
-                    port = service_instance.get('port')
-                    version = service_instance.get('version')
-                    rpc_type = service_instance.get('rpc_type')
-                    metadata = service_instance.get('metadata')
-                    service_instance = ZookeeperServiceInstance(service_id=service_name, instance_id=instance_id,
-                                                                host=host, port=port,
-                                                                version=version, rpc_type=rpc_type, metadata=metadata)
-                    service_instances.append(service_instance)
-
-                service = self.service_nodes.get(service_id)
-                if service is not None:
-                    service.set_instances(service_instances)
-            else:
+            with self._lock:
                 service = self.service_nodes.get(service_id)
-                if service is not None:
-                    service.clear()
-
-            for watcher in self.watches:
-                if callable(watcher.func):
-                    watcher.func()
+                if service is not service_cache:
+                    return
+                nodes = nodes or list()
+                known_nodes = service_cache.get_instance_nodes()
+                first_change = not service_cache.watch_initialized
+                service_cache.watch_initialized = True
+                instance_nodes = dict()  # type: Dict[str, ServiceInstance]
+                added, changed = list(), list()
+                for node in nodes:
+                    known_instance = known_nodes.get(node)
+                    if known_instance is not None and not first_change and node in service_cache.data_watches:
+                        # only new nodes are read, every instance registers a node of its own id,
+                        # data set again on a known node is read by its data watch
+                        instance_nodes[node] = known_instance
+                        continue
+                    service_instance = self._read_service_instance(f'{node_path}/{node}',
+                                                                   watch_data(node))
+                    if service_instance is None:
+                        continue
+                    instance_nodes[node] = service_instance
+                    if known_instance is None:
+                        added.append(service_instance)
+                    elif known_instance != service_instance:
+                        changed.append(service_instance)
+                removed = [instance for node, instance in known_nodes.items() if node not in instance_nodes]
+                service_cache.data_watches.intersection_update(instance_nodes)
+
+                if instance_nodes:
+                    service_cache.set_instance_nodes(instance_nodes)
+                else:
+                    service_cache.clear()
+
+                if added or removed or changed or first_change:
+                    self._notify(InstancesChangedEvent(service_id, list(instance_nodes.values()),
+                                                       added=added, removed=removed, changed=changed))
+
+        def watch_data(node: str) -> 'Optional[Callable]':
+            """:return: the data watch of ``node``, None when one is set already"""
+            if node in service_cache.data_watches:
+                return None
+            service_cache.data_watches.add(node)
+            # a watch fires once, the node is read on another thread like the kazoo recipes do
+            return lambda event: self.zookeeper.handler.spawn(functools.partial(instance_data_change, node))
+
+        def instance_data_change(node: str) -> None:
+            with self._lock:
+                service_cache.data_watches.discard(node)
+                if service_cache.destroyed or node not in service_cache.get_instance_nodes():
+                    return
+                service_instance = self._read_service_instance(f'{node_path}/{node}', watch_data(node))
+                if service_instance is None:
+                    # a deleted node is reported by the children watch
+                    service_cache.data_watches.discard(node)
+                    return
+                instance_nodes = dict(service_cache.get_instance_nodes())
+                if instance_nodes[node] == service_instance:
+                    return
+                instance_nodes[node] = service_instance
+                service_cache.set_instance_nodes(instance_nodes)
+                self._notify(InstancesChangedEvent(service_id, list(instance_nodes.values()),
+                                                   changed=[service_instance]))
 
         watch = ChildrenWatch(client=self.zookeeper, path=node_path, func=child_node_change)
         service_cache.set_watch(watch)
 
+    def _read_service_instance(self, instance_path: str,
+                               watch: 'Callable' = None) -> 'Optional[ZookeeperServiceInstance]':
+        """:return: None when the node has been deleted since the children were listed"""
+        try:
+            instance_data = self.zookeeper.get(instance_path, watch=watch)
+        except NoNodeError:
+            return None
+        if isinstance(instance_data, tuple):
+            # KazooClient returns the data and its ZnodeStat, ZookeeperMicroClient the decoded data only
+            instance_data, _ = instance_data
+        if not instance_data:
+            return None
+        service_instance = json.loads(instance_data)
+        instance_id = service_instance.get('instance_id')
+        service_name = service_instance.get('service_id')
+        host = service_instance.get('host')
+        port = service_instance.get('port')
+        version = service_instance.get('version')
+        rpc_type = service_instance.get('rpc_type')
+        metadata = service_instance.get('metadata')
+        return ZookeeperServiceInstance(service_id=service_name, instance_id=instance_id,
+                                        host=host, port=port,
+                                        version=version, rpc_type=rpc_type, metadata=metadata)
+
+    def _notify(self, event: 'ServiceChangedEvent'):
+        for watcher in self.watches:
+            if callable(watcher.func):
+                watcher.func(event)
+
     def query_for_instances(self, name: str) -> List['ServiceInstance']:
         instances = self.service_nodes.get(name).get_instances()
         return instances
@@ -160,6 +261,9 @@ class ZookeeperServiceDiscovery(ServiceDiscovery):
 
     def stop(self):
         current_nodes = [service for service in self.service_nodes.keys()]
+        for node in current_nodes:
+            # keep what is known, a restart only reports what changed meanwhile
+            self.previous_instance_nodes[node] = self.service_nodes[node].get_instance_nodes()
         list(map(self.remove_service_instance, current_nodes))
 
     def add_watch(self, watch: 'WatchedEvent'):
@@ -0,0 +1,162 @@
+# coding=utf-8
+"""
+Behavior tests of :class:`zookeeper.discovery.ZookeeperServiceDiscovery` against a zookeeper in memory::
+
+    python -m pytest zookeeper/test/discovery_test.py
+"""
+import json
+from typing import Callable, Dict, List
+from unittest import mock
+
+import pytest
+from kazoo.exceptions import NoNodeError
+
+from discovery.event import WatchedEvent, InstancesChangedEvent
+from zookeeper.discovery import ZookeeperServiceDiscovery
+
+ROOT = '/services'
+
+
+class FakeZookeeper:
+    """nodes in memory, one-shot data watches like zookeeper, watch callbacks run on the calling thread"""
+
+    def __init__(self):
+        self.nodes = {ROOT: b''}  # type: Dict[str, bytes]
+        self.data_watches = dict()  # type: Dict[str, List[Callable]]
+        self.children_watches = dict()  # type: Dict[str, List[FakeChildrenWatch]]
+        self.handler = self
+
+    def start(self):
+        pass
+
+    def spawn(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+    def get_children(self, path: str) -> List[str]:
+        return sorted(node[len(path) + 1:] for node in self.nodes if node.rsplit('/', 1)[0] == path)
+
+    def get(self, path: str, watch: 'Callable' = None):
+        if path not in self.nodes:
+            raise NoNodeError()
+        if watch is not None:
+            self.data_watches.setdefault(path, []).append(watch)
+        return self.nodes[path], None
+
+    def create(self, path: str, value: bytes = b''):
+        self.nodes[path] = value
+        self._fire_children(path.rsplit('/', 1)[0])
+
+    def set(self, path: str, value: bytes):
+        self.nodes[path] = value
+        self._fire_data(path)
+
+    def delete(self, path: str):
+        self.nodes.pop(path)
+        self._fire_data(path)
+        self._fire_children(path.rsplit('/', 1)[0])
+
+    def _fire_data(self, path: str):
+        for watch in self.data_watches.pop(path, []):
+            watch(mock.sentinel.event)
+
+    def _fire_children(self, path: str):
+        for watch in self.children_watches.get(path, []):
+            watch.fire()
+
+
+class FakeChildrenWatch:
+    """stands in for :class:`kazoo.recipe.watchers.ChildrenWatch`"""
+
+    def __init__(self, client: 'FakeZookeeper', path: str, func: 'Callable'):
+        self.client = client
+        self.path = path
+        self.func = func
+        self._stopped = False
+        client.children_watches.setdefault(path, []).append(self)
+        self.fire()
+
+    def fire(self):
+        if not self._stopped:
+            self.func(self.client.get_children(self.path))
+
+
+def instance(instance_id: str, **metadata) -> bytes:
+    return json.dumps({'instance_id': instance_id, 'service_id': 'svc', 'host': '127.0.0.1', 'port': 1,
+                       'version': 50000, 'rpc_type': 1, 'metadata': metadata}).encode()
+
+
+@pytest.fixture
+def zookeeper():
+    with mock.patch('zookeeper.discovery.ChildrenWatch', FakeChildrenWatch):
+        yield FakeZookeeper()
+
+
+@pytest.fixture
+def events():
+    return []
+
+
+@pytest.fixture
+def discovery(zookeeper, events):
+    zookeeper.create(f'{ROOT}/svc')
+    zookeeper.create(f'{ROOT}/svc/a', instance('a', weight='1'))
+    zookeeper.create(f'{ROOT}/svc/b', instance('b'))
+    service_discovery = ZookeeperServiceDiscovery(zookeeper, ROOT)
+    service_discovery.add_watch(WatchedEvent(func=lambda event: events.append(event)
+                                             if isinstance(event, InstancesChangedEvent) else None))
+    service_discovery.start()
+    events.clear()
+    return service_discovery
+
+
+def metadata(service_discovery: 'ZookeeperServiceDiscovery') -> Dict[str, dict]:
+    return {instance.get_instance_id(): instance.get_meta_data() for instance in
+            service_discovery.query_for_instances('svc')}
+
+
+def test_metadata_set_on_a_known_node_is_reported(zookeeper, discovery, events):
+    zookeeper.set(f'{ROOT}/svc/a', instance('a', weight='5'))
+    assert [([i.get_instance_id() for i in event.changed], event.added, event.removed) for event in events] == \
+           [(['a'], [], [])]
+    assert metadata(discovery) == {'a': {'weight': '5'}, 'b': {}}
+    assert sorted(i.get_instance_id() for i in events[0].instances) == ['a', 'b']
+
+    # the watch is set again for the next change
+    zookeeper.set(f'{ROOT}/svc/a', instance('a', weight='7'))
+    zookeeper.set(f'{ROOT}/svc/b', instance('b', health_check_path='/ping'))
+    assert len(events) == 3
+    assert metadata(discovery) == {'a': {'weight': '7'}, 'b': {'health_check_path': '/ping'}}
+
+
+def test_unchanged_data_is_not_reported(zookeeper, discovery, events):
+    zookeeper.set(f'{ROOT}/svc/a', instance('a', weight='1'))
+    assert events == []
+    # one watch for each node
+    assert {path: len(watches) for path, watches in zookeeper.data_watches.items()} == \
+           {f'{ROOT}/svc/a': 1, f'{ROOT}/svc/b': 1}
+
+
+def test_a_node_created_again_is_watched(zookeeper, discovery, events):
+    zookeeper.delete(f'{ROOT}/svc/a')
+    assert [[i.get_instance_id() for i in event.removed] for event in events] == [['a']]
+    zookeeper.create(f'{ROOT}/svc/a', instance('a', weight='2'))
+    zookeeper.set(f'{ROOT}/svc/a', instance('a', weight='3'))
+    assert [len(event.added) + len(event.changed) for event in events[1:]] == [1, 1]
+    assert metadata(discovery) == {'a': {'weight': '3'}, 'b': {}}
+
+
+def test_a_known_node_without_data_watch_is_read_again(zookeeper, discovery, events):
+    # the node has been replaced between two children lists, its watch fired while it was gone
+    zookeeper.nodes.pop(f'{ROOT}/svc/a')
+    zookeeper._fire_data(f'{ROOT}/svc/a')
+    zookeeper.nodes[f'{ROOT}/svc/a'] = instance('a', weight='4')
+    zookeeper.create(f'{ROOT}/svc/c', instance('c'))
+    assert metadata(discovery) == {'a': {'weight': '4'}, 'b': {}, 'c': {}}
+    zookeeper.set(f'{ROOT}/svc/a', instance('a', weight='6'))
+    assert metadata(discovery)['a'] == {'weight': '6'}
+
+
+def test_stopped_services_report_nothing(zookeeper, discovery, events):
+    discovery.stop()
+    zookeeper.set(f'{ROOT}/svc/a', instance('a', weight='5'))
+    assert events == []